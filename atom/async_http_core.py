@@ -0,0 +1,604 @@
+#!/usr/bin/env python
+#
+#    Copyright (C) 2009 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+"""Runs many HTTP requests at once on a single thread.
+
+AsyncHttpClient implements the same request(http_request) interface as
+atom.http_core.HttpClient, so it can be used anywhere an http_client is
+expected. It also has request_async(http_request), which starts the request
+and returns a Future right away. Requests only make progress while the
+client's event loop runs, which happens in AsyncHttpClient.run() and
+whenever Future.result() is waiting for a result:
+
+  client = AsyncHttpClient()
+  futures = [client.request_async(atom.http_core.HttpRequest(uri, 'GET'))
+             for uri in uris]
+  client.run()
+  responses = [future.result() for future in futures]
+
+Connections are non-blocking sockets multiplexed with select, and are kept
+alive for later requests to the same server. Proxies are not supported; use
+atom.http_core.ProxiedHttpClient behind a proxy.
+"""
+
+
+import errno
+import select
+import socket
+import sys
+import time
+import atom.http_core
+ssl = None
+try:
+  import ssl
+except ImportError:
+  pass
+
+# Non-blocking SSL sockets raise these when they need to wait.
+_SSL_ERRORS = ()
+if ssl is not None:
+  _SSL_ERRORS = ssl.SSLError
+
+
+class Error(Exception):
+  pass
+
+
+class Future(object):
+  """The result of a request which may not have finished yet."""
+
+  def __init__(self, loop=None):
+    self._loop = loop
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def result(self):
+    """Returns the result, running the event loop until there is one.
+
+    Raises:
+      The exception the request failed with, if it failed.
+    """
+    if not self._done and self._loop is not None:
+      self._loop.run(until=self)
+    if not self._done:
+      raise Error('The request has not finished.')
+    if self._exc_info is not None:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+  def add_done_callback(self, callback):
+    """Calls callback(future) once this future is done."""
+    if self._done:
+      callback(self)
+    else:
+      self._callbacks.append(callback)
+
+  def set_result(self, result):
+    self._result = result
+    self._finish()
+
+  def set_exception(self, exc_info):
+    """Finishes with an exception, given as a sys.exc_info() tuple."""
+    self._exc_info = exc_info
+    self._finish()
+
+  def _finish(self):
+    self._done = True
+    callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+
+def completed(result=None, exc_info=None):
+  """Returns a Future which is already done."""
+  future = Future()
+  if exc_info is not None:
+    future.set_exception(exc_info)
+  else:
+    future.set_result(result)
+  return future
+
+
+class AsyncHttpResponse(atom.http_core.HttpResponse):
+  """A response whose body has been read in full.
+
+  Header names are matched without regard to case, as in httplib.
+  """
+
+  def __init__(self, status, reason, headers, body):
+    atom.http_core.HttpResponse.__init__(self, status=status, reason=reason,
+                                         body=body)
+    self._header_list = headers
+    self._headers = dict([(name.lower(), value) for name, value in headers])
+
+  def getheader(self, name, default=None):
+    return self._headers.get(name.lower(), default)
+
+  def getheaders(self):
+    return self._header_list
+
+
+class AsyncHttpClient(object):
+  """Performs HTTP requests on non-blocking sockets from one thread.
+
+  At most max_connections requests are in flight at once, and at most
+  max_per_host of them to any one server; the rest wait their turn. A request
+  which sees no progress for timeout seconds fails with socket.timeout.
+  """
+  debug = None
+  max_connections = 64
+  max_per_host = 8
+  timeout = 60
+  read_size = 65536
+  accept_encoding = atom.http_core.HttpClient.accept_encoding
+
+  def __init__(self):
+    self._waiting = []  # (key, http_request, future) not yet started
+    self._active = []  # _Exchanges in progress
+    self._idle = {}  # key -> [socket, ...] kept alive for reuse
+    self._addresses = {}  # (host, port) -> address from getaddrinfo
+
+  def request(self, http_request):
+    """Performs the request and returns its response, like HttpClient."""
+    return self.request_async(http_request).result()
+
+  Request = request
+
+  def request_async(self, http_request):
+    """Starts the request and returns a Future for its response.
+
+    The response is an AsyncHttpResponse with the whole body already read.
+    """
+    uri = http_request.uri
+    if isinstance(uri, (str, unicode)):
+      uri = atom.http_core.Uri.parse_uri(uri)
+      http_request.uri = uri
+    key = (uri.scheme or 'http', uri.host, _port(uri))
+    future = Future(self)
+    self._waiting.append((key, http_request, future))
+    return future
+
+  RequestAsync = request_async
+
+  def run(self, until=None):
+    """Runs the event loop until every request has finished.
+
+    Args:
+      until: Future (optional) Stop as soon as this future is done instead.
+    """
+    while until is None or not until.done():
+      self._start_waiting()
+      if not self._active:
+        return
+      now = time.time()
+      readers = [x for x in self._active if x.wants_read()]
+      writers = [x for x in self._active if x.wants_write()]
+      deadline = min([x.deadline for x in self._active])
+      try:
+        readable, writable, _ = select.select(readers, writers, [],
+                                              max(0, deadline - now))
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for exchange in writable:
+        self._step(exchange, exchange.handle_write)
+      for exchange in readable:
+        if exchange in self._active:
+          self._step(exchange, exchange.handle_read)
+      now = time.time()
+      for exchange in self._active[:]:
+        if exchange.deadline <= now:
+          self._fail(exchange, (socket.timeout,
+                                socket.timeout('timed out'), None))
+
+  def close(self):
+    """Closes the idle connections."""
+    for sockets in self._idle.values():
+      for sock in sockets:
+        sock.close()
+    self._idle = {}
+
+  def _start_waiting(self):
+    # Callbacks of failed requests may add requests to self._waiting.
+    waiting, self._waiting = self._waiting, []
+    still_waiting = []
+    for key, http_request, future in waiting:
+      if (len(self._active) >= self.max_connections or
+          len([x for x in self._active if x.key == key]) >= self.max_per_host):
+        still_waiting.append((key, http_request, future))
+        continue
+      try:
+        sock = self._idle_socket(key)
+        exchange = _Exchange(self, key, http_request, future, sock)
+      except:
+        future.set_exception(sys.exc_info())
+        continue
+      self._active.append(exchange)
+    self._waiting = still_waiting + self._waiting
+
+  def _idle_socket(self, key):
+    sockets = self._idle.get(key)
+    while sockets:
+      sock = sockets.pop()
+      # An idle socket has nothing to read unless the server closed it.
+      if not select.select([sock], [], [], 0)[0]:
+        return sock
+      sock.close()
+    return None
+
+  def _address(self, host, port):
+    if (host, port) not in self._addresses:
+      self._addresses[(host, port)] = socket.getaddrinfo(
+          host, port, 0, socket.SOCK_STREAM)[0]
+    return self._addresses[(host, port)]
+
+  def _step(self, exchange, handler):
+    try:
+      response = handler()
+    except:
+      self._fail(exchange, sys.exc_info())
+      return
+    if response is not None:
+      self._active.remove(exchange)
+      if exchange.keep_alive:
+        self._idle.setdefault(exchange.key, []).append(exchange.sock)
+      else:
+        exchange.sock.close()
+      exchange.future.set_result(response)
+
+  def _fail(self, exchange, exc_info):
+    self._active.remove(exchange)
+    exchange.sock.close()
+    # A reused connection may have been closed by the server while it was
+    # idle. Send the request again on a new one, if it can be sent again and
+    # the server can't have acted on it yet, or doing it twice is harmless.
+    if (exchange.reused and not exchange.received and
+        (exchange.state != exchange.RECEIVING or
+         exchange.http_request.method in atom.http_core.IDEMPOTENT_METHODS)
+        and exchange.rewind()):
+      self._waiting.insert(0, (exchange.key, exchange.http_request,
+                               exchange.future))
+      for sock in self._idle.pop(exchange.key, []):
+        sock.close()
+      return
+    exchange.future.set_exception(exc_info)
+
+
+def _port(uri):
+  if uri.port:
+    return int(uri.port)
+  if uri.scheme == 'https':
+    return 443
+  return 80
+
+
+class _Exchange(object):
+  """One request and its response on one connection."""
+
+  CONNECTING, HANDSHAKE, SENDING, RECEIVING = range(4)
+
+  def __init__(self, client, key, http_request, future, sock=None):
+    self.client = client
+    self.key = key
+    self.http_request = http_request
+    self.future = future
+    self.reused = sock is not None
+    self.received = False
+    self.keep_alive = False
+    self.deadline = time.time() + client.timeout
+    self._positions = atom.http_core._body_positions(http_request._body_parts)
+    self._parser = _ResponseParser(http_request.method)
+    self._prepare_output()
+    if sock is not None:
+      self.sock = sock
+      self.state = self.SENDING
+    else:
+      self._connect()
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def wants_read(self):
+    if self.state == self.HANDSHAKE:
+      return self._handshake_wants_read
+    return self.state == self.RECEIVING
+
+  def wants_write(self):
+    if self.state == self.HANDSHAKE:
+      return not self._handshake_wants_read
+    return self.state in (self.CONNECTING, self.SENDING)
+
+  def rewind(self):
+    """Gets the request ready to be sent again. False if it can't be."""
+    if self._positions is None:
+      return False
+    atom.http_core._rewind_body(self.http_request._body_parts,
+                                self._positions)
+    return True
+
+  def _connect(self):
+    scheme, host, port = self.key
+    family, socktype, proto, _, address = self.client._address(host, port)
+    self.sock = socket.socket(family, socktype, proto)
+    self.sock.setblocking(0)
+    result = self.sock.connect_ex(address)
+    if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+      raise socket.error(result, errno.errorcode.get(result, 'connect failed'))
+    self.state = self.CONNECTING
+
+  def _prepare_output(self):
+    request = self.http_request
+    uri = request.uri
+    headers = dict(request.headers)
+    default_port = {'http': 80, 'https': 443}.get(self.key[0])
+    if self.key[2] == default_port:
+      headers.setdefault('Host', uri.host)
+    else:
+      headers.setdefault('Host', '%s:%s' % (uri.host, self.key[2]))
+    if self.client.accept_encoding is not None and 'Range' not in headers:
+      headers.setdefault('Accept-Encoding', self.client.accept_encoding)
+    else:
+      headers.setdefault('Accept-Encoding', 'identity')
+    lines = ['%s %s HTTP/1.1' % (request.method, uri._get_relative_path())]
+    for name, value in headers.iteritems():
+      lines.append('%s: %s' % (name, value))
+    self._output = '\r\n'.join(lines) + '\r\n\r\n'
+    self._parts = list(request._body_parts)
+    if self.client.debug:
+      print 'send: %r' % self._output
+
+  def handle_write(self):
+    if self.state == self.CONNECTING:
+      error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        raise socket.error(error, errno.errorcode.get(error, 'connect failed'))
+      if self.key[0] == 'https':
+        self._start_tls()
+      else:
+        self.state = self.SENDING
+      return None
+    if self.state == self.HANDSHAKE:
+      return self._handshake()
+    self._send()
+    return None
+
+  def handle_read(self):
+    if self.state == self.HANDSHAKE:
+      return self._handshake()
+    while True:
+      try:
+        data = self.sock.recv(self.client.read_size)
+      except _SSL_ERRORS, e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+          return None
+        raise
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return None
+        raise
+      self.deadline = time.time() + self.client.timeout
+      if data:
+        self.received = True
+      if self._parser.feed(data):
+        self.keep_alive = self._parser.keep_alive
+        return self._parser.response()
+      if not data:
+        raise atom.http_core.Error('Connection closed before the response '
+                                   'was complete.')
+      # SSL sockets may hold decrypted data that select doesn't know about.
+      if not hasattr(self.sock, 'pending') or not self.sock.pending():
+        return None
+
+  def _start_tls(self):
+    if ssl is None:
+      raise Error('https requires the ssl module.')
+    host = self.key[1]
+    if hasattr(ssl, 'create_default_context'):
+      context = ssl.create_default_context()
+      self.sock = context.wrap_socket(self.sock, server_hostname=host,
+                                      do_handshake_on_connect=False)
+    else:
+      self.sock = ssl.wrap_socket(self.sock, do_handshake_on_connect=False)
+    self.state = self.HANDSHAKE
+    self._handshake_wants_read = False
+
+  def _handshake(self):
+    try:
+      self.sock.do_handshake()
+    except ssl.SSLError, e:
+      if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+        self._handshake_wants_read = True
+        return None
+      if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+        self._handshake_wants_read = False
+        return None
+      raise
+    self.state = self.SENDING
+    return None
+
+  def _send(self):
+    while True:
+      if not self._output:
+        if not self._parts:
+          self.state = self.RECEIVING
+          return
+        self._output = self._next_output()
+        continue
+      try:
+        sent = self.sock.send(self._output)
+      except _SSL_ERRORS, e:
+        if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+          return
+        raise
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      self.deadline = time.time() + self.client.timeout
+      self._output = self._output[sent:]
+      if self._output:
+        return
+
+  def _next_output(self):
+    part = self._parts[0]
+    if isinstance(part, unicode):
+      part = part.encode('utf-8')
+    if isinstance(part, str):
+      self._parts.pop(0)
+      return part
+    if hasattr(part, 'read'):
+      # Send files a piece at a time rather than reading them in whole.
+      data = part.read(self.client.read_size)
+      if data:
+        return data
+      self._parts.pop(0)
+      return ''
+    self._parts.pop(0)
+    return str(part)
+
+
+class _ResponseParser(object):
+  """Reads an HTTP/1.x response from the data fed to it."""
+
+  def __init__(self, method):
+    self.method = method
+    self._buffer = ''
+    self._headers_done = False
+    self._body = []
+    self._remaining = None  # bytes left in the body or current chunk
+    self._chunked = False
+    self._until_close = False
+    self._done = False
+    self.status = None
+    self.reason = None
+    self.headers = []
+    self.keep_alive = False
+
+  def feed(self, data):
+    """Adds data received from the server. Returns True when the response is
+    complete. An empty string means the server closed the connection."""
+    if not data:
+      if self._until_close:
+        self._done = True
+      return self._done
+    self._buffer += data
+    if not self._headers_done:
+      self._parse_headers()
+    if self._headers_done:
+      self._parse_body()
+    return self._done
+
+  def response(self):
+    body = ''.join(self._body)
+    headers = self.headers
+    encoding = dict(headers).get('content-encoding', '').lower()
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+      decompressor = atom.http_core.Decompressor(encoding.replace('x-', ''))
+      body = decompressor.decompress(body) + decompressor.flush()
+      headers = [(name, value) for name, value in headers
+                 if name not in ('content-encoding', 'content-length')]
+    return AsyncHttpResponse(self.status, self.reason, headers, body)
+
+  def _parse_headers(self):
+    while not self._headers_done:
+      end = self._buffer.find('\r\n\r\n')
+      if end == -1:
+        return
+      head = self._buffer[:end].split('\r\n')
+      self._buffer = self._buffer[end + 4:]
+      version, status = head[0].split(' ', 2)[:2]
+      self.reason = ' '.join(head[0].split(' ', 2)[2:])
+      self.status = int(status)
+      self.headers = []
+      for line in head[1:]:
+        name, value = line.split(':', 1)
+        self.headers.append((name.strip().lower(), value.strip()))
+      if self.status == 100:
+        # Skip the interim response and wait for the real one.
+        continue
+      self._headers_done = True
+      self._begin_body(version)
+
+  def _begin_body(self, version):
+    headers = dict(self.headers)
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+      self.keep_alive = connection != 'close'
+    else:
+      self.keep_alive = connection == 'keep-alive'
+    if (self.method == 'HEAD' or self.status in (204, 304) or
+        100 <= self.status < 200):
+      self._remaining = 0
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+      self._chunked = True
+    elif 'content-length' in headers:
+      self._remaining = int(headers['content-length'])
+    else:
+      self._until_close = True
+      self.keep_alive = False
+
+  def _parse_body(self):
+    if self._until_close:
+      self._body.append(self._buffer)
+      self._buffer = ''
+      return
+    if not self._chunked:
+      take = self._buffer[:self._remaining]
+      self._body.append(take)
+      self._buffer = self._buffer[len(take):]
+      self._remaining -= len(take)
+      self._done = self._remaining == 0
+      return
+    while not self._done:
+      if self._remaining is None:
+        end = self._buffer.find('\r\n')
+        if end == -1:
+          return
+        size = int(self._buffer[:end].split(';')[0], 16)
+        self._buffer = self._buffer[end + 2:]
+        if size == 0:
+          self._remaining = -1
+        else:
+          self._remaining = size
+      if self._remaining == -1:
+        # Skip any trailers, which end with a blank line.
+        end = self._buffer.find('\r\n\r\n')
+        if self._buffer.startswith('\r\n'):
+          self._done = True
+        elif end != -1:
+          self._done = True
+        return
+      take = self._buffer[:self._remaining]
+      self._body.append(take)
+      self._buffer = self._buffer[len(take):]
+      self._remaining -= len(take)
+      if self._remaining:
+        return
+      if len(self._buffer) < 2:
+        self._remaining = 0
+        return
+      self._buffer = self._buffer[2:]
+      self._remaining = None
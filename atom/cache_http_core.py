@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+#
+#    Copyright (C) 2009 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+"""Caches XML responses and revalidates them with their ETag.
+
+CachingHttpClient wraps another http_client. It remembers the body and ETag
+of each XML response to a GET, and asks for the same URI again with
+If-None-Match. When the server answers 304 Not Modified, the remembered
+response is returned as if the server had sent it again:
+
+  cache = HttpCache(max_bytes=16 * 1024 * 1024, cache_dir='/tmp/feeds')
+  client.http_client = CachingHttpClient(client.http_client, cache)
+
+Responses are cached per URI and per Authorization header, so one user is
+never handed another user's feed. An HttpCache may be shared by several
+CachingHttpClients, including ones used from different threads.
+
+A new response is passed on to the caller as it is read, so it can still be
+parsed while it streams in, and it is only stored once it has been read to
+the end.
+
+Responses from the cache keep the objects parsed from them in
+parsed_objects, which gdata.client.GDClient uses to hand back the object it
+parsed last time instead of parsing an unchanged feed again. These count
+against the cache's max_bytes too, as PARSED_OBJECT_COST times the size of
+the body they were parsed from.
+"""
+
+
+import StringIO
+import collections
+import hashlib
+import marshal
+import os
+import threading
+import time
+import atom.http_core
+
+
+# A parsed feed takes several times the memory of its XML, about eight
+# times with atom.core.LAZY_CHILDREN and more without.
+PARSED_OBJECT_COST = 8
+
+
+class CachedHttpResponse(atom.http_core.HttpResponse):
+  """A response whose body and headers came from or went into the cache.
+
+  Attributes:
+    from_cache: bool True if the server answered 304 Not Modified and the
+        body is the one cached earlier.
+    parsed_objects: dict Objects parsed from this body, keyed by whatever
+        the parser likes. Shared by every response for the same cache entry.
+  """
+
+  def __init__(self, entry, from_cache):
+    atom.http_core.HttpResponse.__init__(self, entry.status, entry.reason,
+                                         body=StringIO.StringIO(entry.body))
+    self._header_list = entry.headers
+    self._headers = dict((name.lower(), value)
+                         for name, value in entry.headers)
+    self.from_cache = from_cache
+    self.parsed_objects = entry.parsed_objects
+
+  def getheader(self, name, default=None):
+    return self._headers.get(name.lower(), default)
+
+  def getheaders(self):
+    return self._header_list
+
+
+class _Entry(object):
+
+  def __init__(self, etag, status, reason, headers, body):
+    self.etag = etag
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.body = body
+    self.parsed_objects = _ParsedObjects(self)
+    self.cache = None  # the HttpCache holding the entry in memory
+    self.key = None
+    self.counted = 0  # what the entry adds to the cache's size
+
+  def cost(self):
+    return len(self.body) * (1 + PARSED_OBJECT_COST * len(self.parsed_objects))
+
+
+class _ParsedObjects(dict):
+  """The parsed_objects of an _Entry, which tells the cache holding the
+  entry about each object added so it can be counted against max_bytes."""
+
+  def __init__(self, entry):
+    dict.__init__(self)
+    self._entry = entry
+
+  def __setitem__(self, key, value):
+    dict.__setitem__(self, key, value)
+    cache = self._entry.cache
+    if cache is not None:
+      cache._recount(self._entry)
+
+
+class HttpCache(object):
+  """Stores cached responses, least recently used first out.
+
+  The bodies kept in memory, and the objects parsed from them, add up to
+  at most max_bytes. If cache_dir is
+  given, every response is also written there and read back when it isn't
+  in memory, so the cache outlives the process. The files in cache_dir add
+  up to at most max_disk_bytes, the least recently used going first, and a
+  file which hasn't been used for max_age seconds is thrown away.
+  """
+
+  def __init__(self, max_bytes=16777216, cache_dir=None,
+               max_disk_bytes=67108864, max_age=604800):
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.max_disk_bytes = max_disk_bytes
+    self.max_age = max_age
+    self.size = 0
+    self._entries = collections.OrderedDict()  # key -> _Entry
+    self._lock = threading.Lock()
+    self._disk_size = None  # bytes in cache_dir, counted by the first prune
+    self._disk_lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the cached _Entry for key, or None."""
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+        return entry
+    finally:
+      self._lock.release()
+    entry = self._read(key)
+    if entry is not None:
+      self._remember(key, entry)
+    return entry
+
+  def put(self, key, entry):
+    self._remember(key, entry)
+    self._write(key, entry)
+
+  def remove(self, key):
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._forget(entry)
+    finally:
+      self._lock.release()
+    if self.cache_dir is not None:
+      self._remove_file(self._path(key))
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      for entry in self._entries.values():
+        entry.cache = None
+      self._entries.clear()
+      self.size = 0
+    finally:
+      self._lock.release()
+
+  def _remember(self, key, entry):
+    self._lock.acquire()
+    try:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._forget(old)
+      if len(entry.body) > self.max_bytes:
+        return
+      entry.cache = self
+      entry.key = key
+      self._entries[key] = entry
+      self._count(entry)
+    finally:
+      self._lock.release()
+
+  def _recount(self, entry):
+    """Counts the objects parsed from entry since it was last counted."""
+    self._lock.acquire()
+    try:
+      if self._entries.get(entry.key) is entry:
+        # It was just used, so it is the last to go.
+        del self._entries[entry.key]
+        self._entries[entry.key] = entry
+        self._count(entry)
+    finally:
+      self._lock.release()
+
+  def _count(self, entry):
+    cost = entry.cost()
+    if cost > self.max_bytes:
+      # The body fits but not with what was parsed from it.
+      dict.clear(entry.parsed_objects)
+      cost = entry.cost()
+    self.size += cost - entry.counted
+    entry.counted = cost
+    while self.size > self.max_bytes:
+      oldest_key, oldest = self._entries.popitem(last=False)
+      self._forget(oldest)
+
+  def _forget(self, entry):
+    self.size -= entry.counted
+    entry.counted = 0
+    entry.cache = None
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir,
+                        hashlib.sha1(marshal.dumps(key)).hexdigest())
+
+  def _read(self, key):
+    if self.cache_dir is None:
+      return None
+    path = self._path(key)
+    try:
+      if time.time() - os.path.getmtime(path) > self.max_age:
+        self._remove_file(path)
+        return None
+      stored = open(path, 'rb').read()
+      # The modification time marks when the file was last used.
+      os.utime(path, None)
+    except (IOError, OSError):
+      return None
+    try:
+      stored_key, etag, status, reason, headers, body = marshal.loads(stored)
+    except (EOFError, ValueError, TypeError):
+      return None
+    if stored_key != key:
+      return None
+    return _Entry(etag, status, reason, headers, body)
+
+  def _write(self, key, entry):
+    if self.cache_dir is None:
+      return
+    path = self._path(key)
+    temp_path = '%s.%d.tmp' % (path, threading.currentThread().ident)
+    data = marshal.dumps((key, entry.etag, entry.status, entry.reason,
+                          [tuple(header) for header in entry.headers],
+                          entry.body))
+    if len(data) > self.max_disk_bytes:
+      self._remove_file(path)
+      return
+    try:
+      if not os.path.isdir(self.cache_dir):
+        os.makedirs(self.cache_dir, 0700)
+      temp_file = open(temp_path, 'wb')
+      try:
+        temp_file.write(data)
+      finally:
+        temp_file.close()
+      replaced = _file_size(path)
+      os.rename(temp_path, path)
+    except (IOError, OSError):
+      # The disk cache is only an optimization.
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+      return
+    self._disk_lock.acquire()
+    try:
+      if self._disk_size is not None:
+        self._disk_size += len(data) - replaced
+      if self._disk_size is None or self._disk_size > self.max_disk_bytes:
+        self._prune()
+    finally:
+      self._disk_lock.release()
+
+  def _remove_file(self, path):
+    size = _file_size(path)
+    try:
+      os.remove(path)
+    except OSError:
+      return
+    self._disk_lock.acquire()
+    try:
+      if self._disk_size is not None:
+        self._disk_size -= size
+    finally:
+      self._disk_lock.release()
+
+  def _prune(self):
+    """Removes expired files from cache_dir, then the least recently used
+    ones until it is back to three quarters of max_disk_bytes, so it isn't
+    scanned again on the next write. Called with _disk_lock held."""
+    now = time.time()
+    files = []
+    try:
+      names = os.listdir(self.cache_dir)
+    except OSError:
+      return
+    for name in names:
+      path = os.path.join(self.cache_dir, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      # Temp files are left behind by writes which didn't finish.
+      if (now - stat.st_mtime > self.max_age or
+          (name.endswith('.tmp') and now - stat.st_mtime > 3600)):
+        _remove_quietly(path)
+      elif not name.endswith('.tmp'):
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    size = sum([file_size for mtime, file_size, path in files])
+    limit = self.max_disk_bytes * 3 / 4
+    for mtime, file_size, path in files:
+      if size <= limit:
+        break
+      _remove_quietly(path)
+      size -= file_size
+    self._disk_size = size
+
+
+class CachingHttpClient(object):
+  """Performs requests with another http_client, caching XML GET responses.
+
+  Requests which already carry If-None-Match, If-Match or Range headers are
+  passed through untouched, as are responses without an ETag or marked
+  Cache-Control: no-store. Any other method sent to a cached URI drops it
+  from the cache.
+  """
+
+  def __init__(self, http_client=None, cache=None):
+    self.http_client = http_client or atom.http_core.HttpClient()
+    self.cache = cache or HttpCache()
+
+  def _get_debug(self):
+    return self.http_client.debug
+
+  def _set_debug(self, value):
+    self.http_client.debug = value
+
+  debug = property(_get_debug, _set_debug)
+
+  def request(self, http_request):
+    key = (str(http_request.uri), _auth_scope(http_request))
+    if http_request.method != 'GET':
+      self.cache.remove(key)
+      return self.http_client.request(http_request)
+    for header in ('If-None-Match', 'If-Match', 'Range'):
+      if header in http_request.headers:
+        return self.http_client.request(http_request)
+
+    entry = self.cache.get(key)
+    if entry is not None:
+      http_request = http_request._copy()
+      http_request.headers['If-None-Match'] = entry.etag
+    response = self.http_client.request(http_request)
+
+    if response.status == 304 and entry is not None:
+      etag = response.getheader('ETag') or response.getheader('etag')
+      response.read()
+      if etag is not None and etag != entry.etag:
+        entry.etag = etag
+        self.cache.put(key, entry)
+      return CachedHttpResponse(entry, True)
+
+    if response.status != 200 or not _cacheable(response):
+      return response
+    headers = response.getheaders()
+    if isinstance(headers, dict):
+      headers = headers.items()
+    entry = _Entry(response.getheader('ETag') or response.getheader('etag'),
+                   response.status, response.reason, list(headers), None)
+    return _CachingResponse(response, self.cache, key, entry)
+
+  Request = request
+
+
+class _CachingResponse(object):
+  """Passes a response on as it is read, keeping a copy of the body.
+
+  The entry is put in the cache once the body has been read to the end. If
+  the body grows past the cache's max_bytes, the copy is dropped and nothing
+  is cached, so a huge feed is never held in memory.
+  """
+
+  from_cache = False
+
+  def __init__(self, response, cache, key, entry):
+    self._response = response
+    self._cache = cache
+    self._key = key
+    self._entry = entry
+    self._parts = []
+    self._size = 0
+    self.status = response.status
+    self.reason = response.reason
+    self.parsed_objects = entry.parsed_objects
+
+  def read(self, amt=None):
+    if amt:
+      data = self._response.read(amt)
+    else:
+      data = self._response.read()
+    if self._parts is None:
+      return data
+    if data:
+      self._parts.append(data)
+      self._size += len(data)
+      if self._size > self._cache.max_bytes:
+        self._parts = None
+        return data
+    if not amt or not data:
+      self._entry.body = ''.join(self._parts)
+      self._parts = None
+      self._cache.put(self._key, self._entry)
+    return data
+
+  def getheader(self, name, default=None):
+    return self._response.getheader(name, default)
+
+  def getheaders(self):
+    return self._response.getheaders()
+
+
+def _file_size(path):
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+
+def _remove_quietly(path):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def _auth_scope(http_request):
+  authorization = http_request.headers.get('Authorization')
+  if authorization is None:
+    return None
+  return hashlib.sha1(authorization).hexdigest()
+
+
+def _cacheable(response):
+  if not (response.getheader('ETag') or response.getheader('etag')):
+    return False
+  content_type = (response.getheader('Content-Type')
+                  or response.getheader('content-type') or '')
+  if 'xml' not in content_type:
+    return False
+  cache_control = (response.getheader('Cache-Control')
+                   or response.getheader('cache-control') or '')
+  return 'no-store' not in cache_control
@@ -22,6 +22,8 @@
 __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
+import sys
+import atom.async_http_core
 import atom.http_core
 
 
@@ -80,6 +82,39 @@ class AtomPubClient(object):
       The results of calling self.http_client.request. With the default
       http_client, this is an HTTP response object.
     """
+    http_request = self._build_request(method, uri, auth_token, http_request,
+                                       **kwargs)
+    # Perform the fully specified request using the http_client instance.
+    # Sends the request to the server and returns the server's response.
+    return self.http_client.request(http_request)
+
+  Request = request
+
+  def request_async(self, method=None, uri=None, auth_token=None,
+                    http_request=None, **kwargs):
+    """Starts an HTTP request and returns a Future for the response.
+
+    Takes the same arguments as request(). If the http_client has no
+    request_async method, the request is performed right away and the
+    returned future is already done.
+
+    Returns:
+      An atom.async_http_core.Future whose result() is the response.
+    """
+    http_request = self._build_request(method, uri, auth_token, http_request,
+                                       **kwargs)
+    if hasattr(self.http_client, 'request_async'):
+      return self.http_client.request_async(http_request)
+    try:
+      return atom.async_http_core.completed(
+          self.http_client.request(http_request))
+    except:
+      return atom.async_http_core.completed(exc_info=sys.exc_info())
+
+  RequestAsync = request_async
+
+  def _build_request(self, method, uri, auth_token, http_request, **kwargs):
+    """Fills in the request as described in request()."""
     # Modify the request based on the AtomPubClient settings and parameters
     # passed in to the request.
     http_request = self.modify_request(http_request)
@@ -112,11 +147,7 @@ class AtomPubClient(object):
     if http_request.uri.host is None:
       raise MissingHost('No host provided in request %s %s' % (
           http_request.method, str(http_request.uri)))
-    # Perform the fully specified request using the http_client instance.
-    # Sends the request to the server and returns the server's response.
-    return self.http_client.request(http_request)
-
-  Request = request
+    return http_request
 
   def get(self, uri=None, auth_token=None, http_request=None, **kwargs):
     """Performs a request using the GET method, returns an HTTP response."""
@@ -171,11 +202,13 @@ class AtomPubClient(object):
     if self.host is not None and http_request.uri.host is None:
       http_request.uri.host = self.host
 
-    # Set the user agent header for logging purposes.
+    # Set the user agent header for logging purposes. Google's servers only
+    # compress responses for user agents which mention gzip.
     if self.source:
-      http_request.headers['User-Agent'] = '%s gdata-py/2.0.14' % self.source
+      http_request.headers['User-Agent'] = (
+          '%s gdata-py/2.0.14 (gzip)' % self.source)
     else:
-      http_request.headers['User-Agent'] = 'gdata-py/2.0.14'
+      http_request.headers['User-Agent'] = 'gdata-py/2.0.14 (gzip)'
 
     return http_request
 
@@ -21,7 +21,7 @@
 __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
-import inspect
+import StringIO
 try:
   from xml.etree import cElementTree as ElementTree
 except ImportError:
@@ -42,37 +42,150 @@ except ImportError:
 STRING_ENCODING = 'utf-8'
 
 
+class _Member(object):
+  """Takes the place of a member's definition in its class.
+
+  Used for _other_elements and _other_attributes, and for every member when
+  COMPACT_MEMBERS is set or objects are parsed with LAZY_CHILDREN. Read from
+  the class, it gives the definition, so the parsing rules are unchanged.
+  Read from an instance which has no value for the member, it converts the
+  member's child elements if they haven't been yet (see LAZY_CHILDREN), or
+  else gives None, or a new empty container which is then kept in the
+  instance.
+  """
+
+  def __init__(self, name, definition, factory=None, lazy=False):
+    self.name = name
+    self.definition = definition
+    self.factory = factory
+    # Whether the member holds child elements, which may not have been
+    # converted yet.
+    self.lazy = lazy
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self.definition
+    if self.lazy and '_lazy' in instance.__dict__:
+      return _convert_member(instance, self.name, self.factory)
+    if self.factory is None:
+      return None
+    value = instance.__dict__[self.name] = self.factory()
+    return value
+
+
+def _is_member(name, member_type):
+  """Tells whether the class attribute name defines an XML member."""
+  if name.startswith('_') or name == 'text':
+    return False
+  return (isinstance(member_type, tuple) or isinstance(member_type, list)
+          or isinstance(member_type, (str, unicode))
+          or (isinstance(member_type, type)
+              and issubclass(member_type, XmlElement)))
+
+
+# The _own_members of classes which aren't XmlElements, such as mixins.
+_other_class_members = {}
+
+
+def _own_members(klass):
+  """Lists (name, definition) for the XML members defined in klass itself,
+  and (name, None) for its other public attributes."""
+  if '_own_members' in klass.__dict__:
+    return klass.__dict__['_own_members']
+  if klass in _other_class_members:
+    return _other_class_members[klass]
+  members = []
+  for name, member_type in klass.__dict__.iteritems():
+    if name.startswith('_'):
+      continue
+    if isinstance(member_type, _Member):
+      member_type = member_type.definition
+    if _is_member(name, member_type):
+      members.append((name, member_type))
+    else:
+      members.append((name, None))
+  if isinstance(klass, _XmlElementClass):
+    klass._own_members = members
+  else:
+    _other_class_members[klass] = members
+  return members
+
+
+class _XmlElementClass(type):
+  """The metaclass of XmlElement.
+
+  Lists the XML members of each class and gives the class its own caches
+  when the class is defined, rather than checking for them whenever an
+  instance is made or parsed.
+  """
+
+  def __init__(cls, name, bases, namespace):
+    type.__init__(cls, name, bases, namespace)
+    cls._members = tuple(cls._list_xml_members())
+    cls._generated = {}
+    cls._element_members = {}
+
+
 class XmlElement(object):
   """Represents an element node in an XML document.
 
   The text member is a UTF-8 encoded str or unicode.
   """
+  __metaclass__ = _XmlElementClass
   _qname = None
-  _other_elements = None
-  _other_attributes = None
+  # Made when first used by instances which don't have them yet.
+  _other_elements = _Member('_other_elements', None, list, True)
+  _other_attributes = _Member('_other_attributes', None, dict)
   # The rule set contains mappings for XML qnames to child members and the
   # appropriate member classes.
   _rule_set = None
+  # (member_name, definition) for each XML member, set by _XmlElementClass.
   _members = None
+  # Parse and serialize functions generated for this class, by version. See
+  # _generated_function. Like _element_members, each class is given its own
+  # dict by _XmlElementClass.
+  _generated = None
+  # The child element members, by version. See _element_members.
+  _element_members = None
   text = None
 
   def __init__(self, text=None, *args, **kwargs):
-    if ('_members' not in self.__class__.__dict__
-        or self.__class__._members is None):
-      self.__class__._members = tuple(self.__class__._list_xml_members())
-    for member_name, member_type in self.__class__._members:
-      if member_name in kwargs:
-        setattr(self, member_name, kwargs[member_name])
-      else:
-        if isinstance(member_type, list):
-          setattr(self, member_name, [])
+    if COMPACT_MEMBERS:
+      # Only the members given are stored. The others are looked up through
+      # the class's _Member descriptors.
+      if '_compact' not in self.__class__.__dict__:
+        _use_member_descriptors(self.__class__)
+      for member_name, member_type in self.__class__._members:
+        if member_name in kwargs:
+          setattr(self, member_name, kwargs[member_name])
+    else:
+      for member_name, member_type in self.__class__._members:
+        if member_name in kwargs:
+          setattr(self, member_name, kwargs[member_name])
         else:
-          setattr(self, member_name, None)
-    self._other_elements = []
-    self._other_attributes = {}
+          if isinstance(member_type, list):
+            setattr(self, member_name, [])
+          else:
+            setattr(self, member_name, None)
+      self._other_elements = []
+      self._other_attributes = {}
     if text is not None:
       self.text = text
 
+  def __getstate__(self):
+    # The elements a lazily parsed object holds on to can't be pickled, so
+    # convert the rest of its members first.
+    if '_lazy' in self.__dict__:
+      _convert_members(self)
+    return self.__dict__
+
+  def __setstate__(self, state):
+    # The state may have come from a compact object, which leaves out the
+    # members it doesn't have.
+    if '_compact' not in self.__class__.__dict__:
+      _use_member_descriptors(self.__class__)
+    self.__dict__.update(state)
+
   def _list_xml_members(cls):
     """Generator listing all members which are XML elements or attributes.
 
@@ -88,16 +201,18 @@ class XmlElement(object):
         look for a namespaced attribute with the local name of 'att2' and an
         XML namespace of 'http://example.com/namespace'.
     """
-    members = []
-    for pair in inspect.getmembers(cls):
-      if not pair[0].startswith('_') and pair[0] != 'text':
-        member_type = pair[1]
-        if (isinstance(member_type, tuple) or isinstance(member_type, list)
-            or isinstance(member_type, (str, unicode))
-            or (inspect.isclass(member_type)
-                and issubclass(member_type, XmlElement))):
-          members.append(pair)
-    return members
+    # Gives the same result as looking at everything inspect.getmembers
+    # finds, much faster: going through the classes in reverse method
+    # resolution order, each class's own definitions replace any inherited
+    # ones, and its other public attributes hide them.
+    members = {}
+    for klass in reversed(cls.__mro__):
+      for name, member_type in _own_members(klass):
+        if member_type is None:
+          members.pop(name, None)
+        else:
+          members[name] = member_type
+    return sorted(members.iteritems())
 
   _list_xml_members = classmethod(_list_xml_members)
 
@@ -160,8 +275,6 @@ class XmlElement(object):
       # when given an XML attribute's qname.
       elements = {}
       attributes = {}
-      if ('_members' not in cls.__dict__ or cls._members is None):
-        cls._members = tuple(cls._list_xml_members())
       for member_name, target in cls._members:
         if isinstance(target, list):
           # This member points to a repeating element.
@@ -208,18 +321,27 @@ class XmlElement(object):
     ignored1, elements, ignored2 = self.__class__._get_rules(version)
     if elements:
       for qname, element_def in elements.iteritems():
-        member = getattr(self, element_def[0])
-        if member:
-          if _qname_matches(tag, namespace, qname):
+        # Check the qname first, so that lazily parsed members which can't
+        # match aren't converted.
+        if _qname_matches(tag, namespace, qname):
+          member = getattr(self, element_def[0])
+          if member:
             if element_def[2]:
               # If this is a repeating element, copy all instances into the
               # result list.
               matches.extend(member)
             else:
               matches.append(member)
-    for element in self._other_elements:
-      if _qname_matches(tag, namespace, element._qname):
-        matches.append(element)
+    if tag is not None and namespace:
+      # Only the other elements with exactly this qname can match.
+      qname = '{%s}%s' % (namespace, tag)
+      for element in self._other_elements:
+        if element._qname == qname:
+          matches.append(element)
+    else:
+      for element in self._other_elements:
+        if _qname_matches(tag, namespace, element._qname):
+          matches.append(element)
     return matches
 
   GetElements = get_elements
@@ -271,30 +393,44 @@ class XmlElement(object):
 
   def _harvest_tree(self, tree, version=1):
     """Populates object members from the data in the tree Element."""
-    qname, elements, attributes = self.__class__._get_rules(version)
+    elements = self.__class__._get_rules(version)[1]
     for element in tree:
-      if elements and element.tag in elements:
-        definition = elements[element.tag]
-        # If this is a repeating element, make sure the member is set to a
-        # list.
-        if definition[2]:
-          if getattr(self, definition[0]) is None:
-            setattr(self, definition[0], [])
-          getattr(self, definition[0]).append(_xml_element_from_tree(element,
-              definition[1], version))
-        else:
-          setattr(self, definition[0], _xml_element_from_tree(element,
-              definition[1], version))
+      self._harvest_element(element, version, elements)
+    self._harvest_attributes(tree, version)
+    if tree.text:
+      self.text = tree.text
+
+  def _harvest_element(self, element, version=1, elements=None):
+    """Converts one child Element and stores it in the matching member.
+
+    elements is the element rules from _get_rules, if already looked up.
+    """
+    if elements is None:
+      elements = self.__class__._get_rules(version)[1]
+    if elements and element.tag in elements:
+      definition = elements[element.tag]
+      # If this is a repeating element, make sure the member is set to a
+      # list.
+      if definition[2]:
+        if getattr(self, definition[0]) is None:
+          setattr(self, definition[0], [])
+        getattr(self, definition[0]).append(_xml_element_from_tree(element,
+            definition[1], version))
       else:
-        self._other_elements.append(_xml_element_from_tree(element, XmlElement,
-                                                           version))
+        setattr(self, definition[0], _xml_element_from_tree(element,
+            definition[1], version))
+    else:
+      self._other_elements.append(_xml_element_from_tree(element, XmlElement,
+                                                         version))
+
+  def _harvest_attributes(self, tree, version=1):
+    """Stores the attributes of the tree Element in the matching members."""
+    qname, elements, attributes = self.__class__._get_rules(version)
     for attrib, value in tree.attrib.iteritems():
       if attributes and attrib in attributes:
         setattr(self, attributes[attrib], value)
       else:
         self._other_attributes[attrib] = value
-    if tree.text:
-      self.text = tree.text
 
   def _to_tree(self, version=1, encoding=None):
     new_tree = ElementTree.Element(_get_qname(self, version))
@@ -314,6 +450,12 @@ class XmlElement(object):
       version: int Ingnored in this method but used by VersionedElement.
       encoding: str (optional)
     """
+    if GENERATE_CODE:
+      attach_members = _generated_function(self.__class__, version, 'attach')
+      if attach_members is not None:
+        return attach_members(self, tree, version, encoding)
+    if '_lazy' in self.__dict__:
+      _convert_members(self)
     qname, elements, attributes = self.__class__._get_rules(version)
     encoding = encoding or STRING_ENCODING
     # Add the expected elements and attributes to the tree.
@@ -441,6 +583,34 @@ class XmlElement(object):
   attributes = extension_attributes
 
 
+# When True, XmlElements only store the members which have a value, and the
+# lists and dicts for other elements and attributes are made when first
+# used, rather than every instance holding every member. Instances behave
+# the same either way, but a parsed feed takes much less memory. Set before
+# creating any objects.
+COMPACT_MEMBERS = False
+
+
+def _use_member_descriptors(cls):
+  """Replaces the member definitions of cls and its bases with _Member
+  descriptors, so that instances need not store members they don't have.
+
+  A real __slots__ layout isn't possible: the definitions are class
+  attributes with the same names as the members.
+  """
+  for klass in cls.__mro__:
+    if not issubclass(klass, XmlElement) or '_compact' in klass.__dict__:
+      continue
+    for name, definition in klass.__dict__.items():
+      if _is_member(name, definition):
+        if isinstance(definition, list):
+          setattr(klass, name, _Member(name, definition, list, True))
+        else:
+          setattr(klass, name, _Member(name, definition, None,
+                                       isinstance(definition, type)))
+    klass._compact = True
+
+
 def _get_qname(element, version):
   if isinstance(element._qname, tuple):
     if version <= len(element._qname):
@@ -451,6 +621,10 @@ def _get_qname(element, version):
     return element._qname
 
 
+# (namespace, tag) for each qname _qname_matches has split.
+_qname_parts = {}
+
+
 def _qname_matches(tag, namespace, qname):
   """Logic determines if a QName matches the desired local tag and namespace.
 
@@ -472,6 +646,8 @@ def _qname_matches(tag, namespace, qname):
   if qname is None:
     member_tag = None
     member_namespace = None
+  elif qname in _qname_parts:
+    member_namespace, member_tag = _qname_parts[qname]
   else:
     if qname.startswith('{'):
       member_namespace = qname[1:qname.index('}')]
@@ -479,6 +655,7 @@ def _qname_matches(tag, namespace, qname):
     else:
       member_namespace = None
       member_tag = qname
+    _qname_parts[qname] = (member_namespace, member_tag)
   return ((tag is None and namespace is None)
       # If there is a tag, but no namespace, see if the local tag matches.
       or (namespace is None and member_tag == tag)
@@ -502,7 +679,8 @@ def parse(xml_string, target_class=None, version=1, encoding=None):
   """Parses the XML string according to the rules for the target_class.
 
   Args:
-    xml_string: str or unicode
+    xml_string: str, unicode or a file-like object with a read method, such
+        as an HTTP response. A file-like object is parsed as it is read.
     target_class: XmlElement or a subclass. If None is specified, the
         XmlElement class is used.
     version: int (optional) The version of the schema which should be used when
@@ -517,7 +695,10 @@ def parse(xml_string, target_class=None, version=1, encoding=None):
       xml_string = xml_string.encode(STRING_ENCODING)
     else:
       xml_string = xml_string.encode(encoding)
-  tree = ElementTree.fromstring(xml_string)
+  if hasattr(xml_string, 'read'):
+    tree = ElementTree.parse(xml_string).getroot()
+  else:
+    tree = ElementTree.fromstring(xml_string)
   return _xml_element_from_tree(tree, target_class, version)
 
 
@@ -526,7 +707,111 @@ xml_element_from_string = parse
 XmlElementFromString = xml_element_from_string
 
 
+class ElementStream(object):
+  """Parses a document a child element at a time, as it is read.
+
+  Iterating over an ElementStream yields the converted children of the root
+  element which are stored in one repeating member (by default entry, so for
+  a feed these are its entries), as soon as each one has been read. Each
+  child is discarded once it is converted, so only one is held in memory at
+  a time rather than the whole document.
+
+  All the other children and attributes of the root element are stored in
+  the root object, which is available as the root attribute. Those which
+  come after the first streamed child are only there once iteration is
+  done. The streamed member itself is left empty. If the root element does
+  not match target_class, root is None and nothing is yielded, much as parse
+  returns None. A stream can only be iterated over once.
+
+    stream = ElementStream(http_response, gdata.docs.data.DocList, 2)
+    for entry in stream:
+      print entry.title.text
+    next_link = stream.root.get_next_link()
+  """
+
+  def __init__(self, source, target_class=None, version=1, member='entry'):
+    """
+    Args:
+      source: A file-like object with a read method, such as an HTTP
+          response, or a str or unicode holding the whole document.
+      target_class: XmlElement or a subclass for the root element. If None
+          is specified, the XmlElement class is used and every child is
+          streamed as an XmlElement.
+      version: int (optional) The version of the schema which should be used
+          when converting the XML into objects. The default is 1.
+      member: str (optional) The name of the repeating member of
+          target_class whose elements are streamed. Default is 'entry'.
+    """
+    if target_class is None:
+      target_class = XmlElement
+    if isinstance(source, unicode):
+      source = source.encode(STRING_ENCODING)
+    if not hasattr(source, 'read'):
+      source = StringIO.StringIO(source)
+    self.root = None
+    self._source = source
+    self._target_class = target_class
+    self._version = version
+    self._member = member
+
+  def __iter__(self):
+    version = self._version
+    streamed_tag = None
+    streamed_class = XmlElement
+    qname, elements, attributes = self._target_class._get_rules(version)
+    for tag, definition in (elements or {}).iteritems():
+      if definition[0] == self._member:
+        streamed_tag, streamed_class = tag, definition[1]
+    depth = 0
+    root_element = None
+    for event, element in ElementTree.iterparse(self._source,
+                                                events=('start', 'end')):
+      if event == 'start':
+        depth += 1
+        if root_element is None:
+          root_element = element
+          self.root = _root_instance(element, self._target_class, version)
+          if self.root is None:
+            return
+          self.root._harvest_attributes(element, version)
+        continue
+      depth -= 1
+      if depth == 1:
+        # A child of the root is complete.
+        if element.tag == streamed_tag or self._target_class._qname is None:
+          yield _xml_element_from_tree(element, streamed_class, version)
+        else:
+          self.root._harvest_element(element, version)
+        if not LAZY_CHILDREN:
+          # Lazily parsed objects still need the element's children.
+          element.clear()
+        root_element.remove(element)
+      elif depth == 0 and element.text:
+        self.root.text = element.text
+
+
+def _root_instance(tree, target_class, version=1):
+  """Creates the object for tree the way _xml_element_from_tree does, without
+  harvesting its children."""
+  if target_class._qname is None:
+    instance = target_class()
+    instance._qname = tree.tag
+    return instance
+  elif tree.tag == _get_qname(target_class, version):
+    return target_class()
+  return None
+
+
 def _xml_element_from_tree(tree, target_class, version=1):
+  if GENERATE_CODE:
+    parse_tree = _generated_function(target_class, version, 'parse')
+    if parse_tree is not None:
+      if (target_class._qname is None
+          or tree.tag == _get_qname(target_class, version)):
+        return parse_tree(tree)
+      return None
+  if LAZY_CHILDREN and _element_members(target_class, version) is not None:
+    return _lazy_element_from_tree(tree, target_class, version)
   if target_class._qname is None:
     instance = target_class()
     instance._qname = tree.tag
@@ -542,6 +827,446 @@ def _xml_element_from_tree(tree, target_class, version=1):
   return None
 
 
+# When True, parsing only converts the root element and its attributes and
+# text. The child elements are kept and each member is converted the first
+# time it is read, so callers which only look at a few members of each entry
+# skip converting the rest. The objects behave the same, but hold on to the
+# parsed ElementTree elements until all their members have been converted.
+LAZY_CHILDREN = False
+
+
+def _element_members(cls, version):
+  """Returns {member_name: (qname, member_class, repeating)} for the members
+  of cls which hold child elements, or None if cls can't be parsed lazily
+  because it overrides __init__ or _harvest_tree."""
+  members = cls._element_members
+  if version > 2:
+    version = 2
+  if version not in members:
+    init = cls.__init__.im_func
+    if ((init is XmlElement.__init__.im_func
+         or getattr(init, 'plain_init', False))
+        and cls._harvest_tree.im_func is XmlElement._harvest_tree.im_func):
+      _use_member_descriptors(cls)
+      qname, elements, attributes = cls._get_rules(version)
+      members[version] = dict(
+          (member_name, (tag, member_class, repeating))
+          for tag, (member_name, member_class, repeating)
+          in (elements or {}).iteritems())
+    else:
+      members[version] = None
+  return members[version]
+
+
+def _lazy_element_from_tree(tree, target_class, version):
+  """Like _xml_element_from_tree, but leaves the children of tree to be
+  converted when their members are read."""
+  if target_class._qname is not None and tree.tag != _get_qname(target_class,
+                                                                version):
+    return None
+  instance = object.__new__(target_class)
+  values = instance.__dict__
+  if target_class._qname is None:
+    values['_qname'] = tree.tag
+  if len(tree):
+    # The element, the version, and its children by qname once sorted.
+    values['_lazy'] = [tree, version, None]
+  attributes = target_class._get_rules(version)[2]
+  for key, value in tree.items():
+    if attributes and key in attributes:
+      values[attributes[key]] = value
+    else:
+      instance._other_attributes[key] = value
+  if tree.text:
+    values['text'] = tree.text
+  return instance
+
+
+def _convert_member(instance, member_name, factory=None):
+  """Converts the child elements for one member of a lazily parsed
+  instance, or for _other_elements, and returns the member's value.
+
+  A member without a rule for the instance's version (because another
+  member has the same qname) is left empty, made by factory if given.
+  """
+  values = instance.__dict__
+  lazy = values.get('_lazy')
+  if lazy is None:
+    # Another thread has converted every member since.
+    return getattr(instance, member_name)
+  tree, version, children = lazy
+  if children is None:
+    # Sort the children by qname the first time a member is converted. Other
+    # threads may be reading members too, so only share the dict once it is
+    # complete; until then they sort the children for themselves.
+    children = {}
+    for child in tree:
+      if child.tag in children:
+        children[child.tag].append(child)
+      else:
+        children[child.tag] = [child]
+    lazy[2] = children
+  members = _element_members(instance.__class__, version)
+  if member_name == '_other_elements':
+    tags = set(tag for tag, member_class, repeating in members.itervalues())
+    value = [_xml_element_from_tree(child, XmlElement, version)
+             for child in tree if child.tag not in tags]
+  elif member_name not in members:
+    value = factory and factory()
+  else:
+    tag, member_class, repeating = members[member_name]
+    parse_tree = None
+    if GENERATE_CODE:
+      # The children's qname is already known to match member_class.
+      parse_tree = _generated_function(member_class, version, 'parse')
+    if parse_tree is not None:
+      value = [parse_tree(child) for child in children.get(tag, ())]
+    else:
+      value = [_xml_element_from_tree(child, member_class, version)
+               for child in children.get(tag, ())]
+    if not repeating:
+      # As when parsing, the last of several elements wins.
+      if value:
+        value = value[-1]
+      else:
+        value = None
+  # If another thread converted the member meanwhile, keep its value so that
+  # both threads see the same objects.
+  return values.setdefault(member_name, value)
+
+
+def _convert_members(instance):
+  """Converts all the unconverted members of a lazily parsed instance, and
+  lets go of its elements."""
+  values = instance.__dict__
+  lazy = values.get('_lazy')
+  if lazy is None:
+    return
+  for member_name in _element_members(instance.__class__, lazy[1]):
+    if member_name not in values:
+      _convert_member(instance, member_name)
+  if '_other_elements' not in values:
+    _convert_member(instance, '_other_elements')
+  values.pop('_lazy', None)
+
+
+def plain_init(init):
+  """Decorator for an __init__ which does nothing more than
+  XmlElement.__init__ when called without arguments.
+
+  Generated parsers set up new instances themselves rather than calling such
+  an __init__, as they do for classes which don't override __init__.
+  """
+  init.plain_init = True
+  return init
+
+
+# When True, XML is converted to and from objects by functions generated for
+# each XmlElement subclass and version. They do the same as _harvest_tree and
+# _attach_members, with the rules looked up once when the function is made
+# rather than for every element. Off by default; an application parsing many
+# large feeds can turn it on. tests/atom_tests/core_benchmark.py compares
+# the two.
+GENERATE_CODE = False
+
+
+def _generated_function(cls, version, kind):
+  """Returns the generated 'parse' or 'attach' function for cls.
+
+  The function is generated the first time it is asked for and kept in the
+  class's _generated dict. Returns None if cls overrides the generic method,
+  which must then be used instead.
+  """
+  generated = cls._generated
+  if version > 2:
+    version = 2
+  key = (kind, version, COMPACT_MEMBERS, LAZY_CHILDREN)
+  if key not in generated:
+    if kind == 'parse':
+      generated[key] = _generate_parser(cls, version)
+    else:
+      generated[key] = _generate_attach_members(cls, version)
+  return generated[key]
+
+
+def _compile_function(source, name, namespace, cls):
+  code = compile('\n'.join(source) + '\n',
+                 '<generated %s for %s>' % (name, cls.__name__), 'exec')
+  exec code in namespace
+  return namespace[name]
+
+
+def _child_parser(namespace, name, member_class, version):
+  """Returns a placeholder which, when first called, replaces itself in
+  namespace with the parser for member_class. This way classes which
+  contain themselves, directly or not, can be generated."""
+  def parse_child(tree):
+    parser = _generated_function(member_class, version, 'parse')
+    if parser is None:
+      def parser(tree):
+        return _xml_element_from_tree(tree, member_class, version)
+    namespace[name] = parser
+    return parser(tree)
+  return parse_child
+
+
+def _child_attacher(namespace, name, member_class, version):
+  """Like _child_parser, for the function adding members of member_class."""
+  def attach_child(instance, tree, version, encoding):
+    attach = _generated_function(member_class, version, 'attach')
+    if attach is None:
+      def attach(instance, tree, version, encoding):
+        instance._attach_members(tree, version, encoding)
+    namespace[name] = attach
+    attach(instance, tree, version, encoding)
+  return attach_child
+
+
+def _generate_parser(cls, version):
+  """Generates a function which converts an Element into an instance of cls,
+  like _xml_element_from_tree and _harvest_tree do."""
+  if cls._harvest_tree.im_func is not XmlElement._harvest_tree.im_func:
+    return None
+  if LAZY_CHILDREN and _element_members(cls, version) is not None:
+    return _generate_lazy_parser(cls, version)
+  qname, elements, attributes = cls._get_rules(version)
+  namespace = {'cls': cls, 'new': object.__new__}
+  source = ['def parse(tree):']
+  # Repeating members are appended to through local variables when the
+  # instance is set up here rather than by a custom __init__.
+  init = cls.__init__.im_func
+  plain_init = (init is XmlElement.__init__.im_func
+                or getattr(init, 'plain_init', False))
+  lists = {}
+  compact = COMPACT_MEMBERS
+  if compact:
+    _use_member_descriptors(cls)
+  if compact and plain_init:
+    # Members, and the containers for other elements and attributes, are
+    # only stored once there is something to put in them.
+    source.append('  self = new(cls)')
+    for member_name, member_type in cls._members:
+      if isinstance(member_type, list):
+        lists[member_name] = 'list_%d' % len(lists)
+        source.append('  %s = None' % lists[member_name])
+    source.append('  other_elements = other_attributes = None')
+  elif compact:
+    source.append('  self = cls()')
+    source.append('  other_elements = other_attributes = None')
+  elif plain_init:
+    # Start from a copy of the members which are None, rather than setting
+    # them one at a time.
+    namespace['defaults'] = dict((member_name, None)
+        for member_name, member_type in cls._members
+        if not isinstance(member_type, list))
+    source.append('  self = new(cls)')
+    source.append('  self.__dict__ = defaults.copy()')
+    for member_name, member_type in cls._members:
+      if isinstance(member_type, list):
+        lists[member_name] = 'list_%d' % len(lists)
+        source.append('  %s = self.%s = []' % (lists[member_name],
+                                              member_name))
+    source.append('  other_elements = self._other_elements = []')
+    source.append('  other_attributes = self._other_attributes = {}')
+  else:
+    source.append('  self = cls()')
+    source.append('  other_elements = self._other_elements')
+    source.append('  other_attributes = self._other_attributes')
+  if cls._qname is None:
+    source.append('  self._qname = tree.tag')
+
+  namespace['parse_other'] = _child_parser(namespace, 'parse_other',
+                                           XmlElement, version)
+  source.append('  for child in tree:')
+  if elements:
+    # Repeating members come first: they come up most often, and are checked
+    # first when there are few enough members to check one by one.
+    definitions = sorted(elements.iteritems(), key=lambda item: not item[1][2])
+    cases = []
+    for index, (tag, (member_name, member_class, repeating)) in enumerate(
+        definitions):
+      parser_name = 'parse_%d' % index
+      namespace[parser_name] = _child_parser(namespace, parser_name,
+                                             member_class, version)
+      if repeating and member_name in lists and compact:
+        case = ['if %s is None:' % lists[member_name],
+                '  %s = self.%s = []' % (lists[member_name], member_name),
+                '%s.append(%s(child))' % (lists[member_name], parser_name)]
+      elif repeating and member_name in lists:
+        case = ['%s.append(%s(child))' % (lists[member_name], parser_name)]
+      elif repeating:
+        case = ['items = self.%s' % member_name,
+                'if items is None:',
+                '  items = self.%s = []' % member_name,
+                'items.append(%s(child))' % parser_name]
+      else:
+        case = ['self.%s = %s(child)' % (member_name, parser_name)]
+      cases.append((tag, case))
+    if len(cases) <= 4:
+      source.append('    tag = child.tag')
+      keyword = 'if'
+      for tag, case in cases:
+        source.append('    %s tag == %r:' % (keyword, tag))
+        source.extend('      ' + line for line in case)
+        keyword = 'elif'
+      source.append('    else:')
+      _add_other(source, 'other_elements',
+                 'other_elements.append(parse_other(child))', compact,
+                 '      ')
+    else:
+      # Look the tag up once and find its case by bisecting the indexes,
+      # rather than comparing the tag with every qname.
+      namespace['tag_index'] = dict(
+          (tag, index) for index, (tag, case) in enumerate(cases)).get
+      source.append('    index = tag_index(child.tag)')
+      source.append('    if index is None:')
+      _add_other(source, 'other_elements',
+                 'other_elements.append(parse_other(child))', compact,
+                 '      ')
+      source.append('    else:')
+      _bisect_cases(source, [case for tag, case in cases], 0, '      ')
+  else:
+    _add_other(source, 'other_elements',
+               'other_elements.append(parse_other(child))', compact, '    ')
+  _add_attributes_and_text(source, attributes, compact)
+  return _compile_function(source, 'parse', namespace, cls)
+
+
+def _generate_lazy_parser(cls, version):
+  """Generates a function which converts an Element into an instance of cls
+  like _lazy_element_from_tree does."""
+  qname, elements, attributes = cls._get_rules(version)
+  namespace = {'cls': cls, 'new': object.__new__, 'version': version}
+  source = ['def parse(tree):',
+            '  self = new(cls)']
+  if cls._qname is None:
+    source.append('  self._qname = tree.tag')
+  source.extend(['  if len(tree):',
+                 '    self._lazy = [tree, version, None]',
+                 '  other_attributes = None'])
+  _add_attributes_and_text(source, attributes, True)
+  return _compile_function(source, 'parse', namespace, cls)
+
+
+def _add_attributes_and_text(source, attributes, compact):
+  """Adds the end of a parser, which stores the attributes and text of
+  tree and returns self."""
+  source.append('  for key, value in tree.items():')
+  keyword = 'if'
+  for attribute, member_name in (attributes or {}).iteritems():
+    source.append('    %s key == %r:' % (keyword, attribute))
+    source.append('      self.%s = value' % member_name)
+    keyword = 'elif'
+  if keyword == 'elif':
+    source.append('    else:')
+    _add_other(source, 'other_attributes',
+               'other_attributes[key] = value', compact, '      ')
+  else:
+    _add_other(source, 'other_attributes',
+               'other_attributes[key] = value', compact, '    ')
+  source.append('  text = tree.text')
+  source.append('  if text:')
+  source.append('    self.text = text')
+  source.append('  return self')
+
+
+def _add_other(source, container, statement, compact, indent):
+  """Adds statement, which stores a child or attribute in the container
+  for other elements or attributes."""
+  if compact:
+    # Ask the instance for the container the first time, as a custom
+    # __init__ may already have made one.
+    source.append('%sif %s is None:' % (indent, container))
+    source.append('%s  %s = self._%s' % (indent, container, container))
+  source.append(indent + statement)
+
+
+def _bisect_cases(source, cases, first, indent):
+  """Adds code running cases[i - first] for the value i of index."""
+  if len(cases) == 1:
+    source.extend(indent + line for line in cases[0])
+    return
+  middle = len(cases) // 2
+  source.append('%sif index < %d:' % (indent, first + middle))
+  _bisect_cases(source, cases[:middle], first, indent + '  ')
+  source.append('%selse:' % indent)
+  _bisect_cases(source, cases[middle:], first + middle, indent + '  ')
+
+
+def _generate_attach_members(cls, version):
+  """Generates a function which adds the members of an instance of cls to an
+  Element, like XmlElement._attach_members does."""
+  if cls._attach_members.im_func is not XmlElement._attach_members.im_func:
+    return None
+  qname, elements, attributes = cls._get_rules(version)
+  namespace = {'STRING_ENCODING': STRING_ENCODING,
+               'sub_element': ElementTree.SubElement}
+  namespace['convert_members'] = _convert_members
+  source = ['def attach_members(self, tree, version, encoding):',
+            "  if '_lazy' in self.__dict__:",
+            '    convert_members(self)',
+            '  encoding = encoding or STRING_ENCODING']
+  if COMPACT_MEMBERS:
+    # Read the members the instance has, without making empty containers
+    # for those it doesn't.
+    source.append('  members = self.__dict__')
+    member_value = 'members.get(%r)'
+  else:
+    member_value = 'self.%s'
+  # Members are added in the same order as _attach_members adds them.
+  for index, (tag, (member_name, member_class, repeating)) in enumerate(
+      (elements or {}).iteritems()):
+    source.append('  member = %s' % (member_value % member_name))
+    source.append('  if member:')
+    indent = '    '
+    if repeating:
+      source.append('    for member in member:')
+      indent = '      '
+    if (member_class._become_child.im_func
+        is not XmlElement._become_child.im_func):
+      source.append('%smember._become_child(tree, version)' % indent)
+      continue
+    # Members of exactly the declared class, with its qname, are added
+    # straight away instead of through _become_child and _attach_members.
+    class_name, attach_name = 'class_%d' % index, 'attach_%d' % index
+    namespace[class_name] = member_class
+    namespace[attach_name] = _child_attacher(namespace, attach_name,
+                                             member_class, version)
+    source.extend([
+        "%sif member.__class__ is %s and '_qname' not in member.__dict__:" % (
+            indent, class_name),
+        '%s  %s(member, sub_element(tree, %r), version, None)' % (
+            indent, attach_name, tag),
+        '%selse:' % indent,
+        '%s  member._become_child(tree, version)' % indent])
+  for attribute, member_name in (attributes or {}).iteritems():
+    source.append('  value = %s' % (member_value % member_name))
+    source.append('  if value:')
+    source.append('    tree.set(%r, value)' % attribute)
+  if COMPACT_MEMBERS:
+    source.extend([
+        "  other_elements = members.get('_other_elements') or ()",
+        "  other_attributes = members.get('_other_attributes') or {}"])
+  else:
+    source.extend([
+        '  other_elements = self._other_elements',
+        '  other_attributes = self._other_attributes'])
+  source.extend([
+      '  for element in other_elements:',
+      '    element._become_child(tree, version)',
+      '  for key, value in other_attributes.iteritems():',
+      '    if not isinstance(value, unicode):',
+      '      value = value.decode(encoding)',
+      '    tree.set(key, value)',
+      '  text = self.text',
+      '  if text:',
+      '    if isinstance(text, unicode):',
+      '      tree.text = text',
+      '    else:',
+      '      tree.text = text.decode(encoding)'])
+  return _compile_function(source, 'attach_members', namespace, cls)
+
+
 class XmlAttribute(object):
 
   def __init__(self, qname, value):
@@ -291,6 +291,7 @@ class FeedEntryParent(atom.core.XmlElement, LinkFinder):
   title = Title
   updated = Updated
 
+  @atom.core.plain_init
   def __init__(self, atom_id=None, text=None, *args, **kwargs):
     if atom_id is not None:
       self.id = atom_id
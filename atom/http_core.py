@@ -23,10 +23,15 @@ __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
 import os
+import select
+import socket
 import StringIO
+import threading
+import time
 import urlparse
 import urllib
 import httplib
+import zlib
 ssl = None
 try:
   import ssl
@@ -48,6 +53,8 @@ class ProxyError(Error):
 
 
 MIME_BOUNDARY = 'END_OF_PART'
+# Requests which can be sent again without changing what the first one did.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
 
 
 def get_headers(http_response):
@@ -411,9 +418,243 @@ def _dump_response(http_response):
   return output
 
 
+class ConnectionPool(object):
+  """Keeps idle keep-alive connections so later requests can reuse them.
+
+  Connections are kept per key, which is usually (scheme, host, port), and
+  are checked out by one request at a time, so a pool can be shared between
+  clients in different threads. A connection which has been idle for longer
+  than idle_timeout seconds, or which the server has closed, is dropped
+  instead of being reused. When more than max_size connections are idle, the
+  one idle the longest is closed.
+  """
+
+  def __init__(self, max_size=10, idle_timeout=60):
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self._idle = []  # (key, connection, time released), oldest first
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+
+  def get(self, key):
+    """Returns an idle connection for key, or None if there isn't one."""
+    self._lock.acquire()
+    try:
+      self._forget_if_forked()
+      now = time.time()
+      for i in xrange(len(self._idle) - 1, -1, -1):
+        idle_key, connection, released = self._idle[i]
+        if idle_key != key:
+          continue
+        del self._idle[i]
+        if now - released <= self.idle_timeout and _is_open(connection):
+          return connection
+        connection.close()
+      return None
+    finally:
+      self._lock.release()
+
+  def put(self, key, connection):
+    """Returns a connection whose last response was read to the pool."""
+    self._lock.acquire()
+    try:
+      self._forget_if_forked()
+      self._idle.append((key, connection, time.time()))
+      while len(self._idle) > self.max_size:
+        self._idle.pop(0)[1].close()
+    finally:
+      self._lock.release()
+
+  def clear(self, key=None):
+    """Closes the idle connections for key, or all of them."""
+    self._lock.acquire()
+    try:
+      keep = []
+      for idle in self._idle:
+        if key is None or idle[0] == key:
+          idle[1].close()
+        else:
+          keep.append(idle)
+      self._idle = keep
+    finally:
+      self._lock.release()
+
+  def _forget_if_forked(self):
+    # A forked child must not talk over its parent's sockets.
+    if self._pid != os.getpid():
+      self._pid = os.getpid()
+      self._idle = []
+
+
+def _is_open(connection):
+  """False if the server has closed an idle connection.
+
+  An idle connection should have nothing to read; if it is readable, the
+  server has closed it (or sent something we can't use).
+  """
+  if connection.sock is None:
+    return False
+  try:
+    return not select.select([connection.sock], [], [], 0)[0]
+  except (select.error, socket.error, ValueError):
+    return False
+
+
+class PooledResponse(object):
+  """Wraps an httplib response to give its connection back to the pool.
+
+  Once the body has been read to the end, the connection is free for another
+  request and is put back in the pool, unless the server said it would close
+  it. Everything else is passed through to the httplib response.
+  """
+
+  def __init__(self, response, connection, pool, key):
+    self._response = response
+    self._connection = connection
+    self._pool = pool
+    self._key = key
+    # Responses without a body are finished as soon as they arrive.
+    if response.length == 0:
+      response.read()
+      self._release()
+
+  def read(self, amt=None):
+    if amt is None:
+      data = self._response.read()
+    else:
+      data = self._response.read(amt)
+    if self._response.isclosed():
+      self._release()
+    return data
+
+  def close(self):
+    # If the body wasn't read to the end the connection can't be reused.
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+    self._response.close()
+
+  def _release(self):
+    connection = self._connection
+    if connection is None:
+      return
+    self._connection = None
+    if not self._response.will_close and connection.sock is not None:
+      self._pool.put(self._key, connection)
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+
+class Decompressor(object):
+  """Decompresses a body sent with Content-Encoding gzip or deflate.
+
+  Some servers send deflate bodies without the zlib header, so if the body
+  doesn't start with one it is read as a raw deflate stream.
+  """
+
+  def __init__(self, encoding):
+    self._encoding = encoding
+    if encoding == 'gzip':
+      self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+      self._decompressor = zlib.decompressobj()
+    self._started = False
+
+  def decompress(self, data):
+    if self._started or self._encoding == 'gzip' or not data:
+      return self._decompressor.decompress(data)
+    self._started = True
+    try:
+      return self._decompressor.decompress(data)
+    except zlib.error:
+      self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+      return self._decompressor.decompress(data)
+
+  def flush(self):
+    return self._decompressor.flush()
+
+
+def decode_response(response):
+  """Wraps the response to decompress its body if it is compressed."""
+  encoding = (response.getheader('Content-Encoding')
+              or response.getheader('content-encoding') or '').lower()
+  if encoding in ('gzip', 'x-gzip', 'deflate'):
+    return DecodedResponse(response, encoding.replace('x-', ''))
+  return response
+
+
+class DecodedResponse(object):
+  """Decompresses a response body a piece at a time as it is read.
+
+  The Content-Encoding and Content-Length headers describe the compressed
+  body, so they are left out of the headers. Everything else is passed
+  through to the wrapped response.
+  """
+  read_size = 16384
+
+  def __init__(self, response, encoding):
+    self._response = response
+    self._decompressor = Decompressor(encoding)
+    self._buffer = ''
+    self._eof = False
+    length = (response.getheader('Content-Length')
+              or response.getheader('content-length'))
+    self._expected = length is not None and int(length) or None
+    self._received = 0
+
+  def read(self, amt=None):
+    while not self._eof and (amt is None or len(self._buffer) < amt):
+      if amt is None:
+        data = self._response.read()
+      else:
+        data = self._response.read(self.read_size)
+      if data:
+        self._received += len(data)
+        self._buffer += self._decompressor.decompress(data)
+      if not data or amt is None:
+        self._eof = True
+        self._buffer += self._decompressor.flush()
+        if self._expected is not None and self._received < self._expected:
+          raise httplib.IncompleteRead(self._buffer,
+                                       self._expected - self._received)
+    if amt is None:
+      data, self._buffer = self._buffer, ''
+    else:
+      data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+    return data
+
+  def getheader(self, name, default=None):
+    if name.lower() in ('content-encoding', 'content-length'):
+      return default
+    return self._response.getheader(name, default)
+
+  def getheaders(self):
+    headers = self._response.getheaders()
+    if isinstance(headers, dict):
+      headers = headers.items()
+    return [(name, value) for name, value in headers
+            if name.lower() not in ('content-encoding', 'content-length')]
+
+  def __getattr__(self, name):
+    return getattr(self._response, name)
+
+
+# Connections are shared by all HttpClients unless one is given its own pool.
+DEFAULT_CONNECTION_POOL = ConnectionPool()
+
+
 class HttpClient(object):
-  """Performs HTTP requests using httplib."""
+  """Performs HTTP requests using httplib.
+
+  Connections are kept alive and reused through connection_pool. Set it to
+  None to open a new connection for every request.
+  """
   debug = None
+  connection_pool = DEFAULT_CONNECTION_POOL
+  # Compressed responses are decompressed as they are read. Set to None to
+  # ask for uncompressed responses.
+  accept_encoding = 'gzip, deflate'
 
   def request(self, http_request):
     return self._http_request(http_request.method, http_request.uri,
@@ -424,11 +665,30 @@ class HttpClient(object):
   def _get_connection(self, uri, headers=None):
     """Opens a socket connection to the server to set up an HTTP request.
 
+    An idle connection to the same server is reused if the pool has one.
+
     Args:
       uri: The full URL for the request as a Uri object.
       headers: A dict of string pairs containing the HTTP headers for the
           request.
     """
+    return self._pooled_connection((uri.scheme, uri.host, uri.port),
+                                   self._new_connection, uri)
+
+  def _pooled_connection(self, key, connect, *args):
+    """Takes a connection for key from the pool, or calls connect(*args)."""
+    connection = None
+    if self.connection_pool is not None:
+      connection = self.connection_pool.get(key)
+    if connection is None:
+      connection = connect(*args)
+      connection._reused = False
+    else:
+      connection._reused = True
+    connection._pool_key = key
+    return connection
+
+  def _new_connection(self, uri):
     connection = None
     if uri.scheme == 'https':
       if not uri.port:
@@ -457,15 +717,53 @@ class HttpClient(object):
     if isinstance(uri, (str, unicode)):
       uri = Uri.parse_uri(uri)
 
+    positions = _body_positions(body_parts)
     connection = self._get_connection(uri, headers=headers)
-
+    sent = False
+    try:
+      self._send_request(connection, method, uri, headers, body_parts)
+      sent = True
+      response = connection.getresponse()
+    except (socket.error, httplib.HTTPException):
+      connection.close()
+      # A reused connection may have been closed by the server while it was
+      # idle, in which case the others for this server likely were as well.
+      # Try once more on a new connection, if the body can be sent again and
+      # the server can't have acted on the first try, or doing it twice is
+      # harmless.
+      if (not getattr(connection, '_reused', False) or positions is None
+          or (sent and method not in IDEMPOTENT_METHODS)):
+        raise
+      self.connection_pool.clear(connection._pool_key)
+      _rewind_body(body_parts, positions)
+      connection = self._get_connection(uri, headers=headers)
+      self._send_request(connection, method, uri, headers, body_parts)
+      response = connection.getresponse()
+
+    if self.connection_pool is not None and hasattr(connection, '_pool_key'):
+      response = PooledResponse(response, connection, self.connection_pool,
+                                connection._pool_key)
+    return decode_response(response)
+
+  def _send_request(self, connection, method, uri, headers, body_parts):
+    """Writes the whole request to connection."""
     if self.debug:
       connection.debuglevel = 1
 
+    # Byte ranges count bytes of the encoded body, so don't ask for
+    # compression when only part of the body is wanted.
+    accept_encoding = None
+    if 'Accept-Encoding' not in headers and 'Range' not in headers:
+      accept_encoding = self.accept_encoding
+
     if connection.host != uri.host:
-      connection.putrequest(method, str(uri))
+      connection.putrequest(method, str(uri),
+                            skip_accept_encoding=accept_encoding is not None)
     else:
-      connection.putrequest(method, uri._get_relative_path())
+      connection.putrequest(method, uri._get_relative_path(),
+                            skip_accept_encoding=accept_encoding is not None)
+    if accept_encoding is not None:
+      connection.putheader('Accept-Encoding', accept_encoding)
 
     # Overcome a bug in Python 2.4 and 2.5
     # httplib.HTTPConnection.putrequest adding
@@ -493,8 +791,26 @@ class HttpClient(object):
       for part in body_parts:
         _send_data_part(part, connection)
 
-    # Return the HTTP Response from the server.
-    return connection.getresponse()
+
+def _body_positions(body_parts):
+  """Notes where the body's file-like parts start so the body can be sent
+  again. Returns None if a part can't be rewound."""
+  positions = []
+  for part in body_parts or ():
+    if hasattr(part, 'read'):
+      try:
+        positions.append(part.tell())
+      except (AttributeError, IOError):
+        return None
+    else:
+      positions.append(None)
+  return positions
+
+
+def _rewind_body(body_parts, positions):
+  for part, position in zip(body_parts or (), positions):
+    if position is not None:
+      part.seek(position)
 
 
 def _send_data_part(data, connection):
@@ -532,54 +848,63 @@ class ProxiedHttpClient(HttpClient):
     # Get a username and password for the proxy if required.
     proxy_auth = _get_proxy_auth()
     if uri.scheme == 'https':
-      import socket
-      if proxy_auth:
-        proxy_auth = 'Proxy-authorization: %s' % proxy_auth
-      # Construct the proxy connect command.
-      port = uri.port
-      if not port:
-        port = 443
-      proxy_connect = 'CONNECT %s:%s HTTP/1.0\r\n' % (uri.host, port)
-      # Set the user agent to send to the proxy
-      user_agent = ''
-      if headers and 'User-Agent' in headers:
-        user_agent = 'User-Agent: %s\r\n' % (headers['User-Agent'])
-      proxy_pieces = '%s%s%s\r\n' % (proxy_connect, proxy_auth, user_agent)
-      # Find the proxy host and port.
-      proxy_uri = Uri.parse_uri(proxy)
-      if not proxy_uri.port:
-        proxy_uri.port = '80'
-      # Connect to the proxy server, very simple recv and error checking
-      p_sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-      p_sock.connect((proxy_uri.host, int(proxy_uri.port)))
-      p_sock.sendall(proxy_pieces)
-      response = ''
-      # Wait for the full response.
-      while response.find("\r\n\r\n") == -1:
-        response += p_sock.recv(8192)
-      p_status = response.split()[1]
-      if p_status != str(200):
-        raise ProxyError('Error status=%s' % str(p_status))
-      # Trivial setup for ssl socket.
-      sslobj = None
-      if ssl is not None:
-        sslobj = ssl.wrap_socket(p_sock, None, None)
-      else:
-        sock_ssl = socket.ssl(p_sock, None, Nonesock_)
-        sslobj = httplib.FakeSocket(p_sock, sock_ssl)
-      # Initalize httplib and replace with the proxy socket.
-      connection = httplib.HTTPConnection(proxy_uri.host)
-      connection.sock = sslobj
-      return connection
+      # The tunnel goes through this proxy to this server.
+      return self._pooled_connection((uri.scheme, uri.host, uri.port, proxy),
+                                     self._new_tunnel, uri, headers, proxy,
+                                     proxy_auth)
     elif uri.scheme == 'http':
       proxy_uri = Uri.parse_uri(proxy)
       if not proxy_uri.port:
         proxy_uri.port = '80'
       if proxy_auth:
         headers['Proxy-Authorization'] = proxy_auth.strip()
-      return httplib.HTTPConnection(proxy_uri.host, int(proxy_uri.port))
+      # Requests for any server can share a connection to the proxy.
+      return self._pooled_connection(
+          ('http', proxy_uri.host, proxy_uri.port), httplib.HTTPConnection,
+          proxy_uri.host, int(proxy_uri.port))
     return None
 
+  def _new_tunnel(self, uri, headers, proxy, proxy_auth):
+    """Connects to uri's server through an https proxy."""
+    if proxy_auth:
+      proxy_auth = 'Proxy-authorization: %s' % proxy_auth
+    # Construct the proxy connect command.
+    port = uri.port
+    if not port:
+      port = 443
+    proxy_connect = 'CONNECT %s:%s HTTP/1.0\r\n' % (uri.host, port)
+    # Set the user agent to send to the proxy
+    user_agent = ''
+    if headers and 'User-Agent' in headers:
+      user_agent = 'User-Agent: %s\r\n' % (headers['User-Agent'])
+    proxy_pieces = '%s%s%s\r\n' % (proxy_connect, proxy_auth, user_agent)
+    # Find the proxy host and port.
+    proxy_uri = Uri.parse_uri(proxy)
+    if not proxy_uri.port:
+      proxy_uri.port = '80'
+    # Connect to the proxy server, very simple recv and error checking
+    p_sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    p_sock.connect((proxy_uri.host, int(proxy_uri.port)))
+    p_sock.sendall(proxy_pieces)
+    response = ''
+    # Wait for the full response.
+    while response.find("\r\n\r\n") == -1:
+      response += p_sock.recv(8192)
+    p_status = response.split()[1]
+    if p_status != str(200):
+      raise ProxyError('Error status=%s' % str(p_status))
+    # Trivial setup for ssl socket.
+    sslobj = None
+    if ssl is not None:
+      sslobj = ssl.wrap_socket(p_sock, None, None)
+    else:
+      sock_ssl = socket.ssl(p_sock, None, Nonesock_)
+      sslobj = httplib.FakeSocket(p_sock, sock_ssl)
+    # Initalize httplib and replace with the proxy socket.
+    connection = httplib.HTTPConnection(proxy_uri.host)
+    connection.sock = sslobj
+    return connection
+
 
 def _get_proxy_auth():
   import base64
@@ -22,6 +22,7 @@ __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
 import StringIO
+import copy
 import pickle
 import os.path
 import tempfile
@@ -76,7 +77,8 @@ class MockHttpClient(object):
       self.last_request_was_live = False
       for recording in self._recordings:
         if _match_request(recording[0], request):
-          return recording[1]
+          # Replay a copy so that each response has its own read position.
+          return copy.copy(recording[1])
     else:
       # Pass along the debug settings to the real client.
       self.real_client.debug = self.debug
@@ -89,7 +91,7 @@ class MockHttpClient(object):
                         dict(atom.http_core.get_headers(scrubbed_response)),
                         scrubbed_response.read())
       # Return the recording which we just added.
-      return self._recordings[-1][1]
+      return copy.copy(self._recordings[-1][1])
     raise NoRecordingFound('No recoding was found for request: %s %s' % (
         request.method, str(request.uri)))
 
@@ -304,6 +306,7 @@ class SettableHttpClient(object):
 
 
 class MockHttpResponse(atom.http_core.HttpResponse):
+  _position = 0
 
   def __init__(self, status=None, reason=None, headers=None, body=None):
     self._headers = headers or {}
@@ -319,5 +322,11 @@ class MockHttpResponse(atom.http_core.HttpResponse):
       else:
         self._body = body
 
-  def read(self):
-    return self._body
+  def read(self, amt=None):
+    # A read without a size returns the whole body every time so that reads
+    # can be repeated. Sized reads work through the body like a socket.
+    if not amt:
+      return self._body
+    chunk = self._body[self._position:self._position + amt]
+    self._position += len(chunk)
+    return chunk
@@ -31,7 +31,12 @@ in this module is GDClient.
 __author__ = 'j.s@google.com (Jeff Scudder)'
 
 
+import Queue
 import re
+import sys
+import threading
+import time
+import atom.async_http_core
 import atom.client
 import atom.core
 import atom.http_core
@@ -120,6 +125,32 @@ def error_from_response(message, http_response, error_class,
   return error
 
 
+def _parse_response(response, desired_class, version=1):
+  """Parses the response body, reusing the object parsed from it last time.
+
+  Responses from atom.cache_http_core.CachingHttpClient keep the objects
+  parsed from their body in parsed_objects, so a feed which hasn't changed
+  since the last request isn't parsed again. The same object is returned
+  each time, so it should be treated as read only.
+  """
+  parsed_objects = getattr(response, 'parsed_objects', None)
+  if parsed_objects is None:
+    return atom.core.parse(response, desired_class, version=version)
+  key = (desired_class, version)
+  if key not in parsed_objects:
+    parsed_objects[key] = atom.core.parse(response, desired_class,
+                                          version=version)
+  return parsed_objects[key]
+
+
+def _copy_result(source, destination):
+  """Finishes the destination future the same way as the source future."""
+  try:
+    destination.set_result(source.result())
+  except:
+    destination.set_exception(sys.exc_info())
+
+
 def get_xml_version(version):
   """Determines which XML schema to use based on the client API version.
 
@@ -238,6 +269,80 @@ class GDClient(atom.client.AtomPubClient):
       body will be converted to the class using
       atom.core.parse.
     """
+    uri = self._use_gsessionid(uri, http_request)
+
+    # The AtomPubClient should call this class' modify_request before
+    # performing the HTTP request.
+    #http_request = self.modify_request(http_request)
+
+    response = atom.client.AtomPubClient.request(self, method=method,
+        uri=uri, auth_token=auth_token, http_request=http_request, **kwargs)
+
+    def redirect():
+      # Make a recursive call with the gsession ID in the URI to follow
+      # the redirect.
+      return self.request(method=method, uri=uri, auth_token=auth_token,
+                          http_request=http_request, converter=converter,
+                          desired_class=desired_class,
+                          redirects_remaining=redirects_remaining-1,
+                          **kwargs)
+
+    return self._handle_response(response, converter, desired_class,
+                                 redirects_remaining, redirect)
+
+  Request = request
+
+  def request_async(self, method=None, uri=None, auth_token=None,
+                    http_request=None, converter=None, desired_class=None,
+                    redirects_remaining=4, **kwargs):
+    """Starts an HTTP request and returns a Future for its result.
+
+    Takes the same arguments as request() and the future's result() is what
+    request() would have returned, or raises what it would have raised.
+    With an http_client that has a request_async method, such as
+    atom.async_http_core.AsyncHttpClient, many requests can be in flight at
+    once on one thread. Other http clients perform the request right away
+    and return a future which is already done.
+    """
+    uri = self._use_gsessionid(uri, http_request)
+    response_future = atom.client.AtomPubClient.request_async(self,
+        method=method, uri=uri, auth_token=auth_token,
+        http_request=http_request, **kwargs)
+
+    loop = None
+    if hasattr(self.http_client, 'run'):
+      loop = self.http_client
+    future = atom.async_http_core.Future(loop)
+
+    def redirect():
+      return self.request_async(method=method, uri=uri, auth_token=auth_token,
+                                http_request=http_request, converter=converter,
+                                desired_class=desired_class,
+                                redirects_remaining=redirects_remaining-1,
+                                **kwargs)
+
+    def finished(response_future):
+      try:
+        result = self._handle_response(response_future.result(), converter,
+                                       desired_class, redirects_remaining,
+                                       redirect)
+      except:
+        future.set_exception(sys.exc_info())
+        return
+      if isinstance(result, atom.async_http_core.Future):
+        # A redirect was followed; its result is this request's result.
+        result.add_done_callback(lambda redirected: _copy_result(redirected,
+                                                                 future))
+      else:
+        future.set_result(result)
+
+    response_future.add_done_callback(finished)
+    return future
+
+  RequestAsync = request_async
+
+  def _use_gsessionid(self, uri, http_request):
+    """Adopts the gsession ID from the request, or adds the stored one."""
     if isinstance(uri, (str, unicode)):
       uri = atom.http_core.Uri.parse_uri(uri)
 
@@ -256,28 +361,30 @@ class GDClient(atom.client.AtomPubClient):
     # URI then add it to the URI.
     elif self.__gsessionid is not None:
       uri.query['gsessionid'] = self.__gsessionid
+    return uri
 
-    # The AtomPubClient should call this class' modify_request before
-    # performing the HTTP request.
-    #http_request = self.modify_request(http_request)
+  def _handle_response(self, response, converter, desired_class,
+                       redirects_remaining, redirect):
+    """Converts a response as described in request(), or raises an error.
 
-    response = atom.client.AtomPubClient.request(self, method=method,
-        uri=uri, auth_token=auth_token, http_request=http_request, **kwargs)
+    Calls redirect() to follow a 302 and returns what it returns.
+    """
     # On success, convert the response body using the desired converter
     # function if present.
     if response is None:
       return None
-    if response.status == 200 or response.status == 201:
+    if (response.status == 200 or response.status == 201
+        or response.status == 206):
       if converter is not None:
         return converter(response)
       elif desired_class is not None:
         if self.api_version is not None:
-          return atom.core.parse(response.read(), desired_class,
-                                 version=get_xml_version(self.api_version))
+          return _parse_response(response, desired_class,
+                                 get_xml_version(self.api_version))
         else:
           # No API version was specified, so allow parse to
           # use the default version.
-          return atom.core.parse(response.read(), desired_class)
+          return _parse_response(response, desired_class)
       else:
         return response
     # TODO: move the redirect logic into the Google Calendar client once it
@@ -290,13 +397,7 @@ class GDClient(atom.client.AtomPubClient):
           m = re.compile('[\?\&]gsessionid=(\w*)').search(location)
           if m is not None:
             self.__gsessionid = m.group(1)
-          # Make a recursive call with the gsession ID in the URI to follow
-          # the redirect.
-          return self.request(method=method, uri=uri, auth_token=auth_token,
-                              http_request=http_request, converter=converter,
-                              desired_class=desired_class,
-                              redirects_remaining=redirects_remaining-1,
-                              **kwargs)
+          return redirect()
         else:
           raise error_from_response('302 received without Location header',
                                     response, RedirectError)
@@ -319,8 +420,6 @@ class GDClient(atom.client.AtomPubClient):
       raise error_from_response('Server responded with', response,
                                 RequestError)
 
-  Request = request
-
   def request_client_login_token(
       self, email, password, source, service=None,
       account_type='HOSTED_OR_GOOGLE',
@@ -636,6 +735,26 @@ class GDClient(atom.client.AtomPubClient):
 
   GetFeed = get_feed
 
+  def get_feed_stream(self, uri, auth_token=None,
+                      desired_class=gdata.data.GDFeed, **kwargs):
+    """Requests a feed and returns its entries as they are parsed.
+
+    Returns:
+      An atom.core.ElementStream over the response. Iterating over it yields
+      the entries of the feed one at a time as they are read, and once they
+      have all been read its root is the desired_class object holding the
+      rest of the feed.
+    """
+    version = get_xml_version(self.api_version)
+
+    def stream(response):
+      return atom.core.ElementStream(response, desired_class, version)
+
+    return self.request(method='GET', uri=uri, auth_token=auth_token,
+                        converter=stream, **kwargs)
+
+  GetFeedStream = get_feed_stream
+
   def get_entry(self, uri, auth_token=None, converter=None,
                 desired_class=gdata.data.GDEntry, etag=None, **kwargs):
     http_request = atom.http_core.HttpRequest()
@@ -766,7 +885,7 @@ class Query(object):
   def __init__(self, text_query=None, categories=None, author=None, alt=None,
                updated_min=None, updated_max=None, pretty_print=False,
                published_min=None, published_max=None, start_index=None,
-               max_results=None, strict=False):
+               max_results=None, strict=False, fields=None):
     """Constructs a Google Data Query to filter feed contents serverside.
 
     Args:
@@ -812,6 +931,10 @@ class Query(object):
       strict: boolean (optional) If True, the server will return an error if
           the server does not recognize any of the parameters in the request
           URL. Defaults to False.
+      fields: str (optional) Asks for a partial response holding only the
+          listed parts of the feed, in the syntax of the fields parameter.
+          For example, fields='link,entry(@gd:etag,id,title)' returns just
+          the links of the feed and the etag, id and title of each entry.
     """
     self.text_query = text_query
     self.categories = categories or []
@@ -825,6 +948,7 @@ class Query(object):
     self.start_index = start_index
     self.max_results = max_results
     self.strict = strict
+    self.fields = fields
 
   def modify_request(self, http_request):
     _add_query_param('q', self.text_query, http_request)
@@ -844,6 +968,7 @@ class Query(object):
       http_request.uri.query['max-results'] = str(self.max_results)
     if self.strict:
       http_request.uri.query['strict'] = 'true'
+    _add_query_param('fields', self.fields, http_request)
 
 
   ModifyRequest = modify_request
@@ -865,9 +990,15 @@ class ResumableUploader(object):
   """Resumable upload helper for the Google Data protocol."""
 
   DEFAULT_CHUNK_SIZE = 5242880  # 5MB
+  # Chunks other than the last must be a multiple of this size.
+  CHUNK_GRANULARITY = 262144  # 256KB
+  MIN_CHUNK_SIZE = 262144  # 256KB
+  MAX_CHUNK_SIZE = 33554432  # 32MB
+  # When adapting, aim for chunks which take this long to send.
+  TARGET_CHUNK_SECONDS = 2
 
   def __init__(self, client, file_handle, content_type, total_file_size,
-               chunk_size=None, desired_class=None):
+               chunk_size=None, desired_class=None, adapt_chunk_size=True):
     """Starts a resumable upload to a service that supports the protocol.
 
     Args:
@@ -879,6 +1010,9 @@ class ResumableUploader(object):
           DEFAULT_CHUNK_SIZE will be used.
       desired_class: object (optional) The type of gdata.data.GDEntry to parse
           the completed entry as. This should be specific to the API.
+      adapt_chunk_size: bool (optional) Change the chunk size during the
+          upload so that each chunk takes about TARGET_CHUNK_SECONDS to send.
+          chunk_size is then only the size of the first chunk.
     """
     self.client = client
     self.file_handle = file_handle
@@ -886,6 +1020,7 @@ class ResumableUploader(object):
     self.total_file_size = total_file_size
     self.chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
     self.desired_class = desired_class or gdata.data.GDEntry
+    self.adapt_chunk_size = adapt_chunk_size
     self.upload_uri = None
 
     # Send the entire file if the chunk size is less than fize's total size.
@@ -968,10 +1103,10 @@ class ResumableUploader(object):
     if self.upload_uri is None:
       raise RequestError('Resumable upload request not initialized.')
 
-    # Adjustment if last byte range is less than defined chunk size.
-    chunk_size = self.chunk_size
-    if len(content_bytes) <= chunk_size:
-      chunk_size = len(content_bytes)
+    # The byte range is whatever was passed in, which need not be
+    # self.chunk_size: the last chunk is shorter, and the chunk size changes
+    # during an upload when it adapts to the connection.
+    chunk_size = len(content_bytes)
 
     http_request = atom.http_core.HttpRequest()
     http_request.add_body_part(content_bytes, self.content_type,
@@ -1025,15 +1160,7 @@ class ResumableUploader(object):
     self._init_session(resumable_media_link, headers=headers,
                        auth_token=auth_token, entry=entry)
 
-    start_byte = 0
-    entry = None
-
-    while not entry:
-      entry = self.upload_chunk(
-          start_byte, self.file_handle.read(self.chunk_size))
-      start_byte += self.chunk_size
-
-    return entry
+    return self._upload_chunks(0)
 
   UploadFile = upload_file
 
@@ -1068,6 +1195,43 @@ class ResumableUploader(object):
       RequestError if anything other than a HTTP 308 is returned
       when the request raises an exception.
     """
+    self.start_update(entry_or_resumable_edit_link, headers=headers,
+                      force=force, auth_token=auth_token)
+
+    return self._upload_chunks(0)
+
+  UpdateFile = update_file
+
+  def start_update(self, entry_or_resumable_edit_link, headers=None,
+                   force=False, auth_token=None):
+    """Starts a resumable upload session to update an existing file.
+
+    No file content is sent. Use resume_upload() to send it. Save the
+    returned uri to continue the upload later, even from another process.
+
+    Args:
+      entry_or_resumable_edit_link: object or string A gdata.data.GDEntry for
+          the entry/file to update or the full uri of the link with rel
+          #resumable-edit-media.
+      headers: dict Additional headers to send in the initial request to create
+          the resumable upload request. These headers will override any default
+          headers sent in the request. For example: headers={'Slug': 'MyTitle'}.
+      force boolean (optional) True to force an update and set the If-Match
+          header to '*'. If False and entry_or_resumable_edit_link is a
+          gdata.data.GDEntry object, its etag value is used. Otherwise this
+          parameter should be set to True to force the update.
+      auth_token: (optional) An object which sets the Authorization HTTP header
+          in its modify_request method. Recommended classes include
+          gdata.gauth.ClientLoginToken and gdata.gauth.AuthSubToken
+          among others.
+
+    Returns:
+      The unique upload uri of the new session.
+
+    Raises:
+      RequestError if the server refused to start the session, for example
+      with a 412 if the etag did not match.
+    """
     # Need to override the POST request for a resumable update (required).
     customer_headers = {'X-HTTP-Method-Override': 'PUT'}
 
@@ -1084,10 +1248,108 @@ class ResumableUploader(object):
     if force:
       customer_headers['If-Match'] = '*'
 
-    return self.upload_file(resumable_edit_link, headers=customer_headers,
-                            auth_token=auth_token)
+    self._init_session(resumable_edit_link, headers=customer_headers,
+                       auth_token=auth_token)
+    return self.upload_uri
 
-  UpdateFile = update_file
+  StartUpdate = start_update
+
+  def resume_upload(self, upload_uri=None, start_byte=None):
+    """Sends the rest of the file, starting from a given byte.
+
+    This continues an upload whose session was started earlier, either by
+    this object or by one whose upload_uri was saved. The file handle must be
+    seekable, as the file is read from start_byte.
+
+    Args:
+      upload_uri: str (optional) The unique upload uri of the session to
+          continue. Defaults to the session this object started.
+      start_byte: int (optional) The offset to send the file from. If None,
+          the server is asked how much it has already received using
+          query_upload_status().
+
+    Returns:
+      The final Atom entry created on the server, with the type given in
+      self.desired_class, or True if the server already had the whole file
+      and so no entry was returned.
+
+    Raises:
+      RequestError if anything other than a HTTP 308 is returned
+      when the request raises an exception.
+    """
+    if upload_uri is not None:
+      self.upload_uri = upload_uri
+
+    if start_byte is None:
+      start_byte = self.query_upload_status()
+      if start_byte is True:
+        return True
+    self.file_handle.seek(start_byte)
+
+    return self._upload_chunks(start_byte)
+
+  ResumeUpload = resume_upload
+
+  def _upload_chunks(self, start_byte):
+    """Sends the file from its current position, which is start_byte.
+
+    A reader thread reads the next chunk while the current one is being sent,
+    so the disk and the network are busy at the same time. The reader is
+    only asked for a chunk once the previous one has been taken, so no more
+    than two chunks are held in memory.
+    """
+    wanted = Queue.Queue()
+    ready = Queue.Queue()
+
+    def read_ahead():
+      while wanted.get():
+        try:
+          ready.put((self.file_handle.read(self.chunk_size), None))
+        except:
+          ready.put((None, sys.exc_info()))
+          return
+
+    reader = threading.Thread(target=read_ahead)
+    reader.setDaemon(True)
+    reader.start()
+    wanted.put(True)
+    try:
+      entry = None
+
+      while not entry:
+        content_bytes, error = ready.get()
+        if error is not None:
+          raise error[0], error[1], error[2]
+        if not content_bytes:
+          # Sending nothing would get the same answer again, forever.
+          raise Error('The whole file was sent but the server is still '
+                      'waiting for more of it.')
+        wanted.put(True)
+        started = time.time()
+        entry = self.upload_chunk(start_byte, content_bytes)
+        start_byte += len(content_bytes)
+        self._adapt_chunk_size(len(content_bytes), time.time() - started,
+                               self.total_file_size - start_byte)
+
+      return entry
+    finally:
+      wanted.put(False)
+      reader.join()
+
+  def _adapt_chunk_size(self, sent, seconds, remaining):
+    """Moves the chunk size toward what the connection sends in
+    TARGET_CHUNK_SECONDS, given that sent bytes took seconds to send."""
+    # The last chunk is usually short and says little about the connection.
+    if (not self.adapt_chunk_size or seconds <= 0
+        or sent < self.chunk_size or sent < self.MIN_CHUNK_SIZE):
+      return
+    target = sent / seconds * self.TARGET_CHUNK_SECONDS
+    # Keep a few chunks to go so that reading and sending still overlap.
+    target = min(target, remaining / 4)
+    # Go half way there so that one slow chunk doesn't swing it too far.
+    chunk_size = int((self.chunk_size + target) / 2)
+    chunk_size = max(self.MIN_CHUNK_SIZE, min(self.MAX_CHUNK_SIZE, chunk_size))
+    self.chunk_size = chunk_size - chunk_size % self.CHUNK_GRANULARITY
 
   def query_upload_status(self, uri=None):
     """Queries the current status of a resumable upload request.
@@ -1115,16 +1377,21 @@ class ResumableUploader(object):
     try:
       response = self.client.request(
           method='POST', uri=uri, http_request=http_request)
-      if response.status == 201:
+      if response.status == 200 or response.status == 201:
         return True
       else:
         raise error_from_response(
             '%s returned by server' % response.status, response, RequestError)
     except RequestError, error:
       if error.status == 308:
-        for pair in error.headers:
+        headers = error.headers
+        if isinstance(headers, dict):
+          headers = headers.items()
+        for pair in headers:
           if pair[0].capitalize() == 'Range':
             return int(pair[1].split('-')[1]) + 1
+        # No Range header means the server has none of the file yet.
+        return 0
       else:
         raise error
 
@@ -19,7 +19,11 @@
 
 __author__ = 'e.bidelman (Eric Bidelman)'
 
+import errno
 import mimetypes
+import os
+import random
+import re
 import urllib
 import atom.data
 import atom.http_core
@@ -34,6 +38,38 @@ FOLDERS_FEED_TEMPLATE = DOCLIST_FEED_URI + '%s/contents'
 ACL_FEED_TEMPLATE = DOCLIST_FEED_URI + '%s/acl'
 REVISIONS_FEED_TEMPLATE = DOCLIST_FEED_URI + '%s/revisions'
 
+# Matches the Content-Range header of a partial response.
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+
+def partial_path(file_path):
+  """Returns the path a resumable download of file_path is written to."""
+  directory, name = os.path.split(file_path)
+  return os.path.join(directory, '.%s.part' % name)
+
+
+def _open_temp_file(file_path):
+  """Creates a new hidden file in the same directory as file_path.
+
+  The file is in the same directory so that it can be renamed over file_path
+  atomically. It is created with the usual permissions for a new file.
+
+  Returns:
+    A (path, file object) tuple for the new file, opened for writing.
+  """
+  directory, name = os.path.split(file_path)
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+  while True:
+    temp_path = os.path.join(directory, '.%s.%06x.tmp' % (
+        name, random.getrandbits(24)))
+    try:
+      fd = os.open(temp_path, flags, 0666)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    else:
+      return temp_path, os.fdopen(fd, 'wb')
+
 
 class DocsClient(gdata.client.GDClient):
   """Client extension for the Google Documents List API."""
@@ -43,6 +79,7 @@ class DocsClient(gdata.client.GDClient):
   auth_service = 'writely'
   auth_scopes = gdata.gauth.AUTH_SCOPES['writely']
   ssl = True
+  DOWNLOAD_CHUNK_SIZE = 65536  # 64KB
 
   def __init__(self, auth_token=None, **kwargs):
     """Constructs a new client for the DocList API.
@@ -82,9 +119,23 @@ class DocsClient(gdata.client.GDClient):
 
   GetFileContent = get_file_content
 
-  def _download_file(self, uri, file_path, auth_token=None, **kwargs):
+  def _download_file(self, uri, file_path, auth_token=None,
+                     progress_callback=None, chunk_size=None, resume=False,
+                     **kwargs):
     """Downloads a file to disk from the specified URI.
 
+    The response is copied to disk a chunk at a time, so memory use does not
+    grow with the size of the file. The chunks are written to a temporary
+    file next to file_path which is renamed over file_path once the whole
+    body has arrived; an interrupted download never leaves a truncated file
+    at file_path.
+
+    With resume, the temporary file is the one named by partial_path() and
+    is kept if the download fails. The next call with resume asks the server
+    for only the bytes after the ones already in it, using a Range header.
+    The caller must remove the partial file if the remote file has changed
+    since it was started.
+
     Note: to download a file in memory, use the GetFileContent() method.
 
     Args:
@@ -92,23 +143,101 @@ class DocsClient(gdata.client.GDClient):
       file_path: str The full path to save the file to.
       auth_token: (optional) gdata.gauth.ClientLoginToken, AuthSubToken, or
           OAuthToken which authorizes this client to edit the user's data.
-      kwargs: Other parameters to pass to self.get_file_content().
+      progress_callback: (optional) function called after each chunk is
+          written with the number of bytes written so far and the total
+          size of the file, or None if the server did not send a
+          Content-Length.
+      chunk_size: int (optional) The number of bytes to read at a time. If
+          None, DOWNLOAD_CHUNK_SIZE is used.
+      resume: bool (optional) Keep the partial file of a failed download and
+          continue from it on the next call.
+      kwargs: Other parameters to pass to self.request().
 
     Raises:
       gdata.client.RequestError: on error response from server.
+      gdata.client.Error: if the connection closed before the whole file was
+          received.
     """
-    f = open(file_path, 'wb')
+    chunk_size = chunk_size or self.DOWNLOAD_CHUNK_SIZE
+    offset = 0
+    http_request = None
+    if resume:
+      temp_path = partial_path(file_path)
+      if os.path.exists(temp_path):
+        offset = os.path.getsize(temp_path)
+      if offset:
+        http_request = atom.http_core.HttpRequest()
+        http_request.headers['Range'] = 'bytes=%i-' % offset
+
     try:
-      f.write(self.get_file_content(uri, auth_token=auth_token, **kwargs))
+      server_response = self.request('GET', uri, auth_token=auth_token,
+                                     http_request=http_request, **kwargs)
     except gdata.client.RequestError, e:
-      f.close()
-      raise e
-    f.flush()
-    f.close()
+      if not offset or e.status != 416:
+        raise
+      # The partial file is longer than the file on the server, start over.
+      os.remove(temp_path)
+      return self._download_file(uri, file_path, auth_token=auth_token,
+                                 progress_callback=progress_callback,
+                                 chunk_size=chunk_size, resume=resume,
+                                 **kwargs)
+
+    if server_response.status == 206 and offset:
+      content_range = (server_response.getheader('Content-Range')
+                       or server_response.getheader('content-range'))
+      match = CONTENT_RANGE_PATTERN.match(content_range or '')
+      if match is None or int(match.group(1)) != offset:
+        os.remove(temp_path)
+        raise gdata.client.Error, ('Unexpected Content-Range for resumed '
+                                   'download: %s' % content_range)
+      total = match.group(2)
+      f = open(temp_path, 'ab')
+    elif server_response.status == 200:
+      total = (server_response.getheader('Content-Length')
+               or server_response.getheader('content-length'))
+      # The server sent the whole file, so anything we had is not needed.
+      offset = 0
+      if resume:
+        f = open(temp_path, 'wb')
+      else:
+        temp_path, f = _open_temp_file(file_path)
+    else:
+      raise gdata.client.RequestError, {'status': server_response.status,
+                                        'reason': server_response.reason,
+                                        'body': server_response.read()}
+    if total is not None and total != '*':
+      total = int(total)
+    else:
+      total = None
+
+    try:
+      try:
+        written = offset
+        while True:
+          chunk = server_response.read(chunk_size)
+          if not chunk:
+            break
+          f.write(chunk)
+          written += len(chunk)
+          if progress_callback is not None:
+            progress_callback(written, total)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      if total is not None and written != total:
+        raise gdata.client.Error, ('Download incomplete: received %i of %i '
+                                   'bytes.' % (written, total))
+      os.rename(temp_path, file_path)
+    except:
+      if not resume and os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise
 
   _DownloadFile = _download_file
 
-  def get_doclist(self, uri=None, limit=None, auth_token=None, **kwargs):
+  def get_doclist(self, uri=None, limit=None, auth_token=None, fields=None,
+                  desired_class=None, **kwargs):
     """Retrieves the main doclist feed containing the user's items.
 
     Args:
@@ -123,25 +252,45 @@ class DocsClient(gdata.client.GDClient):
           the uri parameter, it is chosen over a value set for limit.
       auth_token: (optional) gdata.gauth.ClientLoginToken, AuthSubToken, or
           OAuthToken which authorizes this client to edit the user's data.
+      fields: str (optional) Asks for a partial response, such as
+          gdata.docs.data.PARTIAL_DOCLIST_FIELDS. The fields can also be set
+          on a query passed as q, or already be in the uri (next links keep
+          them).
+      desired_class: (optional) The class to parse the feed as. Defaults to
+          gdata.docs.data.PartialDocList if fields is
+          gdata.docs.data.PARTIAL_DOCLIST_FIELDS, and DocList otherwise.
       kwargs: Other parameters to pass to self.get_feed().
 
     Returns:
-      gdata.docs.data.DocList feed.
+      gdata.docs.data.DocList feed, or a gdata.docs.data.PartialDocList if
+      the fields were gdata.docs.data.PARTIAL_DOCLIST_FIELDS.
     """
-    if uri is None:
-      uri = DOCLIST_FEED_URI
+    uri, desired_class = _doclist_query(uri, limit, fields, kwargs.get('q'),
+                                        desired_class)
+    return self.get_feed(uri, desired_class=desired_class,
+                         auth_token=auth_token, **kwargs)
 
-    if isinstance(uri, (str, unicode)):
-      uri = atom.http_core.Uri.parse_uri(uri)    
+  GetDocList = get_doclist
 
-    # Add max-results param if it wasn't included in the uri.
-    if limit is not None and not 'max-results' in uri.query:
-      uri.query['max-results'] = limit
+  def get_doclist_stream(self, uri=None, limit=None, auth_token=None,
+                         fields=None, desired_class=None, **kwargs):
+    """Retrieves a page of the doclist feed, parsing entries as they arrive.
 
-    return self.get_feed(uri, desired_class=gdata.docs.data.DocList,
-                         auth_token=auth_token, **kwargs)
+    Takes the same arguments as get_doclist(). Only one entry is held in
+    memory at a time, and the response must be read to the end before the
+    connection can be used for another request.
 
-  GetDocList = get_doclist
+    Returns:
+      An atom.core.ElementStream which yields gdata.docs.data.DocsEntry (or
+      PartialDocsEntry) objects. Once they have all been read, its root is
+      the DocList holding the rest of the feed, such as its next link.
+    """
+    uri, desired_class = _doclist_query(uri, limit, fields, kwargs.get('q'),
+                                        desired_class)
+    return self.get_feed_stream(uri, desired_class=desired_class,
+                                auth_token=auth_token, **kwargs)
+
+  GetDocListStream = get_doclist_stream
 
   def get_doc(self, resource_id, etag=None, auth_token=None, uri=None,
               **kwargs):
@@ -197,7 +346,9 @@ class DocsClient(gdata.client.GDClient):
       uri = DOCLIST_FEED_URI
 
     feed = self.GetDocList(uri=uri, auth_token=auth_token, **kwargs)
-    entries = feed.entry
+    # Copy the list rather than extend the first feed's, which may be shared
+    # by a cache.
+    entries = list(feed.entry)
 
     while feed.GetNextLink() is not None:
       feed = self.GetDocList(
@@ -208,6 +359,32 @@ class DocsClient(gdata.client.GDClient):
 
   GetEverything = get_everything
 
+  def iter_everything(self, uri=None, auth_token=None, **kwargs):
+    """Yields every entry of the user's doc list, following next links.
+
+    Like get_everything(), but each page is parsed as it is read with
+    get_doclist_stream(), so only one entry is held in memory at a time.
+
+    Args:
+      uri: str (optional) A URI to query the doclist feed with.
+      auth_token: (optional) gdata.gauth.ClientLoginToken, AuthSubToken, or
+          OAuthToken which authorizes this client to edit the user's data.
+      kwargs: Other parameters to pass to self.get_doclist_stream().
+    """
+    if uri is None:
+      uri = DOCLIST_FEED_URI
+
+    while uri is not None:
+      stream = self.get_doclist_stream(uri=uri, auth_token=auth_token,
+                                       **kwargs)
+      for entry in stream:
+        yield entry
+      uri = None
+      if stream.root is not None and stream.root.get_next_link() is not None:
+        uri = stream.root.get_next_link().href
+
+  IterEverything = iter_everything
+
   def get_acl_permissions(self, resource_id, auth_token=None, uri=None,
                           **kwargs):
     """Retrieves a the ACL sharing permissions for a document.
@@ -538,6 +715,33 @@ class DocsClient(gdata.client.GDClient):
   Export = export
 
 
+def _doclist_query(uri, limit, fields, query, desired_class):
+  """Returns the doclist uri for get_doclist and the class to parse it as.
+
+  Entries are only parsed as PartialDocsEntry when the projection is
+  PARTIAL_DOCLIST_FIELDS, whose members they hold. Any other projection is
+  parsed as a DocList, so the members it asks for are all there.
+  """
+  if uri is None:
+    uri = DOCLIST_FEED_URI
+
+  if isinstance(uri, (str, unicode)):
+    uri = atom.http_core.Uri.parse_uri(uri)
+
+  # Add max-results param if it wasn't included in the uri.
+  if limit is not None and not 'max-results' in uri.query:
+    uri.query['max-results'] = limit
+
+  if fields is not None:
+    uri.query['fields'] = fields
+  if desired_class is not None:
+    return uri, desired_class
+  fields = uri.query.get('fields') or getattr(query, 'fields', None)
+  if fields == gdata.docs.data.PARTIAL_DOCLIST_FIELDS:
+    return uri, gdata.docs.data.PartialDocList
+  return uri, gdata.docs.data.DocList
+
+
 class DocsQuery(gdata.client.Query):
 
   def __init__(self, title=None, title_exact=None, opened_min=None,
@@ -53,6 +53,12 @@ DOCS_PUBLISH_LINK_REL = DOCUMENTS_NS + '#publish'
 FILE_EXT_PATTERN = re.compile('.*\.([a-zA-Z]{3,}$)')
 RESOURCE_ID_PATTERN = re.compile('^([a-z]*)(:|%3A)([\w-]*)$')
 
+# Partial response projection (the fields query parameter) asking for what a
+# PartialDocsEntry holds, and for a doclist feed of them and its next links.
+PARTIAL_ENTRY_FIELDS = ('@gd:etag,id,title,updated,gd:resourceId,content,'
+                        'link(@rel,@href),category(@scheme,@term,@label)')
+PARTIAL_DOCLIST_FIELDS = 'link,entry(%s)' % PARTIAL_ENTRY_FIELDS
+
 # File extension/mimetype pairs of common format.
 MIMETYPES = {
   'CSV': 'text/csv',
@@ -238,11 +244,37 @@ class Acl(gdata.acl.data.AclEntry):
   """A document ACL entry."""
 
 
+class PartialDocsEntry(DocsEntry):
+  """A DocsEntry fetched with fields=PARTIAL_ENTRY_FIELDS.
+
+  Only the members in the projection are parsed, which makes each entry
+  cheaper to build. The other DocsEntry members are None, and anything else
+  the server sends ends up in _other_elements.
+  """
+  author = None
+  contributor = None
+  control = None
+  feed_link = None
+  last_modified_by = None
+  last_viewed = None
+  published = None
+  quota_bytes_used = None
+  rights = None
+  source = None
+  summary = None
+  writers_can_invite = None
+
+
 class DocList(gdata.data.GDFeed):
   """The main DocList feed containing a list of Google Documents."""
   entry = [DocsEntry]
 
 
+class PartialDocList(DocList):
+  """A DocList fetched with fields=PARTIAL_DOCLIST_FIELDS."""
+  entry = [PartialDocsEntry]
+
+
 class AclFeed(gdata.acl.data.AclFeed):
   """A DocList ACL feed."""
   entry = [Acl]
@@ -392,9 +392,12 @@ def check_data_classes(test, classes):
                      'The _qname for class %s is only a namespace' % (
                          data_class))
 
-    for attribute_name, value in data_class.__dict__.iteritems():
+    for attribute_name in data_class.__dict__:
       # Ignore all elements that start with _ (private members)
       if not attribute_name.startswith('_'):
+        # Read through the class, which gives a member's definition even
+        # when atom.core.COMPACT_MEMBERS has replaced it with a descriptor.
+        value = getattr(data_class, attribute_name)
         try:
           if not (isinstance(value, str) or inspect.isfunction(value) 
               or (isinstance(value, list)
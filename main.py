@@ -3,70 +3,359 @@
 import gdata.docs.data
 from gdata.docs.data import MIMETYPES
 import gdata.docs.client
+import atom.core
+import atom.http_core
+import atom.cache_http_core
+import atom.data
+import gdata.client
 from gdata.gauth import ClientLoginToken
 from gdata.client import Unauthorized
 
 from signal import SIGTERM
 from getpass import getpass
-import sys, os, time, atexit, argparse
+import sys, os, time, atexit, argparse, copy, random
 
 import pyinotify
 import sqlite3
 import urllib
+import hashlib
+import threading
+import Queue
 from daemon import Daemon
 
 import exceptions
+from contextlib import contextmanager
+
+# Whole doclists are kept in memory while syncing, so only store the members
+# each entry actually has, and only convert the ones which are read. Every
+# poll parses a doclist, so use the parsers generated for each class too.
+atom.core.COMPACT_MEMBERS = True
+atom.core.LAZY_CHILDREN = True
+atom.core.GENERATE_CODE = True
+
+class DbPool(object):
+    """
+    Keeps one sqlite connection per thread for a database file. Connections
+    are opened the first time a thread asks for one and reused after that,
+    and the schema is only checked the first time any thread connects.
+    """
+    
+    pools = {} # db_file -> DbPool
+    pools_lock = threading.Lock()
+    
+    def get(cls, db_file):
+        """
+        Returns the shared pool for db_file, creating it if needed.
+        """
+        cls.pools_lock.acquire()
+        try:
+            if db_file not in cls.pools:
+                cls.pools[db_file] = cls(db_file)
+            return cls.pools[db_file]
+        finally:
+            cls.pools_lock.release()
+            
+    get = classmethod(get)
+    
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.initialized = False
+        
+    def connection(self, init=None):
+        """
+        Returns this thread's connection. init is called with the first
+        connection made to set up the schema.
+        """
+        # connections don't survive a fork (the daemon forks after authorizing)
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.depth = 0
+            
+            self.lock.acquire()
+            try:
+                if not self.initialized and init is not None:
+                    init(conn)
+                self.initialized = True
+            finally:
+                self.lock.release()
+        return self.local.conn
 
 class DocDb(object):
     """
     Interface for interacting with the local sqlite databse
     """
     
-    db = None # Holds db connection once setDb is called
+    # Each entry upgrades the schema by one version. Never change an existing
+    # entry, add a new one instead.
+    SCHEMA = [
+        [
+            """create table if not exists token
+            (token text, id int primary key)
+            """,
+            """create table if not exists docs
+            (local_path text, resource_id text primary key, etag text, title text)
+            """,
+        ],
+        [
+            """create table sync_state
+            (key text primary key, value text)
+            """,
+            """create table folders
+            (resource_id text, local_path text, etag text,
+            primary key (resource_id, local_path))
+            """,
+        ],
+        [
+            "alter table docs add column content_hash text",
+            "alter table docs add column size int",
+            "alter table docs add column mtime real",
+        ],
+        [
+            "alter table docs add column edit_link text",
+        ],
+        [
+            """create table partials
+            (local_path text primary key, resource_id text, etag text, received int)
+            """,
+        ],
+        [
+            "alter table docs add column upload_link text",
+            """create table uploads
+            (local_path text primary key, upload_uri text, content_hash text)
+            """,
+        ],
+        [
+            # a doc in more than one folder gets a row per copy. local_path
+            # comes first in the key so rows can be looked up by path.
+            """create table docs_by_path
+            (local_path text, resource_id text, etag text, title text, content_hash text,
+            size int, mtime real, edit_link text, upload_link text,
+            primary key (local_path, resource_id))
+            """,
+            """insert into docs_by_path select local_path, resource_id, etag, title,
+            content_hash, size, mtime, edit_link, upload_link from docs
+            """,
+            "drop table docs",
+            "alter table docs_by_path rename to docs",
+        ],
+        [
+            # changes are uploaded as media only, so the doc's metadata is
+            # never rewritten. edit_link is no longer kept.
+            "alter table docs add column edit_media_link text",
+        ],
+    ]
+    
+    # the columns of the docs table, in the order rows are kept in the index
+    DOC_COLUMNS = ('local_path', 'resource_id', 'etag', 'title', 'content_hash', 'size', 'mtime',
+                   'edit_media_link', 'upload_link')
+    
+    pool = None # the DbPool for db_file once setDb is called
+    index = None # (resource_id, local_path) -> docs row during a sync pass
+    changed = None # (resource_id, local_path) -> docs row to write at the end of the pass
+    folders = None # folders rows replacing the table at the end of the pass
+    state = None # sync_state values to write at the end of the pass
     
     def __init__(self):
         """
         nothing to be done here just yet. we're not initializing the database
-        here so that users of this class can control when and how often the
-        connection is initialized. This needed to be this way to allow some
-        threading since you can't operate on a connection that was created in
-        a different thread.
-        
-        @TODO: Determine if it might be more useful to instaniate a new object
-            each time a connection is needed in a thread.
+        here so that users of this class can control when the connection is
+        set up. Connections come from a DbPool, which gives each thread its own
+        connection, so a single DocDb can be shared between threads.
         """
-        pass
+        self.lock = threading.Lock()
+        
+    def _getDb(self):
+        return self.pool.connection(self._initDb)
+        
+    db = property(_getDb, doc='This thread\'s connection to the database')
     
-    def _initDb(self):
+    def _initDb(self, db):
         """
-        Attempt to create the tables needed in the database. They will only be
-        created if they don't already exist. If the database needs to be 
-        updated, that should happen here.
-        
-        @TODO: Set a database version so it can be determined if this codes 
-            needs to be run without actually attempting it.
+        Bring the schema up to date. The current version is kept in the
+        schema_version table so this only runs DDL when the schema actually
+        changed. Called once per database file by the DbPool.
         """
-        CREATE_TOKEN_TABLE = '''create table token
-        (token text, id int primary key)
-        '''
-        CREATE_DOCS_TABLE = '''create table docs
-        (local_path text, resource_id text primary key, etag text, title text)
-        '''
+        query = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        if db.execute(query).fetchone():
+            version = db.execute('SELECT max(version) FROM schema_version').fetchone()[0] or 0
+        else:
+            db.execute('create table schema_version (version int)')
+            version = 0
         
-        try:
-            self.db.execute(CREATE_TOKEN_TABLE)
-            self.db.execute(CREATE_DOCS_TABLE)
-        except sqlite3.OperationalError, error:
-            pass
+        for number in range(version, len(self.SCHEMA)):
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in self.SCHEMA[number]:
+                    db.execute(statement)
+                db.execute('INSERT INTO schema_version (version) VALUES (?)', (number + 1,))
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
     
     def setDb(self, db_file):
         """
-        Use this method to instantiate the database. This must be called in each
-        new thread that is created, otherwise, sqlite will yell at you.
+        Use this method to pick the database file. Connections are made lazily
+        per thread, so calling this again is cheap.
         """
         self.db_file = db_file
-        self.db = sqlite3.connect(self.db_file, isolation_level=None)
-        self._initDb()
+        self.pool = DbPool.get(db_file)
+        
+    def transaction(self):
+        """
+        Context manager wrapping its block in a single write transaction on
+        this thread's connection. Nested uses join the outer transaction.
+        """
+        return _transaction(self)
+        
+    def loadIndex(self):
+        """
+        Read the whole docs table in one query. Returns a dict of
+        (resource_id, local_path) -> row, with the columns in DOC_COLUMNS
+        order.
+        """
+        query = "SELECT %s FROM docs" % ', '.join(self.DOC_COLUMNS)
+        index = {}
+        for row in self.db.execute(query):
+            index[(row[1], row[0])] = tuple(row)
+        return index
+        
+    def startPass(self):
+        """
+        Start a sync pass. The docs table is loaded into memory so getEtag is a
+        dict lookup, and doc writes are kept in memory until finishPass writes
+        them all in one transaction instead of one commit per doc.
+        """
+        index = self.loadIndex()
+        self.lock.acquire()
+        try:
+            self.index = index
+            self.changed = {}
+            self.folders = None
+            self.state = {}
+        finally:
+            self.lock.release()
+        
+    def finishPass(self):
+        """
+        Write every doc changed since startPass with a single executemany.
+        """
+        self.lock.acquire()
+        try:
+            changed, folders, state = self.changed, self.folders, self.state
+            self.index = None
+            self.changed = None
+            self.folders = None
+            self.state = None
+        finally:
+            self.lock.release()
+            
+        if changed or folders is not None or state:
+            with self.transaction() as db:
+                if changed:
+                    query = "INSERT OR REPLACE INTO docs (%s) VALUES (%s)" % (
+                        ', '.join(self.DOC_COLUMNS), ', '.join('?' * len(self.DOC_COLUMNS)))
+                    db.executemany(query, changed.values())
+                if folders is not None:
+                    db.execute("DELETE FROM folders")
+                    query = "INSERT OR REPLACE INTO folders (resource_id, local_path, etag) VALUES (?, ?, ?)"
+                    db.executemany(query, folders)
+                if state:
+                    query = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)"
+                    db.executemany(query, state.items())
+                    
+    def _passRecord(self, resource_id, path, fields, replace=False):
+        """
+        Record a change to the doc's copy at path in the pass index. fields
+        maps column names to their new values; with replace the whole row is
+        replaced, otherwise only those columns of a known copy change. Returns
+        False if no pass is in progress (or the copy to update isn't known),
+        in which case the caller writes to the db directly.
+        """
+        key = (resource_id, path)
+        self.lock.acquire()
+        try:
+            if self.index is None:
+                return False
+            if replace:
+                row = dict.fromkeys(self.DOC_COLUMNS)
+            elif key in self.index:
+                row = dict(zip(self.DOC_COLUMNS, self.index[key]))
+            else:
+                return False
+            row.update(fields)
+            row['resource_id'] = resource_id
+            row['local_path'] = path
+            row = tuple([row[column] for column in self.DOC_COLUMNS])
+            self.index[key] = row
+            self.changed[key] = row
+            return True
+        finally:
+            self.lock.release()
+            
+    def _update(self, resource_id, path, **fields):
+        """
+        Change some columns of the row for the doc's copy at path.
+        """
+        if self._passRecord(resource_id, path, fields):
+            return
+        names = fields.keys()
+        query = "UPDATE docs SET %s WHERE resource_id = ? AND local_path = ?" % (
+            ', '.join(['%s = ?' % name for name in names]))
+        self.db.execute(query, [fields[name] for name in names] + [resource_id, path])
+        
+    def getState(self, key):
+        """
+        Get a value saved with setState, or None if there isn't one.
+        """
+        query = "SELECT value FROM sync_state WHERE key = ?"
+        res = self.db.execute(query, (key,)).fetchone()
+        if res:
+            return res[0]
+        return None
+        
+    def setState(self, key, value):
+        """
+        Save a bit of sync bookkeeping (e.g. the last time we synced). During a
+        sync pass it's written along with everything else by finishPass, so it
+        only sticks if the pass finishes.
+        """
+        self.lock.acquire()
+        try:
+            if self.state is not None:
+                self.state[key] = value
+                return
+        finally:
+            self.lock.release()
+        query = "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)"
+        self.db.execute(query, (key, value))
+        
+    def setFolders(self, folders):
+        """
+        Replace the folders table with the given (resource_id, local_path,
+        etag) rows at the end of the current sync pass.
+        """
+        self.lock.acquire()
+        try:
+            self.folders = list(folders)
+        finally:
+            self.lock.release()
+            
+    def getFolders(self):
+        """
+        Returns a dict of folder resource_id -> list of (local_path, etag).
+        """
+        query = "SELECT resource_id, local_path, etag FROM folders"
+        folders = {}
+        for resource_id, local_path, etag in self.db.execute(query):
+            folders.setdefault(resource_id, []).append((local_path, etag))
+        return folders
         
     def getToken(self):
         """
@@ -89,38 +378,182 @@ class DocDb(object):
         query = "INSERT OR REPLACE INTO token (token, id) VALUES (?, 1)"
         self.db.execute(query, (token,))
         
-    def addDoc(self, doc, path):
+    def addDoc(self, doc, path, content=(None, None, None)):
+        """
+        Adds or replaces the row for the given doc's copy at path. Each copy
+        of a doc that lives in several folders has its own row. content is
+        the (content_hash, size, mtime) of the local file, as returned by
+        fileState.
+        """
+        fields = {'etag': doc.etag, 'title': doc.title.text,
+                  'edit_media_link': doc.find_edit_media_link(),
+                  'upload_link': doc.find_url(RESUMABLE_EDIT_MEDIA_REL)}
+        fields.update(zip(('content_hash', 'size', 'mtime'), content))
+        if self._passRecord(doc.resource_id.text, path, fields, replace=True):
+            return
+        fields['resource_id'] = doc.resource_id.text
+        fields['local_path'] = path
+        query = "INSERT OR REPLACE INTO docs (%s) VALUES (%s)" % (
+            ', '.join(self.DOC_COLUMNS), ', '.join('?' * len(self.DOC_COLUMNS)))
+        self.db.execute(query, [fields[column] for column in self.DOC_COLUMNS])
+        
+    def getPartial(self, path):
+        """
+        Returns (resource_id, etag, received) for an unfinished download to
+        path, or None.
+        """
+        query = "SELECT resource_id, etag, received FROM partials WHERE local_path = ?"
+        return self.db.execute(query, (path,)).fetchone()
+        
+    def setPartial(self, path, resource_id, etag, received):
+        """
+        Record that a download of the given version of a doc to path has
+        started, and how many bytes of it are on disk.
+        """
+        query = "INSERT OR REPLACE INTO partials (local_path, resource_id, etag, received) VALUES (?, ?, ?, ?)"
+        self.db.execute(query, (path, resource_id, etag, received))
+        
+    def clearPartial(self, path):
+        """
+        Forget the unfinished download to path.
+        """
+        self.db.execute("DELETE FROM partials WHERE local_path = ?", (path,))
+        
+    def getUpload(self, path):
+        """
+        Returns (upload_uri, content_hash) of an unfinished resumable upload
+        of path, or None.
+        """
+        query = "SELECT upload_uri, content_hash FROM uploads WHERE local_path = ?"
+        return self.db.execute(query, (path,)).fetchone()
+        
+    def setUpload(self, path, upload_uri, content_hash):
+        """
+        Remember the session uri of a resumable upload of path, and the hash of
+        the content being sent, so a restart can carry on with it.
+        """
+        query = "INSERT OR REPLACE INTO uploads (local_path, upload_uri, content_hash) VALUES (?, ?, ?)"
+        self.db.execute(query, (path, upload_uri, content_hash))
+        
+    def getUploads(self):
+        """
+        Returns (local_path, upload_uri, content_hash) for every unfinished
+        resumable upload.
+        """
+        return self.db.execute("SELECT local_path, upload_uri, content_hash FROM uploads").fetchall()
+        
+    def clearUpload(self, path):
         """
-        Adds or replaces the given doc and associated path to the docs table.
+        Forget the resumable upload of path.
         """
-        query = "INSERT OR REPLACE INTO docs (local_path, resource_id, etag, title) VALUES (?, ?, ?, ?)"
-        self.db.execute(query, (path, doc.resource_id.text, doc.etag, doc.title.text))
+        self.db.execute("DELETE FROM uploads WHERE local_path = ?", (path,))
         
-    def getEtag(self, resource_id):
+    def getEtag(self, resource_id, path):
         """
-        Get the etag by resource_id. Useful to see if the doc has changed on the
-        server. Returns False when a document isn't found.
+        Get the etag the doc's copy at path was last synced at. Useful to see
+        if that copy is behind the server. Returns False when the copy isn't
+        known. During a sync pass this is answered from the in-memory index.
         """
-        query = "SELECT etag FROM docs WHERE resource_id = ?"
-        res = self.db.execute(query, (resource_id,)).fetchone()
+        index = self.index
+        if index is not None:
+            key = (resource_id, path)
+            if key in index:
+                return index[key][2]
+            return False
+        query = "SELECT etag FROM docs WHERE resource_id = ? AND local_path = ?"
+        res = self.db.execute(query, (resource_id, path)).fetchone()
         if res:
             return res[0]
         return False
         
     def getRowFromPath(self, path):
         """
-        Get a row from the docs table by the path.
+        Get a row from the docs table by the path: (resource_id, etag, title,
+        content_hash, size, mtime, edit_media_link, upload_link).
         """
-        query = "SELECT resource_id, etag, title FROM docs WHERE local_path = ?"
+        query = """SELECT resource_id, etag, title, content_hash, size, mtime, edit_media_link, upload_link
+            FROM docs WHERE local_path = ?"""
         res = self.db.execute(query, (path,)).fetchone()
         return res
         
-    def resetEtag(self, doc):
+    def resetEtag(self, doc, path):
         """
-        Updates the given doc's etag. Useful after various sync operations.
+        Updates the etag of the given doc's copy at path. Useful after various
+        sync operations.
+        """
+        self._update(doc.resource_id.text, path, etag=doc.etag,
+                     edit_media_link=doc.find_edit_media_link(), upload_link=doc.find_url(RESUMABLE_EDIT_MEDIA_REL))
+        
+    def setContent(self, resource_id, path, content):
         """
-        query = "UPDATE docs SET etag = ? WHERE resource_id = ?"
-        self.db.execute(query, (doc.etag, doc.resource_id.text))
+        Record the (content_hash, size, mtime) of the doc's file at path as
+        last synced.
+        """
+        content_hash, size, mtime = content
+        self._update(resource_id, path, content_hash=content_hash, size=size, mtime=mtime)
+
+def _transaction(docdb):
+    """
+    Generator behind DocDb.transaction. The nesting depth is kept per thread
+    in the pool so only the outermost block begins and commits.
+    """
+    db = docdb.db
+    local = docdb.pool.local
+    if local.depth == 0:
+        db.execute('BEGIN IMMEDIATE')
+    local.depth += 1
+    try:
+        yield db
+    except:
+        local.depth -= 1
+        if local.depth == 0:
+            db.execute('ROLLBACK')
+        raise
+    local.depth -= 1
+    if local.depth == 0:
+        db.execute('COMMIT')
+        
+_transaction = contextmanager(_transaction)
+
+HASH_BLOCK_SIZE = 65536
+
+def fileState(path):
+    """
+    Returns (content_hash, size, mtime) for the file at path. The file is
+    hashed a block at a time so big files never sit in memory.
+    """
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+        stat = os.fstat(f.fileno())
+    finally:
+        f.close()
+    return digest.hexdigest(), stat.st_size, stat.st_mtime
+
+RESUMABLE_EDIT_MEDIA_REL = 'http://schemas.google.com/g/2005#resumable-edit-media'
+ROOT_FEED_URI = '/feeds/default/private/full/folder%3Aroot/contents/-/all'
+# only ask for the parts of each entry the sync uses, which keeps listings small
+LISTING_FIELDS = gdata.docs.data.PARTIAL_DOCLIST_FIELDS
+
+def entryKind(entry):
+    """
+    Work out if an entry from a doclist feed is something we sync. Returns
+    'folder', 'document' or None for everything else.
+    
+    @TODO: add PDFs and other types of files
+    """
+    kind = None
+    for cat in entry.category:
+        if cat.label == 'folder':
+            kind = 'folder'
+        elif cat.label == 'document' and kind is None:
+            kind = 'document'
+    return kind
 
 class Folder(object):
     subfolders = []
@@ -128,67 +561,213 @@ class Folder(object):
     parent = None
     entry = None
     client = None
+    downloader = None
 
     home = os.path.expanduser('~')
     gdocs_folder = home +'/Google Docs'
     path = '/'
 
-    def __init__(self, entry, parent=None, client=None):
+    def __init__(self, entry, parent=None, client=None, crawl=True, downloader=None, path=None):
+        """
+        Sets up the folder on disk. When crawl is True the folder's feed is
+        fetched and every subfolder is built recursively before returning. Pass
+        crawl=False to only create the folder and leave filling it in to the
+        caller (see FolderCrawler). Docs are handed to downloader if one is
+        given; subfolders use their parent's. path can be given to use a folder
+        whose place is already known without building its parents.
+        """
         self.subfolders = []
         self.docs = []
         self.parent = parent
         self.entry = entry
         self.client = client
-        
-        # if no entry given, then assume this is the root
-        if entry is None:
-            feed = self.client.GetDocList(uri='/feeds/default/private/full/folder%3Aroot/contents/-/all')
-        else:
-            feed = self.client.GetDocList(uri=self.entry.content.src)
+        self.downloader = downloader
+        if parent is not None:
+            self.downloader = parent.downloader
         
         # if it's not the root, set up the path properly
-        if entry is not None and parent is not None:
+        if path is not None:
+            self.path = path
+        elif entry is not None and parent is not None:
             self.path = self.entry.title.text + '/'
             self.path = parent.path + self.path
             
         # make the paths exist on the filesystem
         # make sure to add self.gdocs_folder here
         if not os.path.isdir(self.gdocs_folder + self.path):
-            os.mkdir(self.gdocs_folder + self.path, 0755)
+            os.makedirs(self.gdocs_folder + self.path, 0755)
             
-        # run over each entry
-        for e in feed.entry:
-            is_folder = False
-            is_doc = False
+        if crawl:
+            self.addEntries(self.getFeed().entry)
+        
+    def __repr__(self):
+        return self.path
+        
+    def feedUri(self):
+        """
+        The uri of the feed listing this folder's contents.
+        """
+        # if no entry given, then assume this is the root
+        if self.entry is None:
+            return ROOT_FEED_URI
+        return self.entry.content.src
+        
+    def getFeed(self):
+        """
+        Fetch this folder's contents from the server.
+        """
+        return self.client.GetDocList(uri=self.feedUri(), fields=LISTING_FIELDS)
+        
+    def addEntries(self, entries, crawl=True):
+        """
+        Adds each folder or doc in entries to this folder. Returns the list of
+        subfolders that were created.
+        """
+        added = []
+        for e in entries:
+            kind = entryKind(e)
             
-            # find out what folder this belongs to
-            for link in e.link:
-                if link.rel == 'http://schemas.google.com/docs/2007#parent':
-                    #belongs_to = link.title
-                    pass
-        
-            # use this loop to find out if we're in a doc or folder
-            # @TODO: add PDFs and other types of files
-            for cat in e.category:
-                if cat.label == 'folder':
-                    is_folder = True
-                elif cat.label == 'document':
-                    is_doc = True
-
             # add the folder or doc as appropriate
-            if is_folder:
-                self.add_folder(e)
-            elif is_doc:
+            if kind == 'folder':
+                added.append(self.add_folder(e, crawl))
+            elif kind == 'document':
                 self.add_doc(e)
+        return added
         
-    def __repr__(self):
-        return self.path
+    def walk(self):
+        """
+        Generator over this folder and every folder below it.
+        """
+        stack = [self]
+        while stack:
+            folder = stack.pop()
+            yield folder
+            stack.extend(folder.subfolders)
         
-    def add_folder(self, entry):
-        self.subfolders.append(Folder(entry, self, self.client))
+    def add_folder(self, entry, crawl=True):
+        folder = Folder(entry, self, self.client, crawl)
+        self.subfolders.append(folder)
+        return folder
         
     def add_doc(self, entry):
-        self.docs.append(Document(entry, self))
+        self.docs.append(Document(entry, self, downloader=self.downloader))
+
+class FolderCrawler(object):
+    """
+    Builds the same tree as Folder does, but fetches the folder feeds with a
+    bounded pool of worker threads. The workers only do the network round
+    trips; the thread calling crawl() builds the Folder objects as the feeds
+    come back, so parents always exist on disk before their children.
+    """
+    
+    def __init__(self, client, workers=4, downloader=None):
+        self.client = client
+        self.workers = max(1, int(workers))
+        self.downloader = downloader
+        
+    def crawl(self):
+        """
+        Walks the whole tree from the root and returns the root Folder.
+        """
+        pending = Queue.Queue()
+        results = Queue.Queue()
+        
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(pending, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        
+        try:
+            root = Folder(None, None, self.client, False, self.downloader)
+            pending.put(root)
+            outstanding = 1
+            while outstanding:
+                folder, feed, error = results.get()
+                outstanding -= 1
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                for subfolder in folder.addEntries(feed.entry, crawl=False):
+                    pending.put(subfolder)
+                    outstanding += 1
+        finally:
+            # throw away anything still queued and let the workers exit
+            try:
+                while True:
+                    pending.get_nowait()
+            except Queue.Empty:
+                pass
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+                
+        return root
+        
+    def _work(self, pending, results):
+        """
+        Worker loop. Fetches folder feeds until it's handed None.
+        """
+        while True:
+            folder = pending.get()
+            if folder is None:
+                return
+            try:
+                results.put((folder, folder.getFeed(), None))
+            except Exception:
+                results.put((folder, None, sys.exc_info()))
+        
+class FlatLister(object):
+    """
+    Builds the same tree as Folder does from a single paged listing of the
+    whole doclist. Every entry knows its parent folders, so the hierarchy is
+    put back together locally instead of asking for each folder's contents.
+    That costs one request per page_size items rather than one per folder.
+    """
+    
+    feed_uri = gdata.docs.client.DOCLIST_FEED_URI + '?showfolders=true'
+    
+    def __init__(self, client, page_size=1000, downloader=None):
+        self.client = client
+        self.page_size = page_size
+        self.downloader = downloader
+        
+    def crawl(self):
+        """
+        Lists everything and returns the root Folder.
+        """
+        # group the entries by the folder they live in. docs that are in more
+        # than one folder show up under each of them, just like they do when
+        # walking the folders, and anything without a parent lives in the root.
+        children = {}
+        for e in self.client.IterEverything(uri=self.feed_uri, limit=self.page_size,
+                                            fields=LISTING_FIELDS):
+            if entryKind(e) is None:
+                continue
+            parents = [parentId(link) for link in e.in_folders()]
+            if not parents:
+                parents = [None]
+            for parent_id in parents:
+                children.setdefault(parent_id, []).append(e)
+                
+        # walk down from the root. entries whose parent never turns up (e.g.
+        # folders we can't see) are unreachable and get skipped, same as they
+        # would be by the recursive walk.
+        root = Folder(None, None, self.client, False, self.downloader)
+        stack = [(root, None)]
+        while stack:
+            folder, folder_id = stack.pop()
+            for subfolder in folder.addEntries(children.get(folder_id, []), crawl=False):
+                stack.append((subfolder, subfolder.entry.resource_id.text))
+                
+        return root
+
+def parentId(link):
+    """
+    Turn a parent link's href into the resource id of the folder it points to.
+    """
+    return urllib.unquote(link.href.rstrip('/').split('/')[-1])
         
 class Document(object):
     doc = None
@@ -198,8 +777,18 @@ class Document(object):
     gdocs_folder = home +'/Google Docs'
     
     db_file = gdocs_folder + '/.db'
+    
+    # path -> mtime of the files we've downloaded (None while downloading), so
+    # the watcher can tell our writes apart from the user's
+    written = {}
+    written_lock = threading.Lock()
 
-    def __init__(self, doc, parent=None, client=None, force_download=False):
+    def __init__(self, doc, parent=None, client=None, force_download=False, downloader=None):
+        """
+        Works out where the doc lives locally and makes sure it exists on the
+        file system. If a downloader (DownloadQueue) is given the doc is handed
+        to it instead of being saved right away.
+        """
         self.doc = doc
         self.force = force_download
         self.parent = parent
@@ -209,24 +798,285 @@ class Document(object):
         else:
             self.path = parent.gdocs_folder + parent.path + doc.title.text.replace('/', '-') + '.odt'
             self.client = parent.client
-        self.db = DocDb()
-        self.db.setDb(self.db_file)
+            
+        if downloader is None:
+            self.db = DocDb()
+            self.db.setDb(self.db_file)
+            self.save()
+        else:
+            downloader.put(self)
         
-        # make sure it exists on the file system
-        self.save()
+    def save(self, client=None, db=None):
+        """
+        Download the doc if it changed. client and db default to the ones the
+        doc was created with; worker threads pass their own. Returns True if
+        the doc was written.
+        """
+        client = client or self.client
+        db = db or self.db
         
-    def save(self):
-        if self.doc.etag != self.db.getEtag(self.doc.resource_id.text) or self.force:
-            print 'writing:', self.path
-            self.client.Export(self.doc, self.path)
-            self.db.addDoc(self.doc, self.path)
+        # each copy of a doc that lives in more than one folder is checked
+        # against its own row. a copy missing from disk is fetched again too.
+        if (self.doc.etag != db.getEtag(self.doc.resource_id.text, self.path) or self.force
+                or not os.path.exists(self.path)):
+            print 'writing: %s' % self.path
+            self._preparePartial(db)
+            self._setWritten(None)
+            try:
+                client.Export(self.doc, self.path, resume=True)
+            except:
+                # keep what we got so the retry picks up where this left off
+                part = gdata.docs.client.partial_path(self.path)
+                if os.path.exists(part):
+                    db.setPartial(self.path, self.doc.resource_id.text,
+                                  self.doc.etag, os.path.getsize(part))
+                raise
+            finally:
+                if os.path.exists(self.path):
+                    self._setWritten(os.path.getmtime(self.path))
+                else:
+                    self._setWritten(False)
+            db.clearPartial(self.path)
+            db.addDoc(self.doc, self.path, fileState(self.path))
+            return True
         else:
             # nothing to see here, move along
-            pass
+            return False
+        
+    def _preparePartial(self, db):
+        """
+        A partial download left by an earlier attempt is only resumed if it
+        was of the same version of the doc. Otherwise it's thrown away and
+        the download starts from scratch.
+        """
+        resource_id = self.doc.resource_id.text
+        part = gdata.docs.client.partial_path(self.path)
+        partial = db.getPartial(self.path)
+        if os.path.exists(part):
+            if partial and tuple(partial[:2]) == (resource_id, self.doc.etag):
+                print 'resuming: %s at %d bytes' % (self.path, os.path.getsize(part))
+                return
+            os.remove(part)
+        db.setPartial(self.path, resource_id, self.doc.etag, 0)
+        
+    def _setWritten(self, mtime):
+        self.written_lock.acquire()
+        try:
+            if mtime is False:
+                self.written.pop(self.path, None)
+            else:
+                self.written[self.path] = mtime
+        finally:
+            self.written_lock.release()
+            
+    def wroteLast(cls, path):
+        """
+        True if path is being downloaded or hasn't changed since we downloaded
+        it.
+        """
+        cls.written_lock.acquire()
+        try:
+            if path not in cls.written:
+                return False
+            mtime = cls.written[path]
+        finally:
+            cls.written_lock.release()
+        return mtime is None or (os.path.exists(path) and os.path.getmtime(path) == mtime)
+        
+    wroteLast = classmethod(wroteLast)
         
     def __repr__(self):
         return self.doc.title.text
 
+class DownloadQueue(object):
+    """
+    Downloads documents on a pool of worker threads so listing never waits
+    on exports. Each worker has its own client (and so its own connections).
+    The DocDb can be shared since it hands each thread its own connection.
+    Failed downloads are retried a few times and a summary is printed by
+    finish().
+    """
+    
+    def __init__(self, client, workers=4, retries=2, db=None):
+        self.client = client
+        self.workers = max(1, int(workers))
+        self.retries = retries
+        self.db = db
+        
+        # bounded so listing can't run arbitrarily far ahead of downloading
+        self.queue = Queue.Queue(self.workers * 4)
+        self.threads = []
+        self.lock = threading.Lock()
+        
+        self.downloaded = 0
+        self.unchanged = 0
+        self.failed = []
+        
+    def start(self):
+        """
+        Start up the workers.
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+    def put(self, document):
+        """
+        Queue a Document to be saved. Blocks while the queue is full.
+        """
+        self.queue.put(document)
+        
+    def finish(self):
+        """
+        Wait for everything queued to be downloaded, stop the workers and print
+        a summary. If any download failed because the token was rejected, that
+        error is raised so the caller can re-authorize.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        
+        print 'downloaded: %d, unchanged: %d, failed: %d' % (
+            self.downloaded, self.unchanged, len(self.failed))
+        for document, error in self.failed:
+            print 'failed:', document.path, '(%s)' % error
+            
+        for document, error in self.failed:
+            if isinstance(error, Unauthorized):
+                raise error
+        
+    def _newClient(self):
+        """
+        Make a client for a worker. It shares the auth token and the connection
+        pool but not the http client, unless that's something other than a real
+        HttpClient (e.g. a mock) in which case there are no connections to keep
+        apart.
+        """
+        client = copy.copy(self.client)
+        http_client = client.http_client
+        cache = None
+        if isinstance(http_client, atom.cache_http_core.CachingHttpClient):
+            cache = http_client.cache
+            http_client = http_client.http_client
+        if isinstance(http_client, atom.http_core.HttpClient):
+            new_client = http_client.__class__()
+            new_client.debug = http_client.debug
+            new_client.connection_pool = http_client.connection_pool
+            http_client = new_client
+        if cache is not None:
+            http_client = atom.cache_http_core.CachingHttpClient(http_client, cache)
+        client.http_client = http_client
+        return client
+        
+    def _work(self):
+        """
+        Worker loop. Saves documents until it's handed None.
+        """
+        client = self._newClient()
+        db = self.db
+        if db is None:
+            db = DocDb()
+            db.setDb(Document.db_file)
+        
+        while True:
+            document = self.queue.get()
+            if document is None:
+                return
+                
+            attempt = 0
+            while True:
+                try:
+                    written = document.save(client, db)
+                except Unauthorized, error:
+                    # no point retrying with the same token
+                    self._record(document, error=error)
+                    break
+                except Exception, error:
+                    attempt += 1
+                    if attempt > self.retries:
+                        self._record(document, error=error)
+                        break
+                    # the failed attempt may have left a file behind, so don't
+                    # let that count as already downloaded
+                    document.force = True
+                else:
+                    self._record(document, written=written)
+                    break
+                    
+    def _record(self, document, written=False, error=None):
+        self.lock.acquire()
+        try:
+            if error is not None:
+                self.failed.append((document, error))
+            elif written:
+                self.downloaded += 1
+            else:
+                self.unchanged += 1
+        finally:
+            self.lock.release()
+
+class PollScheduler(object):
+    """
+    Polls the server for remote changes on a background thread while the
+    watcher handles local changes. The wait between polls grows while nothing
+    changes and drops back down after something does, and is jittered so
+    clients don't all poll in step. Polling stops if the token is rejected,
+    leaving the error in error for the watcher to raise.
+    """
+    
+    backoff = 1.5 # how much longer to wait after a poll that found nothing
+    jitter = 0.1 # +/- fraction of the wait picked at random
+    
+    def __init__(self, syncer, interval=300, min_interval=None, max_interval=None):
+        self.syncer = syncer
+        # never wait less than 30 seconds after a change, unless asked to poll
+        # more often than that to begin with
+        self.min_interval = min_interval or min(interval, max(30, interval / 4))
+        self.max_interval = max_interval or interval * 6
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None # the Unauthorized that stopped polling, if any
+        
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        self.stopped.set()
+        
+    def nextDelay(self, downloaded):
+        """
+        Adjust the interval after a poll that downloaded this many docs and
+        return how long to wait before the next one.
+        """
+        if downloaded:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        
+    def _run(self):
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        while not self.stopped.wait(delay):
+            try:
+                downloaded = self.syncer.poll()
+            except Unauthorized, error:
+                # every poll would fail the same way until there's a new token
+                print 'remote sync failed: %s' % error
+                self.error = error
+                return
+            except Exception, error:
+                # keep polling; the next one may well work
+                print 'remote sync failed: %s' % error
+                downloaded = 0
+            delay = self.nextDelay(downloaded)
+        
 class DocSync(object):
     """
     Handles the business logic of syncing. Every operation of syncing should be 
@@ -240,6 +1090,21 @@ class DocSync(object):
     db = DocDb()
     authd = False
     
+    crawl_workers = 4 # how many folder feeds to fetch at once
+    flat_listing = False # list the whole doclist at once instead of by folder
+    download_workers = 4 # how many docs to download at once
+    incremental = True # only ask for what changed since the last full sync
+    poll_interval = 300 # seconds between checks for remote changes, 0 for never
+    upload_chunk_size = gdata.client.ResumableUploader.DEFAULT_CHUNK_SIZE # bigger files are sent in chunks
+    upload_retries = 3 # how many times to resume a failed chunked upload
+    cache_feeds = True # revalidate feeds with their etag instead of refetching them
+    # kept out of the synced folder so the watcher doesn't see cache writes
+    cache_dir = os.environ.get('XDG_CACHE_HOME', home + '/.cache') + '/google-docs-sync'
+    cache_size = 16 * 1024 * 1024 # bytes of feeds, and what was parsed from them, to keep in memory
+    cache_disk_size = 64 * 1024 * 1024 # bytes of feeds to keep in cache_dir
+    scheduler = None
+    last_downloaded = 0 # docs downloaded by the last getEverything
+    
     need_new_token = False
     
     def __init__(self):
@@ -249,6 +1114,12 @@ class DocSync(object):
         self.client.ssl = True
         self.client.http_client_debug = False
         self.createBaseFolder()
+        if self.cache_feeds and not isinstance(self.client.http_client,
+                                               atom.cache_http_core.CachingHttpClient):
+            cache = atom.cache_http_core.HttpCache(self.cache_size, self.cache_dir,
+                                                   self.cache_disk_size)
+            self.client.http_client = atom.cache_http_core.CachingHttpClient(
+                self.client.http_client, cache)
         
     def createBaseFolder(self):
         """
@@ -263,28 +1134,79 @@ class DocSync(object):
         """
         try:
             self.getEverything()
+            self._setPeriodicSync()
             self._watchFolder()
         except Unauthorized, e:
             self.authorize()
             self.start()
         
-        #TODO: make this work
-        #self._setPeriodicSync()
-        
         print 'stopped'
         
+    def _setPeriodicSync(self):
+        """
+        Start polling the server for remote changes in the background, unless
+        polling is turned off (poll_interval of 0) or already running.
+        """
+        if self.poll_interval and self.scheduler is None:
+            self.scheduler = PollScheduler(self, self.poll_interval)
+            self.scheduler.start()
+            
+    def poll(self):
+        """
+        Pull down remote changes. Returns how many docs were downloaded.
+        """
+        self.getEverything()
+        return self.last_downloaded
+        
     def _watchFolder(self):
         """
-        sets up the watching of the docs folder for changes.
+        sets up the watching of the docs folder for changes. If polling stops
+        because the token was rejected, watching stops too and the error is
+        raised so start() can get a new token.
         """
         wm = pyinotify.WatchManager()
-        wm.add_watch(self.gdocs_folder, pyinotify.IN_MODIFY, rec=True)
+        wm.add_watch(self.gdocs_folder, pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE, rec=True)
         
-        handler = EventHandler(self)
-        notifier = pyinotify.Notifier(wm, handler)
+        uploads = UploadQueue(self)
+        uploads.start()
+        handler = EventHandler(self, uploads)
+        # wake up every so often to check on the poller
+        notifier = pyinotify.Notifier(wm, handler, timeout=1000)
         
-        print 'waiting for changes . . .'
-        notifier.loop()
+        try:
+            self._resumeUploads(uploads)
+            print 'waiting for changes . . .'
+            notifier.loop(callback=self._pollFailed)
+        finally:
+            uploads.stop()
+            
+        scheduler = self.scheduler
+        if scheduler is not None and scheduler.error is not None:
+            self.scheduler = None
+            raise scheduler.error
+            
+    def _resumeUploads(self, uploads):
+        """
+        Queue the uploads that were cut short by the last run. A session is
+        only kept if the file still has the content it was started with;
+        otherwise it's forgotten and the file, if it's still there, is
+        uploaded from scratch.
+        """
+        self.db.setDb(self.db_file)
+        for path, upload_uri, content_hash in self.db.getUploads():
+            if not os.path.exists(path):
+                self.db.clearUpload(path)
+                continue
+            if fileState(path)[0] != content_hash:
+                self.db.clearUpload(path)
+            uploads.closed(path)
+            
+    def _pollFailed(self, notifier):
+        """
+        Notifier callback that ends the watch loop once polling has stopped
+        because of a rejected token.
+        """
+        return self.scheduler is not None and self.scheduler.error is not None
         
     def authorize(self, username=None, password=None):
         """
@@ -321,15 +1243,19 @@ class DocSync(object):
         Downloads all the docs if the remote version is different than the local
         version.
         """
+        self.last_downloaded = 0
         try:
             if title is None:
-                # build folder structure
-                root_folder = Folder(None, None, self.client)
+                self.db.setDb(self.db_file)
+                mark = self.db.getState('high_water')
+                if not (self.incremental and mark and self.getChanges(mark)):
+                    self.getAll()
             else:
                 exact = 'false'
                 if exact_match:
                     exact = 'true'
-                feed = self.client.GetDocList(uri='/feeds/default/private/full?title='+title+'&title-exact='+exact)
+                feed = self.client.GetDocList(uri='/feeds/default/private/full?title='+title+'&title-exact='+exact,
+                                              fields=LISTING_FIELDS)
                 # run over each entry
                 for e in feed.entry:
                     is_doc = False
@@ -348,6 +1274,115 @@ class DocSync(object):
             self.need_new_token = True
             raise e
         
+    def _syncPass(self, build, mark=None):
+        """
+        Runs build(downloader) as one sync pass: docs are downloaded as they
+        turn up, and all the db writes for the pass go in one transaction at
+        the end. If build finishes, mark is saved as the new high water mark,
+        but never past a doc that failed to download, so the next pass asks
+        for that doc again.
+        """
+        self.db.setDb(self.db_file)
+        self.db.startPass()
+        downloader = DownloadQueue(self.client, self.download_workers, db=self.db)
+        downloader.start()
+        built = False
+        try:
+            result = build(downloader)
+            built = True
+            return result
+        finally:
+            try:
+                downloader.finish()
+            finally:
+                if built and mark is not None:
+                    # updated-min includes the mark itself, so holding it at
+                    # the oldest failure is enough to see that doc again
+                    for document, error in downloader.failed:
+                        mark = min(mark, document.doc.updated.text)
+                    self.db.setState('high_water', mark)
+                self.db.finishPass()
+                self.last_downloaded += downloader.downloaded
+                
+    def getAll(self):
+        """
+        Lists everything on the server and downloads whatever changed. Also
+        remembers where each folder lives and how far along the server was, so
+        the next sync can just ask for changes (see getChanges).
+        """
+        # take the high water mark before listing. anything that changes while
+        # we're listing is newer than this and gets picked up next time.
+        feed = self.client.GetDocList(uri=FlatLister.feed_uri + '&orderby=last-modified', limit=1,
+                                      fields='entry(updated)')
+        mark = None
+        if feed.entry:
+            mark = feed.entry[0].updated.text
+            
+        def build(downloader):
+            if self.flat_listing:
+                lister = FlatLister(self.client, downloader=downloader)
+            else:
+                lister = FolderCrawler(self.client, self.crawl_workers, downloader)
+            root_folder = lister.crawl()
+            
+            folders = []
+            for folder in root_folder.walk():
+                if folder.entry is not None:
+                    folders.append((folder.entry.resource_id.text, folder.path, folder.entry.etag))
+            self.db.setFolders(folders)
+            return root_folder
+            
+        return self._syncPass(build, mark)
+        
+    def getChanges(self, mark):
+        """
+        Only asks the server for what changed since mark (an updated
+        timestamp) and downloads those docs. When nothing changed this is a
+        single request. Returns False without downloading anything if the
+        changes can't be placed from what we know (a folder changed or a doc
+        is in a folder we haven't seen), in which case a full sync is needed.
+        """
+        query = gdata.docs.client.DocsQuery(show_folders='true', updated_min=mark,
+                                            fields=LISTING_FIELDS)
+        entries = self.client.GetEverything(uri=FlatLister.feed_uri, q=query)
+        
+        known = self.db.getFolders()
+        placed = []
+        new_mark = mark
+        for e in entries:
+            if e.updated.text > new_mark:
+                new_mark = e.updated.text
+                
+            kind = entryKind(e)
+            if kind == 'folder':
+                # updated-min includes the mark itself, so the last folder we
+                # saw can come back without having changed
+                paths = known.get(e.resource_id.text, [])
+                if not paths or [etag for path, etag in paths if etag != e.etag]:
+                    return False
+            elif kind == 'document':
+                parents = [parentId(link) for link in e.in_folders()]
+                if not parents:
+                    placed.append((e, '/'))
+                for parent_id in parents:
+                    if parent_id not in known:
+                        return False
+                    for path, etag in known[parent_id]:
+                        placed.append((e, path))
+                        
+        if not placed and new_mark == mark:
+            return True
+            
+        def build(downloader):
+            folders = {}
+            for e, path in placed:
+                if path not in folders:
+                    folders[path] = Folder(None, None, self.client, False, downloader, path)
+                folders[path].add_doc(e)
+            
+        self._syncPass(build, new_mark)
+        return True
+        
     def updateDoc(self, path):
         """
         sends doc information to the corresponding doc on Google Docs.
@@ -357,38 +1392,220 @@ class DocSync(object):
         if not self.authd:
             self._authorize()
         
+        # don't send back what we just downloaded
+        if Document.wroteLast(path):
+            return False
+        
         db_row = self.db.getRowFromPath(path)
         if not db_row:
             return False
         
         resource_id = db_row[0]
         etag = db_row[1]
-        title = db_row[2]
         
-        ms = gdata.data.MediaSource(file_path=path, content_type=MIMETYPES['ODT'])
-        doc = self.client.GetDoc(resource_id.replace(':', '%3A'))
-        new_version = self.client.Update(doc, media_source=ms)
+        # skip the upload if the file is the same as what we last synced. the
+        # size and mtime are checked first so unchanged files aren't hashed.
+        content_hash, size, mtime, media_link, upload_link = db_row[3:]
+        if content_hash is not None:
+            stat = os.stat(path)
+            if stat.st_size == size and stat.st_mtime == mtime:
+                return False
+        content = fileState(path)
+        if content[0] == content_hash:
+            self.db.setContent(resource_id, path, content)
+            return False
+        
+        new_version = None
+        if media_link:
+            # the db has everything needed to upload, so there's no need to
+            # fetch the entry first. if the doc changed remotely since we last
+            # synced, the etag won't match and the server answers 412.
+            try:
+                new_version = self._push(path, content, resource_id, etag,
+                                         media_link, upload_link)
+            except gdata.client.RequestError, e:
+                if e.status != 412:
+                    raise
+        if new_version is None:
+            doc = self.client.GetDoc(resource_id.replace(':', '%3A'))
+            new_version = self._push(path, content, resource_id, doc.etag,
+                                     doc.find_edit_media_link(), doc.find_url(RESUMABLE_EDIT_MEDIA_REL))
         print 'Document pushed:', new_version.GetAlternateLink().href
         
-        self.db.resetEtag(new_version)
+        self.db.resetEtag(new_version, path)
+        self.db.setContent(resource_id, path, content)
+        
+    def _push(self, path, content, resource_id, etag, media_link, upload_link):
+        """
+        Upload the file over the given version of the doc. Files bigger than
+        one chunk go through the resumable protocol, the rest in one PUT.
+        Only the file is sent, never an entry, so the doc's title, folders
+        and the rest of its metadata are left as they are. Returns the new
+        entry.
+        """
+        if upload_link and content[1] > self.upload_chunk_size:
+            return self._uploadResumable(path, content, resource_id, etag, upload_link)
+        ms = gdata.data.MediaSource(file_path=path, content_type=MIMETYPES['ODT'])
+        request = atom.http_core.HttpRequest(headers={'If-Match': etag})
+        return self.client.request(method='PUT', uri=media_link, http_request=request,
+                                   media_source=ms, desired_class=gdata.docs.data.DocsEntry)
+        
+    def _uploadResumable(self, path, content, resource_id, etag, upload_link):
+        """
+        Send the file a chunk at a time. The session uri is kept in the db, so
+        when a chunk fails, or the daemon is restarted, the upload carries on
+        from whatever the server already has instead of starting over.
+        """
+        content_hash, size = content[:2]
+        f = open(path, 'rb')
+        try:
+            uploader = gdata.client.ResumableUploader(self.client, f, MIMETYPES['ODT'], size,
+                chunk_size=self.upload_chunk_size, desired_class=gdata.docs.data.DocsEntry)
+            
+            # a session is only any good for the same content it was started with
+            session = self.db.getUpload(path)
+            if session and session[1] == content_hash:
+                print 'resuming upload: %s' % path
+                upload_uri, start_byte = session[0], None
+            else:
+                upload_uri, start_byte = self._startUpload(uploader, path, content_hash, etag, upload_link), 0
+            
+            failures = 0
+            while True:
+                try:
+                    new_version = uploader.ResumeUpload(upload_uri, start_byte)
+                    break
+                except gdata.client.RequestError, e:
+                    if e.status in (404, 410) and start_byte is None:
+                        # the server forgot the session, start a new one
+                        upload_uri, start_byte = self._startUpload(uploader, path, content_hash, etag, upload_link), 0
+                        continue
+                    if e.status is not None and 400 <= e.status < 500:
+                        raise
+                    error = e
+                except gdata.client.Unauthorized:
+                    raise
+                except Exception, e:
+                    error = e
+                failures += 1
+                if failures > self.upload_retries:
+                    raise error
+                print 'upload of %s failed, resuming: %s' % (path, error)
+                # ask the server how much it got
+                start_byte = None
+        finally:
+            f.close()
+        
+        self.db.clearUpload(path)
+        if new_version is True:
+            # the server had it all, we just never saw its reply
+            new_version = self.client.GetDoc(resource_id.replace(':', '%3A'))
+        return new_version
+        
+    def _startUpload(self, uploader, path, content_hash, etag, upload_link):
+        upload_uri = uploader.StartUpdate(upload_link, headers={'If-Match': etag})
+        self.db.setUpload(path, upload_uri, content_hash)
+        return upload_uri
+        
+class UploadQueue(object):
+    """
+    Collects local changes from the watcher and uploads them on a worker
+    thread, so the notifier never waits on the network. Events are coalesced
+    by path: a file is only uploaded once it has gone quiet, i.e. no
+    IN_MODIFY for quiet_period seconds. IN_CLOSE_WRITE means the writer is
+    done, so it only waits close_delay in case another write follows. An
+    editor saving a file therefore causes one upload, not one per write.
+    """
+    
+    quiet_period = 2.0
+    close_delay = 0.5
+    
+    def __init__(self, syncer):
+        self.syncer = syncer
+        self.due = {} # path -> when to upload it
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+        
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+            
+    def modified(self, path):
+        """
+        The file is being written to. Push its upload back until it's quiet.
+        """
+        self._schedule(path, self.quiet_period)
+        
+    def closed(self, path):
+        """
+        The file was closed after writing. Upload it shortly.
+        """
+        self._schedule(path, self.close_delay)
+        
+    def _schedule(self, path, delay):
+        self.cond.acquire()
+        try:
+            self.due[path] = time.time() + delay
+            self.cond.notify()
+        finally:
+            self.cond.release()
+            
+    def _next(self):
+        """
+        Wait for the next path that's due and return it, or None once stopped.
+        """
+        self.cond.acquire()
+        try:
+            while not self.stopped:
+                if not self.due:
+                    self.cond.wait()
+                    continue
+                path = min(self.due, key=self.due.get)
+                wait = self.due[path] - time.time()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                del self.due[path]
+                return path
+            return None
+        finally:
+            self.cond.release()
+            
+    def _run(self):
+        while True:
+            path = self._next()
+            if path is None:
+                return
+            try:
+                self.syncer.db.setDb(self.syncer.db_file)
+                self.syncer.updateDoc(path)
+            except Exception, error:
+                print 'upload failed: %s (%s)' % (path, error)
         
 class EventHandler(pyinotify.ProcessEvent):
     """
     Houses all methods that respond to specific pyinotify events.
     """
-    def __init__(self, syncer):
+    def __init__(self, syncer, uploads):
         pyinotify.ProcessEvent.__init__(self)
         self.syncer = syncer
-
-    def runCommand(self, event):
-        self.syncer.db.setDb(self.syncer.db_file)
-        self.syncer.updateDoc(event.path + '/' + event.name)
+        self.uploads = uploads
 
     def process_IN_MODIFY(self, event):
-        self.runCommand(event)
+        self.uploads.modified(event.path + '/' + event.name)
         
     def process_IN_CLOSE_WRITE(self, event):
-        self.runCommand(event)
+        self.uploads.closed(event.path + '/' + event.name)
         
 class SyncDaemon(Daemon):
     """
@@ -426,6 +1643,35 @@ if __name__ == "__main__":
     parser.add_argument('-x', '--exact',
                         action='store_true',
                         help='Always used with --file. Tells Watcher to force exact filename matches')
+    parser.add_argument('-w', '--workers',
+                        action='store',
+                        type=int,
+                        default=DocSync.crawl_workers,
+                        help='How many folders to list from the server at once')
+    parser.add_argument('--flat',
+                        action='store_true',
+                        help='List the whole doclist in a few large pages instead of folder by folder')
+    parser.add_argument('--downloads',
+                        action='store',
+                        type=int,
+                        default=DocSync.download_workers,
+                        help='How many documents to download at once')
+    parser.add_argument('--full',
+                        action='store_true',
+                        help='List everything on the server instead of only what changed since the last sync')
+    parser.add_argument('--poll',
+                        action='store',
+                        type=int,
+                        default=DocSync.poll_interval,
+                        help='Seconds between checks for remote changes while watching (0 to never check)')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Fetch every feed in full instead of revalidating cached copies')
+    parser.add_argument('--chunk-size',
+                        action='store',
+                        type=int,
+                        default=DocSync.upload_chunk_size / (1024 * 1024),
+                        help='Upload files bigger than this many MB in chunks of this size')
                         
     parser.add_argument('--username',
                         action='store',
@@ -437,6 +1683,13 @@ if __name__ == "__main__":
                         help='Set the password')
     
     args = parser.parse_args()
+    DocSync.crawl_workers = args.workers
+    DocSync.flat_listing = args.flat
+    DocSync.download_workers = args.downloads
+    DocSync.incremental = not args.full
+    DocSync.poll_interval = args.poll
+    DocSync.upload_chunk_size = args.chunk_size * 1024 * 1024
+    DocSync.cache_feeds = not args.no_cache
     
     # Execute the command
     if args.daemon:
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import StringIO
+import gzip
+import zlib
+import atom.http_core
+import atom.async_http_core
+import gdata.docs.client
+from scripted_server import ScriptedServer, response
+
+
+CHUNKED = ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+           '5\r\nhello\r\n7;name=value\r\n, world\r\n0\r\n'
+           'X-Trailer: yes\r\n\r\n')
+
+
+def gzipped(data):
+  buffer = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buffer, mode='wb')
+  f.write(data)
+  f.close()
+  return buffer.getvalue()
+
+
+class ResponseParserTest(unittest.TestCase):
+
+  def feed_bytewise(self, data, method='GET'):
+    parser = atom.async_http_core._ResponseParser(method)
+    for i in xrange(len(data)):
+      done = parser.feed(data[i])
+      self.assertEqual(done, i == len(data) - 1)
+    return parser.response()
+
+  def test_content_length(self):
+    response = self.feed_bytewise(
+        'HTTP/1.1 200 OK\r\nContent-Length: 5\r\nX-Name: a: b\r\n\r\nhello')
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.reason, 'OK')
+    self.assertEqual(response.getheader('x-name'), 'a: b')
+    self.assertEqual(response.read(), 'hello')
+
+  def test_chunked(self):
+    response = self.feed_bytewise(CHUNKED)
+    self.assertEqual(response.read(), 'hello, world')
+    self.assertEqual(response.getheader('X-Trailer'), None)
+
+  def test_chunked_without_trailers(self):
+    response = self.feed_bytewise('HTTP/1.1 200 OK\r\n'
+        'Transfer-Encoding: chunked\r\n\r\na\r\n0123456789\r\n0\r\n\r\n')
+    self.assertEqual(response.read(), '0123456789')
+
+  def test_continue_is_skipped(self):
+    response = self.feed_bytewise('HTTP/1.1 100 Continue\r\n\r\n'
+        'HTTP/1.1 201 Created\r\nContent-Length: 2\r\n\r\nok')
+    self.assertEqual(response.status, 201)
+    self.assertEqual(response.read(), 'ok')
+
+  def test_head_has_no_body(self):
+    response = self.feed_bytewise(
+        'HTTP/1.1 200 OK\r\nContent-Length: 500\r\n\r\n', 'HEAD')
+    self.assertEqual(response.read(), '')
+
+  def test_keep_alive(self):
+    for head, keep_alive in (('HTTP/1.1 200 OK', True),
+                             ('HTTP/1.1 200 OK\r\nConnection: close', False),
+                             ('HTTP/1.0 200 OK', False),
+                             ('HTTP/1.0 200 OK\r\nConnection: Keep-Alive', True)):
+      parser = atom.async_http_core._ResponseParser('GET')
+      self.assertTrue(parser.feed(head + '\r\nContent-Length: 0\r\n\r\n'))
+      self.assertEqual(parser.keep_alive, keep_alive)
+
+  def test_body_until_close(self):
+    parser = atom.async_http_core._ResponseParser('GET')
+    self.assertFalse(parser.feed('HTTP/1.1 200 OK\r\n\r\nall of'))
+    self.assertFalse(parser.feed(' it'))
+    self.assertTrue(parser.feed(''))
+    self.assertFalse(parser.keep_alive)
+    self.assertEqual(parser.response().read(), 'all of it')
+
+  def test_gzip(self):
+    body = gzipped('compressed ' * 100)
+    parser = atom.async_http_core._ResponseParser('GET')
+    parser.feed('HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n'
+                'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+    response = parser.response()
+    self.assertEqual(response.read(), 'compressed ' * 100)
+    self.assertEqual(response.getheader('Content-Encoding'), None)
+    self.assertEqual(response.getheader('Content-Length'), None)
+
+
+class AsyncHttpClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = atom.async_http_core.AsyncHttpClient()
+    self.client.timeout = 10
+    self.server = None
+
+  def tearDown(self):
+    self.client.close()
+    if self.server is not None:
+      self.server.close()
+
+  def request(self, method, path, body=None):
+    request = atom.http_core.HttpRequest(self.server.url(path), method)
+    if body is not None:
+      request.add_body_part(body, 'text/plain')
+    return request
+
+  def send(self, method, path, body=None):
+    return self.client.request(self.request(method, path, body)).read()
+
+  def connections_used(self):
+    return [request[3] for request in self.server.requests]
+
+  def test_content_length_body(self):
+    self.server = ScriptedServer([response('x' * 200000)])
+    self.assertEqual(self.send('GET', '/big'), 'x' * 200000)
+
+  def test_request_body_is_sent(self):
+    self.server = ScriptedServer([response('created')])
+    self.assertEqual(self.send('POST', '/new', 'a' * 100000), 'created')
+    self.assertEqual(self.server.requests[0][:3], ('POST', '/new', 'a' * 100000))
+
+  def test_chunked_body(self):
+    self.server = ScriptedServer([CHUNKED, response('next')])
+    self.assertEqual(self.send('GET', '/chunked'), 'hello, world')
+    # The whole chunked body was read, so the connection can be used again.
+    self.assertEqual(self.send('GET', '/next'), 'next')
+    self.assertEqual(self.connections_used(), [1, 1])
+
+  def test_gzip_body(self):
+    self.server = ScriptedServer([
+        response(gzipped('gzip ' * 1000), headers={'Content-Encoding': 'gzip'}),
+        response(zlib.compress('deflate ' * 1000),
+                 headers={'Content-Encoding': 'deflate'})])
+    self.assertEqual(self.send('GET', '/gzip'), 'gzip ' * 1000)
+    self.assertEqual(self.send('GET', '/deflate'), 'deflate ' * 1000)
+
+  def test_keep_alive_reuse(self):
+    self.server = ScriptedServer([response('one'), response('two'),
+                                  response('three')])
+    for path, body in (('/1', 'one'), ('/2', 'two'), ('/3', 'three')):
+      self.assertEqual(self.send('GET', path), body)
+    self.assertEqual(self.connections_used(), [1, 1, 1])
+
+  def test_connection_close_is_not_reused(self):
+    self.server = ScriptedServer([
+        ('HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 3\r\n\r\none',
+         True),
+        response('two')])
+    self.assertEqual(self.send('GET', '/1'), 'one')
+    self.assertEqual(self.send('GET', '/2'), 'two')
+    self.assertEqual(self.connections_used(), [1, 2])
+
+  def test_idle_connection_closed_by_server(self):
+    self.server = ScriptedServer([(response('one'), True), response('two')])
+    self.assertEqual(self.send('GET', '/1'), 'one')
+    self.assertEqual(self.send('GET', '/2'), 'two')
+    self.assertEqual(self.connections_used(), [1, 2])
+
+  def test_many_requests_at_once(self):
+    self.server = ScriptedServer([response('same')] * 20)
+    futures = [self.client.request_async(self.request('GET', '/%d' % i))
+               for i in range(20)]
+    self.client.run()
+    self.assertEqual([future.result().read() for future in futures],
+                     ['same'] * 20)
+    self.assertTrue(self.server.connections <= self.client.max_per_host)
+
+  def test_connection_closed_early(self):
+    self.server = ScriptedServer([
+        ('HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nonly some', True)])
+    self.assertRaises(atom.http_core.Error, self.send, 'GET', '/cut')
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_chunked_body_closed_early(self):
+    self.server = ScriptedServer([(CHUNKED[:60], True)])
+    self.assertRaises(atom.http_core.Error, self.send, 'GET', '/cut')
+
+  def test_get_is_sent_again_when_reused_connection_drops(self):
+    self.server = ScriptedServer([response('one'), None, response('two')])
+    self.send('GET', '/1')
+    self.assertEqual(self.send('GET', '/2'), 'two')
+    self.assertEqual(self.connections_used(), [1, 1, 2])
+
+  def test_post_is_not_sent_twice(self):
+    self.server = ScriptedServer([response('one'), None, response('two')])
+    self.send('GET', '/1')
+    self.assertRaises(atom.http_core.Error, self.send, 'POST', '/new', 'entry')
+    self.assertEqual(len(self.server.requests), 2)
+
+  def test_works_as_a_client_http_client(self):
+    feed = ('<feed xmlns="http://www.w3.org/2005/Atom"><id>list</id>'
+            '<entry><id>one</id><title>First</title></entry></feed>')
+    self.server = ScriptedServer([response(
+        feed, headers={'Content-Type': 'application/atom+xml'})])
+    client = gdata.docs.client.DocsClient(source='test',
+                                          http_client=self.client)
+    client.ssl = False
+    feed = client.GetDocList(uri=self.server.url('/feeds/default/private/full'))
+    self.assertEqual([entry.title.text for entry in feed.entry], ['First'])
+
+  def test_new_connection_is_not_retried(self):
+    self.server = ScriptedServer([None, response('never')])
+    self.assertRaises(atom.http_core.Error, self.send, 'GET', '/1')
+    self.assertEqual(len(self.server.requests), 1)
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(ResponseParserTest, 'test'),
+      unittest.makeSuite(AsyncHttpClientTest, 'test')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import atom.http_core
+import atom.cache_http_core
+
+
+class EtagServer(object):
+  """An http_client serving one XML body per path, with an ETag."""
+
+  def __init__(self, bodies):
+    self.bodies = bodies
+    self.requests = []
+
+  def request(self, http_request):
+    self.requests.append(http_request)
+    path = http_request.uri.path
+    etag = '"%d"' % len(self.bodies[path])
+    headers = {'ETag': etag, 'Content-Type': 'application/atom+xml'}
+    if http_request.headers.get('If-None-Match') == etag:
+      return atom.http_core.HttpResponse(304, 'Not Modified', headers, '')
+    return atom.http_core.HttpResponse(200, 'OK', headers,
+                                       self.bodies[path])
+
+
+class CachingHttpClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = EtagServer({'/feed': '<feed>' + 'x' * 1000 + '</feed>'})
+    self.cache = atom.cache_http_core.HttpCache(max_bytes=4096)
+    self.client = atom.cache_http_core.CachingHttpClient(self.server,
+                                                         self.cache)
+
+  def get(self, path):
+    return self.client.request(
+        atom.http_core.HttpRequest('http://example.com' + path, 'GET'))
+
+  def test_unchanged_feed_comes_from_cache(self):
+    body = self.get('/feed').read()
+    response = self.get('/feed')
+    self.assertTrue(response.from_cache)
+    self.assertEqual(response.read(), body)
+    self.assertEqual(self.server.requests[1].headers['If-None-Match'],
+                     '"1013"')
+
+  def test_body_streams_through(self):
+    response = self.get('/feed')
+    self.assertFalse(response.from_cache)
+    self.assertEqual(response.read(10), '<feed>xxxx')
+    # Nothing is stored until the body has been read to the end.
+    self.assertEqual(self.cache.size, 0)
+    while response.read(100):
+      pass
+    self.assertEqual(self.cache.size, 1013)
+    self.assertTrue(self.get('/feed').from_cache)
+
+  def parse(self, path):
+    response = self.get(path)
+    response.read()
+    response.parsed_objects['feed'] = 'parsed'
+
+  def test_parsed_objects_are_kept(self):
+    self.cache.max_bytes = 16384
+    self.parse('/feed')
+    self.assertEqual(self.get('/feed').parsed_objects, {'feed': 'parsed'})
+    cost = atom.cache_http_core.PARSED_OBJECT_COST
+    self.assertEqual(self.cache.size, 1013 * (1 + cost))
+
+  def test_parsed_objects_count_against_max_bytes(self):
+    self.cache.max_bytes = 20000
+    for path in ('/a', '/b', '/c'):
+      self.server.bodies[path] = self.server.bodies['/feed']
+    self.parse('/a')
+    self.parse('/b')
+    cost = atom.cache_http_core.PARSED_OBJECT_COST
+    self.assertEqual(self.cache.size, 2 * 1013 * (1 + cost))
+    # Parsing a third pushes out the least recently used.
+    self.parse('/c')
+    self.assertTrue(self.cache.size <= 20000)
+    self.assertFalse(self.get('/a').from_cache)
+    self.assertTrue(self.get('/c').from_cache)
+
+  def test_parsed_objects_too_big_for_the_cache_are_dropped(self):
+    self.parse('/feed')
+    response = self.get('/feed')
+    # The body is still cached, it just has to be parsed again.
+    self.assertTrue(response.from_cache)
+    self.assertEqual(response.parsed_objects, {})
+    self.assertEqual(self.cache.size, 1013)
+
+  def test_body_bigger_than_cache_is_not_kept(self):
+    self.server.bodies['/big'] = '<feed>' + 'x' * 5000 + '</feed>'
+    response = self.get('/big')
+    while response.read(1000):
+      pass
+    self.assertEqual(self.cache.size, 0)
+    self.assertFalse(self.get('/big').from_cache)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def entry(self, size):
+    return atom.cache_http_core._Entry('"e"', 200, 'OK', [], 'x' * size)
+
+  def disk_size(self):
+    return sum([os.path.getsize(os.path.join(self.cache_dir, name))
+                for name in os.listdir(self.cache_dir)])
+
+  def test_disk_is_bounded(self):
+    cache = atom.cache_http_core.HttpCache(0, self.cache_dir,
+                                           max_disk_bytes=10000)
+    for i in range(50):
+      cache.put(('/feed%d' % i, None), self.entry(1000))
+      self.assertTrue(self.disk_size() <= 10000)
+    # The most recently written entries are the ones kept.
+    self.assertNotEqual(cache.get(('/feed49', None)), None)
+    self.assertEqual(cache.get(('/feed0', None)), None)
+
+  def test_recently_read_entries_are_kept(self):
+    cache = atom.cache_http_core.HttpCache(0, self.cache_dir,
+                                           max_disk_bytes=10000)
+    cache.put(('/first', None), self.entry(1000))
+    for i in range(5):
+      cache.put(('/feed%d' % i, None), self.entry(1000))
+    self.assertNotEqual(cache.get(('/first', None)), None)
+    for i in range(5, 10):
+      cache.put(('/feed%d' % i, None), self.entry(1000))
+    self.assertEqual(cache.get(('/feed0', None)), None)
+    self.assertNotEqual(cache.get(('/first', None)), None)
+
+  def test_expired_entries_are_dropped(self):
+    cache = atom.cache_http_core.HttpCache(0, self.cache_dir, max_age=60)
+    cache.put(('/old', None), self.entry(10))
+    cache.put(('/new', None), self.entry(10))
+    old = time.time() - 120
+    os.utime(cache._path(('/old', None)), (old, old))
+    self.assertEqual(cache.get(('/old', None)), None)
+    self.assertNotEqual(cache.get(('/new', None)), None)
+    self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+  def test_cache_outlives_process(self):
+    cache = atom.cache_http_core.HttpCache(0, self.cache_dir)
+    cache.put(('/feed', None), self.entry(10))
+    cache = atom.cache_http_core.HttpCache(0, self.cache_dir)
+    self.assertEqual(cache.get(('/feed', None)).body, 'x' * 10)
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(CachingHttpClientTest, 'test'),
+      unittest.makeSuite(DiskCacheTest, 'test')))
+
+
+if __name__ == '__main__':
+  unittest.main()
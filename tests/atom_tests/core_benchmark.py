@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+"""Times parsing and serializing large feeds with atom.core.GENERATE_CODE
+off and on.
+
+Run it from this directory with the repository on PYTHONPATH:
+
+  PYTHONPATH=../.. python core_benchmark.py [entries] [runs]
+
+Each time printed is the best of the runs, 10 unless given.
+"""
+
+
+import sys
+import time
+import atom.core
+import gdata.contacts.data
+import gdata.docs.data
+
+
+DOC = (
+    '<entry gd:etag="&quot;e%(i)d&quot;">'
+    '<id>https://docs.google.com/feeds/id/document%%3A%(i)d</id>'
+    '<published>2011-01-01T00:00:00.000Z</published>'
+    '<updated>2011-01-01T00:00:00.000Z</updated>'
+    '<app:edited>2011-01-01T00:00:00.000Z</app:edited>'
+    '<category scheme="http://schemas.google.com/g/2005#kind"'
+    ' term="http://schemas.google.com/docs/2007#document" label="document"/>'
+    '<category scheme="http://schemas.google.com/g/2005/labels"'
+    ' term="http://schemas.google.com/g/2005/labels#viewed" label="viewed"/>'
+    '<title>Doc %(i)d</title>'
+    '<content type="text/html" src="https://docs.google.com/feeds/download/'
+    'documents/Export?docId=%(i)d"/>'
+    '<link rel="http://schemas.google.com/docs/2007#parent"'
+    ' type="application/atom+xml" href="https://docs.google.com/feeds/'
+    'default/private/full/folder%%3Af1" title="Folder"/>'
+    '<link rel="alternate" type="text/html"'
+    ' href="https://docs.google.com/document/d/%(i)d/edit"/>'
+    '<link rel="edit" type="application/atom+xml" href="https://docs.google'
+    '.com/feeds/default/private/full/document%%3A%(i)d"/>'
+    '<link rel="edit-media" type="text/html" href="https://docs.google.com/'
+    'feeds/default/media/document%%3A%(i)d"/>'
+    '<author><name>someone</name><email>someone@example.com</email></author>'
+    '<gd:resourceId>document:%(i)d</gd:resourceId>'
+    '<gd:lastModifiedBy><name>someone</name>'
+    '<email>someone@example.com</email></gd:lastModifiedBy>'
+    '<gd:lastViewed>2011-01-02T00:00:00.000Z</gd:lastViewed>'
+    '<gd:quotaBytesUsed>0</gd:quotaBytesUsed>'
+    '<docs:writersCanInvite value="true"/>'
+    '<gd:feedLink rel="http://schemas.google.com/acl/2007#accessControlList"'
+    ' href="https://docs.google.com/feeds/default/private/full/'
+    'document%%3A%(i)d/acl"/>'
+    '</entry>')
+
+CONTACT = (
+    '<entry gd:etag="&quot;c%(i)d&quot;">'
+    '<id>http://www.google.com/m8/feeds/contacts/u/base/%(i)d</id>'
+    '<updated>2011-01-01T00:00:00.000Z</updated>'
+    '<app:edited>2011-01-01T00:00:00.000Z</app:edited>'
+    '<category scheme="http://schemas.google.com/g/2005#kind"'
+    ' term="http://schemas.google.com/contact/2008#contact"/>'
+    '<title>Person %(i)d</title>'
+    '<link rel="edit" type="application/atom+xml"'
+    ' href="https://www.google.com/m8/feeds/contacts/u/full/%(i)d"/>'
+    '<gd:name><gd:fullName>Person %(i)d</gd:fullName>'
+    '<gd:givenName>Person</gd:givenName>'
+    '<gd:familyName>%(i)d</gd:familyName></gd:name>'
+    '<gd:email rel="http://schemas.google.com/g/2005#home"'
+    ' address="p%(i)d@example.com" primary="true"/>'
+    '<gd:email rel="http://schemas.google.com/g/2005#work"'
+    ' address="w%(i)d@example.com"/>'
+    '<gd:phoneNumber rel="http://schemas.google.com/g/2005#mobile">'
+    '+1 555 %(i)d</gd:phoneNumber>'
+    '<gd:structuredPostalAddress rel="http://schemas.google.com/g/2005#home">'
+    '<gd:formattedAddress>1 Street %(i)d</gd:formattedAddress>'
+    '<gd:street>1 Street</gd:street><gd:city>Town</gd:city>'
+    '</gd:structuredPostalAddress>'
+    '<gd:organization rel="http://schemas.google.com/g/2005#work">'
+    '<gd:orgName>Org</gd:orgName><gd:orgTitle>Title</gd:orgTitle>'
+    '</gd:organization>'
+    '<gContact:groupMembershipInfo deleted="false"'
+    ' href="http://www.google.com/m8/feeds/groups/u/base/6"/>'
+    '<gContact:website href="http://example.com/%(i)d" rel="home"/>'
+    '</entry>')
+
+FEED = ('<feed xmlns="http://www.w3.org/2005/Atom"'
+        ' xmlns:app="http://www.w3.org/2007/app"'
+        ' xmlns:gd="http://schemas.google.com/g/2005"'
+        ' xmlns:docs="http://schemas.google.com/docs/2007"'
+        ' xmlns:gContact="http://schemas.google.com/contact/2008">'
+        '<id>feed</id><title>Feed</title>'
+        '<link rel="next" href="http://example.com/next"/>%s</feed>')
+
+
+def timed(function):
+  started = time.time()
+  result = function()
+  return time.time() - started, result
+
+
+def compare(name, xml, cls, runs):
+  """Prints the best times with GENERATE_CODE off and on. The two settings
+  take turns, so a machine getting busier slows both alike. to_string is
+  timed on a freshly parsed feed, so with LAZY_CHILDREN it includes
+  converting the members."""
+  parse_times = {False: [], True: []}
+  string_times = {False: [], True: []}
+  outputs = {}
+  for i in range(runs):
+    for generate_code in (False, True):
+      atom.core.GENERATE_CODE = generate_code
+      taken, feed = timed(lambda: atom.core.parse(xml, cls, 2))
+      parse_times[generate_code].append(taken)
+      feed = atom.core.parse(xml, cls, 2)
+      taken, outputs[generate_code] = timed(lambda: feed.to_string(2))
+      string_times[generate_code].append(taken)
+  generic_parse, parse = min(parse_times[False]), min(parse_times[True])
+  generic_string, string = min(string_times[False]), min(string_times[True])
+  print ('%-12s parse %.3fs -> %.3fs (%.2fx)  '
+         'to_string %.3fs -> %.3fs (%.2fx)') % (
+      name, generic_parse, parse, generic_parse / parse,
+      generic_string, string, generic_string / string)
+  if outputs[False] != outputs[True]:
+    print '%-12s the XML written differs' % name
+
+
+def main():
+  entries = 1000
+  runs = 10
+  if len(sys.argv) > 1:
+    entries = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    runs = int(sys.argv[2])
+  docs = FEED % ''.join([DOC % {'i': i} for i in range(entries)])
+  contacts = FEED % ''.join([CONTACT % {'i': i} for i in range(entries)])
+  saved = atom.core.GENERATE_CODE
+  try:
+    for compact_members, lazy_children in ((False, False), (True, True)):
+      atom.core.COMPACT_MEMBERS = compact_members
+      atom.core.LAZY_CHILDREN = lazy_children
+      print 'COMPACT_MEMBERS=%s LAZY_CHILDREN=%s, %d entries' % (
+          compact_members, lazy_children, entries)
+      compare('DocList', docs, gdata.docs.data.DocList, runs)
+      compare('ContactsFeed', contacts, gdata.contacts.data.ContactsFeed,
+              runs)
+  finally:
+    atom.core.GENERATE_CODE = saved
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import copy
+import pickle
+import sys
+import threading
+import atom.core
+import atom.data
+import gdata.docs.data
+
+
+FEED = ('<feed xmlns="http://www.w3.org/2005/Atom"><id>feed</id>%s</feed>'
+        % ''.join(['<entry><id>%d</id><title>Entry %d</title>'
+                   '<category term="a"/><category term="b"/>'
+                   '<link rel="alternate" href="http://example.com/%d"/>'
+                   '<other xmlns="http://example.com/ns">x</other></entry>'
+                   % (i, i, i) for i in range(20)]))
+
+
+class LazyChildrenTest(unittest.TestCase):
+
+  def setUp(self):
+    self.saved = (atom.core.COMPACT_MEMBERS, atom.core.LAZY_CHILDREN)
+    atom.core.COMPACT_MEMBERS = True
+    atom.core.LAZY_CHILDREN = True
+
+  def tearDown(self):
+    atom.core.COMPACT_MEMBERS, atom.core.LAZY_CHILDREN = self.saved
+
+  def test_members_are_converted_when_read(self):
+    entry = atom.core.parse(FEED, atom.data.Feed).entry[3]
+    self.assertTrue('_lazy' in entry.__dict__)
+    self.assertEqual(entry.title.text, 'Entry 3')
+    self.assertEqual([category.term for category in entry.category],
+                     ['a', 'b'])
+    self.assertEqual(len(entry.extension_elements), 1)
+
+  def test_threads_reading_one_entry(self):
+    interval = sys.getcheckinterval()
+    # Switch threads as often as possible.
+    sys.setcheckinterval(1)
+    try:
+      for attempt in range(50):
+        entries = atom.core.parse(FEED, atom.data.Feed).entry
+        seen = []
+
+        def read(entry):
+          seen.append((entry.title and entry.title.text, len(entry.category)))
+
+        for entry in entries:
+          threads = [threading.Thread(target=read, args=(entry,))
+                     for i in range(8)]
+          for thread in threads:
+            thread.start()
+          for thread in threads:
+            thread.join()
+        for i, entry in enumerate(entries):
+          self.assertEqual(seen[i * 8:i * 8 + 8], [('Entry %d' % i, 2)] * 8)
+    finally:
+      sys.setcheckinterval(interval)
+
+  def test_pickle(self):
+    feed = atom.core.parse(FEED, atom.data.Feed)
+    feed.entry[0].title.text
+    for protocol in (0, 2):
+      copied = pickle.loads(pickle.dumps(feed, protocol))
+      self.assertEqual(copied.to_string(), feed.to_string())
+      self.assertEqual(copied.entry[5].title.text, 'Entry 5')
+
+  def test_copy(self):
+    entry = atom.core.parse(FEED, atom.data.Feed).entry[1]
+    self.assertEqual(copy.deepcopy(entry).to_string(), entry.to_string())
+    self.assertEqual(copy.copy(entry).title.text, 'Entry 1')
+
+  def test_same_xml_as_eager_parse(self):
+    lazy = atom.core.parse(FEED, atom.data.Feed).to_string()
+    atom.core.LAZY_CHILDREN = False
+    self.assertEqual(atom.core.parse(FEED, atom.data.Feed).to_string(), lazy)
+
+
+class GeneratedLazyChildrenTest(LazyChildrenTest):
+  """The same tests, with the parsers generated for each class."""
+
+  def setUp(self):
+    LazyChildrenTest.setUp(self)
+    self.generate_code = atom.core.GENERATE_CODE
+    atom.core.GENERATE_CODE = True
+
+  def tearDown(self):
+    atom.core.GENERATE_CODE = self.generate_code
+    LazyChildrenTest.tearDown(self)
+
+
+DOCLIST = ('<feed xmlns="http://www.w3.org/2005/Atom"'
+           ' xmlns:gd="http://schemas.google.com/g/2005"'
+           ' xmlns:docs="http://schemas.google.com/docs/2007">'
+           '<id>docs</id>%s</feed>'
+           % ''.join(['<entry gd:etag="&quot;e%d&quot;"><id>%d</id>'
+                      '<title>Doc %d</title><author><name>Ann</name></author>'
+                      '<gd:resourceId>document:%d</gd:resourceId>'
+                      '<docs:writersCanInvite value="true"/>'
+                      '<gd:feedLink rel="acl" href="http://example.com/%d"/>'
+                      '</entry>' % (i, i, i, i, i) for i in range(5)]))
+
+
+class GeneratedCodeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.saved = (atom.core.GENERATE_CODE, atom.core.COMPACT_MEMBERS,
+                  atom.core.LAZY_CHILDREN)
+
+  def tearDown(self):
+    (atom.core.GENERATE_CODE, atom.core.COMPACT_MEMBERS,
+     atom.core.LAZY_CHILDREN) = self.saved
+
+  def round_trip(self, xml, cls, version):
+    parsed = atom.core.parse(xml, cls, version)
+    return parsed.to_string(version), parsed.entry[2].title.text
+
+  def test_same_as_generic_methods(self):
+    for compact in (False, True):
+      for lazy in (False, True):
+        atom.core.COMPACT_MEMBERS = compact
+        atom.core.LAZY_CHILDREN = lazy
+        for xml, cls in ((FEED, atom.data.Feed),
+                         (DOCLIST, gdata.docs.data.DocList)):
+          for version in (1, 2):
+            atom.core.GENERATE_CODE = False
+            generic = self.round_trip(xml, cls, version)
+            atom.core.GENERATE_CODE = True
+            self.assertEqual(self.round_trip(xml, cls, version), generic)
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(LazyChildrenTest, 'test'),
+      unittest.makeSuite(GeneratedLazyChildrenTest, 'test'),
+      unittest.makeSuite(GeneratedCodeTest, 'test'),))
+
+
+if __name__ == '__main__':
+  unittest.main()
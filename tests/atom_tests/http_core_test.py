@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import httplib
+import socket
+import gzip
+import zlib
+import StringIO
+import atom.http_core
+from scripted_server import ScriptedServer, response
+
+
+class ReusedConnectionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.client = atom.http_core.HttpClient()
+    self.client.connection_pool = atom.http_core.ConnectionPool()
+    self.client.accept_encoding = None
+
+  def tearDown(self):
+    self.client.connection_pool.clear()
+    self.server.close()
+
+  def send(self, method, path, body=None):
+    request = atom.http_core.HttpRequest(self.server.url(path), method)
+    if body is not None:
+      request.add_body_part(body, 'text/plain')
+    return self.client.request(request).read()
+
+  def test_connection_is_reused(self):
+    self.server = ScriptedServer([response('one'), response('two')])
+    self.assertEqual(self.send('GET', '/a'), 'one')
+    self.assertEqual(self.send('GET', '/b'), 'two')
+    self.assertEqual(self.server.connections, 1)
+
+  def test_get_is_sent_again_when_reused_connection_drops(self):
+    self.server = ScriptedServer([response('one'), None, response('two')])
+    self.send('GET', '/a')
+    self.assertEqual(self.send('GET', '/b'), 'two')
+    self.assertEqual([(r[0], r[1], r[3]) for r in self.server.requests],
+                     [('GET', '/a', 1), ('GET', '/b', 1), ('GET', '/b', 2)])
+
+  def test_post_is_not_sent_twice(self):
+    self.server = ScriptedServer([response('one'), None, response('two')])
+    self.send('GET', '/a')
+    self.assertRaises((socket.error, httplib.HTTPException),
+                      self.send, 'POST', '/create', 'new entry')
+    self.assertEqual([(r[0], r[1]) for r in self.server.requests],
+                     [('GET', '/a'), ('POST', '/create')])
+
+  def test_put_is_not_sent_twice(self):
+    self.server = ScriptedServer([response('one'), None, response('two')])
+    self.send('GET', '/a')
+    self.assertRaises((socket.error, httplib.HTTPException),
+                      self.send, 'PUT', '/chunk', 'bytes 0-8')
+    self.assertEqual(len(self.server.requests), 2)
+
+
+def gzipped(data):
+  buf = StringIO.StringIO()
+  f = gzip.GzipFile(fileobj=buf, mode='wb')
+  f.write(data)
+  f.close()
+  return buf.getvalue()
+
+
+class DecodedResponseTest(unittest.TestCase):
+
+  # Enough text, not too repetitive, to span several reads of the body.
+  text = ''.join(['line %i of the body\n' % i for i in range(5000)])
+
+  def decoded(self, body, encoding, length=None):
+    headers = {'Content-Encoding': encoding, 'Content-Type': 'text/plain',
+               'Content-Length': str(length or len(body))}
+    return atom.http_core.decode_response(
+        atom.http_core.HttpResponse(200, 'OK', headers, body))
+
+  def test_gzip_body_is_decompressed(self):
+    response = self.decoded(gzipped(self.text), 'gzip')
+    self.assertTrue(isinstance(response, atom.http_core.DecodedResponse))
+    self.assertEqual(response.read(), self.text)
+    self.assertEqual(response.read(), '')
+
+  def test_headers_describe_the_decoded_body(self):
+    response = self.decoded(gzipped(self.text), 'x-gzip')
+    self.assertEqual(response.getheader('Content-Encoding'), None)
+    self.assertEqual(response.getheader('Content-Length'), None)
+    self.assertEqual(response.getheader('Content-Type'), 'text/plain')
+    self.assertEqual(response.getheaders(), [('Content-Type', 'text/plain')])
+    self.assertEqual(response.status, 200)
+
+  def test_deflate_with_and_without_zlib_header(self):
+    self.assertEqual(
+        self.decoded(zlib.compress(self.text), 'deflate').read(), self.text)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    raw = compressor.compress(self.text) + compressor.flush()
+    self.assertEqual(self.decoded(raw, 'deflate').read(), self.text)
+
+  def test_plain_body_is_left_alone(self):
+    original = atom.http_core.HttpResponse(
+        200, 'OK', {'Content-Type': 'text/plain'}, self.text)
+    response = atom.http_core.decode_response(original)
+    self.assertTrue(response is original)
+    self.assertEqual(response.read(), self.text)
+
+  def test_partial_reads(self):
+    response = self.decoded(gzipped(self.text), 'gzip')
+    # Smaller than a chunk of compressed body, so most reads are answered
+    # from what is left over from the one before.
+    response.read_size = 512
+    pieces = []
+    while True:
+      piece = response.read(1000)
+      if not piece:
+        break
+      pieces.append(piece)
+    self.assertEqual(''.join(pieces), self.text)
+    self.assertEqual([len(piece) for piece in pieces[:-1]],
+                     [1000] * (len(pieces) - 1))
+    self.assertEqual(len(pieces[-1]), len(self.text) % 1000 or 1000)
+
+  def test_read_after_partial_read_returns_the_rest(self):
+    response = self.decoded(gzipped(self.text), 'gzip')
+    self.assertEqual(response.read(10), self.text[:10])
+    self.assertEqual(response.read(), self.text[10:])
+
+  def test_truncated_body_raises(self):
+    body = gzipped(self.text)
+    response = self.decoded(body[:len(body) / 2], 'gzip', length=len(body))
+    self.assertRaises(httplib.IncompleteRead, response.read)
+
+  def test_client_decodes_what_the_server_compressed(self):
+    server = ScriptedServer([
+        response(gzipped(self.text), headers={'Content-Encoding': 'gzip'})])
+    try:
+      client = atom.http_core.HttpClient()
+      client.connection_pool = atom.http_core.ConnectionPool()
+      request = atom.http_core.HttpRequest(server.url('/a'), 'GET')
+      self.assertEqual(client.request(request).read(), self.text)
+      client.connection_pool.clear()
+    finally:
+      server.close()
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(ReusedConnectionTest, 'test'),
+      unittest.makeSuite(DecodedResponseTest, 'test'),))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# A local HTTP server for the transport tests which answers with canned
+# bytes, so the tests can send exactly what a server might.
+
+
+import socket
+import threading
+
+
+def response(body, status='200 OK', headers=None):
+  """Builds a keep-alive response with a Content-Length."""
+  lines = ['HTTP/1.1 %s' % status, 'Content-Length: %d' % len(body)]
+  for name, value in (headers or {}).iteritems():
+    lines.append('%s: %s' % (name, value))
+  return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+class ScriptedServer(object):
+  """Answers each request with the next of the given responses.
+
+  Each response is sent as is. None closes the connection without answering
+  once the request has been read, as a server does when it drops an idle
+  keep-alive connection just as a request arrives. A (bytes, True) pair sends
+  the bytes and then closes the connection.
+  """
+
+  def __init__(self, responses):
+    self.responses = list(responses)
+    self.requests = []  # (method, path, body, connection number)
+    self.connections = 0
+    self._lock = threading.Lock()
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind(('127.0.0.1', 0))
+    self._sock.listen(5)
+    self.port = self._sock.getsockname()[1]
+    thread = threading.Thread(target=self._serve)
+    thread.setDaemon(True)
+    thread.start()
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+  def close(self):
+    self._sock.close()
+
+  def _serve(self):
+    while True:
+      try:
+        connection = self._sock.accept()[0]
+      except socket.error:
+        return
+      self._lock.acquire()
+      try:
+        self.connections += 1
+        number = self.connections
+      finally:
+        self._lock.release()
+      thread = threading.Thread(target=self._handle, args=(connection, number))
+      thread.setDaemon(True)
+      thread.start()
+
+  def _handle(self, connection, number):
+    stream = connection.makefile('rb')
+    try:
+      while True:
+        line = stream.readline()
+        if not line:
+          return
+        method, path = line.split()[:2]
+        headers = {}
+        while True:
+          line = stream.readline()
+          if line in ('\r\n', '\n', ''):
+            break
+          name, value = line.split(':', 1)
+          headers[name.strip().lower()] = value.strip()
+        body = stream.read(int(headers.get('content-length', 0)))
+        self._lock.acquire()
+        try:
+          self.requests.append((method, path, body, number))
+          answer = self.responses.pop(0)
+        finally:
+          self._lock.release()
+        if answer is None:
+          return
+        if isinstance(answer, tuple):
+          connection.sendall(answer[0])
+          return
+        connection.sendall(answer)
+    finally:
+      stream.close()
+      connection.close()
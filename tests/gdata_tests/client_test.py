@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import threading
+import time
+import StringIO
+import atom.mock_http_core
+import gdata.client
+import gdata.data
+
+
+UPLOAD_URI = 'http://example.com/upload/session1'
+ENTRY = ('<entry xmlns="http://www.w3.org/2005/Atom"><id>done</id>'
+         '<title>done</title></entry>')
+
+
+class ChunkServer(object):
+  """An http_client taking a resumable upload. It answers 308 to every chunk
+  until the last byte arrives, then returns the entry."""
+
+  def __init__(self, total, last=None, delay=0):
+    self.total = total
+    self.last = last or total - 1
+    self.delay = delay
+    self.ranges = []
+    self.body = ''
+    self.on_request = None
+
+  def request(self, http_request):
+    if self.on_request is not None:
+      self.on_request()
+    time.sleep(self.delay)
+    content_range = http_request.headers['Content-Range']
+    self.ranges.append(content_range)
+    self.body += http_request._body_parts[0]
+    if content_range.split('-')[-1] == '%i/%i' % (self.last, self.total):
+      return atom.mock_http_core.MockHttpResponse(
+          201, 'Created', {'Content-Type': 'application/atom+xml'}, ENTRY)
+    return atom.mock_http_core.MockHttpResponse(
+        308, 'Resume Incomplete', {}, '')
+
+
+class CountingFile(object):
+  """A file which counts its reads, and fails the one numbered fail_on."""
+
+  def __init__(self, data, fail_on=None):
+    self.file = StringIO.StringIO(data)
+    self.reads = 0
+    self.fail_on = fail_on
+
+  def read(self, size):
+    self.reads += 1
+    if self.reads == self.fail_on:
+      raise IOError('disk went away')
+    return self.file.read(size)
+
+  def seek(self, offset):
+    self.file.seek(offset)
+
+
+class UploadChunksTest(unittest.TestCase):
+
+  def uploader(self, f, total, chunk_size, server=None, adapt=False):
+    self.server = server or ChunkServer(total)
+    client = gdata.client.GDClient(http_client=self.server)
+    uploader = gdata.client.ResumableUploader(
+        client, f, 'text/plain', total, chunk_size=chunk_size,
+        desired_class=gdata.data.GDEntry, adapt_chunk_size=adapt)
+    uploader.upload_uri = UPLOAD_URI
+    return uploader
+
+  def test_chunk_boundaries(self):
+    uploader = self.uploader(StringIO.StringIO('abcdefghij'), 10, 4)
+    entry = uploader.resume_upload(start_byte=0)
+    self.assertEqual(entry.id.text, 'done')
+    self.assertEqual(self.server.ranges,
+                     ['bytes 0-3/10', 'bytes 4-7/10', 'bytes 8-9/10'])
+    self.assertEqual(self.server.body, 'abcdefghij')
+
+  def test_resume_from_the_middle(self):
+    uploader = self.uploader(StringIO.StringIO('abcdefghij'), 10, 4)
+    uploader.resume_upload(start_byte=6)
+    self.assertEqual(self.server.ranges, ['bytes 6-9/10'])
+    self.assertEqual(self.server.body, 'ghij')
+
+  def test_exact_multiple_of_chunk_size(self):
+    uploader = self.uploader(StringIO.StringIO('abcdefgh'), 8, 4)
+    uploader.resume_upload(start_byte=0)
+    self.assertEqual(self.server.ranges, ['bytes 0-3/8', 'bytes 4-7/8'])
+
+  def test_server_wanting_more_than_the_file(self):
+    # The server never says it is done, so the upload must not loop on
+    # empty chunks.
+    server = ChunkServer(10, last=10)
+    uploader = self.uploader(StringIO.StringIO('abcdefghij'), 10, 4, server)
+    self.assertRaises(gdata.client.Error, uploader.resume_upload,
+                      start_byte=0)
+    self.assertEqual(len(server.ranges), 3)
+
+  def test_at_most_two_chunks_are_read(self):
+    f = CountingFile('x' * 100)
+    # Give the reader plenty of time to run ahead while a chunk is sent.
+    server = ChunkServer(100, delay=0.01)
+    uploader = self.uploader(f, 100, 10, server)
+    seen = []
+    server.on_request = lambda: seen.append(f.reads - len(server.ranges))
+    uploader.resume_upload(start_byte=0)
+    self.assertEqual(len(server.ranges), 10)
+    # The chunk being sent and, at most, the next one.
+    self.assertTrue(max(seen) <= 2, seen)
+
+  def test_read_error_is_raised_in_the_caller(self):
+    f = CountingFile('x' * 100, fail_on=3)
+    uploader = self.uploader(f, 100, 10)
+    errors = []
+
+    def upload():
+      try:
+        uploader.resume_upload(start_byte=0)
+      except IOError, e:
+        errors.append(e)
+
+    thread = threading.Thread(target=upload)
+    thread.setDaemon(True)
+    thread.start()
+    thread.join(5)
+    self.assertFalse(thread.isAlive())
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(str(errors[0]), 'disk went away')
+    self.assertEqual(self.server.ranges, ['bytes 0-9/100', 'bytes 10-19/100'])
+
+
+class AdaptChunkSizeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.uploader = gdata.client.ResumableUploader(
+        None, None, 'text/plain', 1024 ** 3, chunk_size=1024 * 1024)
+    self.granularity = gdata.client.ResumableUploader.CHUNK_GRANULARITY
+
+  def adapt(self, sent, seconds, remaining=1024 ** 3 / 2):
+    self.uploader._adapt_chunk_size(sent, seconds, remaining)
+    return self.uploader.chunk_size
+
+  def test_fast_connection_grows_the_chunk(self):
+    # 1MB in 0.1s is 20MB in two seconds; it goes half way there.
+    size = self.adapt(1024 * 1024, 0.1)
+    self.assertEqual(size, 11010048)
+    self.assertEqual(size % self.granularity, 0)
+    self.assertTrue(self.adapt(size, 0.1) > size)
+
+  def test_growth_stops_at_the_maximum(self):
+    for i in range(20):
+      size = self.adapt(self.uploader.chunk_size, 0.001)
+    self.assertEqual(size, gdata.client.ResumableUploader.MAX_CHUNK_SIZE)
+
+  def test_slow_connection_shrinks_the_chunk(self):
+    size = self.adapt(1024 * 1024, 10)
+    self.assertEqual(size, 524288)
+    self.assertEqual(self.adapt(size, 100),
+                     gdata.client.ResumableUploader.MIN_CHUNK_SIZE)
+
+  def test_leaves_chunks_to_overlap_near_the_end(self):
+    # Fast enough for 20MB chunks, but only 2MB are left.
+    size = self.adapt(1024 * 1024, 0.1, remaining=2 * 1024 * 1024)
+    self.assertEqual(size, 786432)
+
+  def test_short_last_chunk_is_ignored(self):
+    self.assertEqual(self.adapt(1000, 10), 1024 * 1024)
+
+  def test_can_be_turned_off(self):
+    self.uploader.adapt_chunk_size = False
+    self.assertEqual(self.adapt(1024 * 1024, 0.1), 1024 * 1024)
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(UploadChunksTest, 'test'),
+      unittest.makeSuite(AdaptChunkSizeTest, 'test'),))
+
+
+if __name__ == '__main__':
+  unittest.main()
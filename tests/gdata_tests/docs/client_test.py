@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# This module is used for version 2 of the Google Data APIs.
+
+
+import unittest
+import atom.http_core
+import atom.mock_http_core
+import gdata.docs.client
+import gdata.docs.data
+
+
+FEED_URI = 'https://docs.google.com' + gdata.docs.client.DOCLIST_FEED_URI
+FEED = ('<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<entry><title>Plan</title><author><name>Ann</name>'
+        '<email>ann@example.com</email></author></entry></feed>')
+
+
+class DocListFieldsTest(unittest.TestCase):
+
+  def setUp(self):
+    mock = atom.mock_http_core.MockHttpClient()
+    mock.add_response(atom.http_core.HttpRequest(FEED_URI, 'GET'), 200, 'OK',
+                      {'Content-Type': 'application/atom+xml'}, FEED)
+    self.client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+
+  def test_fields_asking_for_author(self):
+    feed = self.client.get_doclist(fields='entry(title,author)')
+    self.assertEqual(type(feed), gdata.docs.data.DocList)
+    self.assertEqual(feed.entry[0].author[0].name.text, 'Ann')
+
+  def test_stream_with_fields_asking_for_author(self):
+    entries = list(self.client.get_doclist_stream(fields='entry(title,author)'))
+    self.assertEqual(entries[0].author[0].email.text, 'ann@example.com')
+
+  def test_partial_doclist_fields(self):
+    feed = self.client.get_doclist(
+        fields=gdata.docs.data.PARTIAL_DOCLIST_FIELDS)
+    self.assertEqual(type(feed), gdata.docs.data.PartialDocList)
+    self.assertEqual(feed.entry[0].title.text, 'Plan')
+    self.assertEqual(feed.entry[0].author, None)
+
+  def test_next_link_keeps_partial_doclist_fields(self):
+    uri = atom.http_core.Uri.parse_uri(FEED_URI)
+    uri.query['fields'] = gdata.docs.data.PARTIAL_DOCLIST_FIELDS
+    uri.query['start-key'] = 'abc'
+    next_link = str(uri)
+    feed = self.client.get_doclist(uri=next_link)
+    self.assertEqual(type(feed), gdata.docs.data.PartialDocList)
+
+  def test_desired_class(self):
+    feed = self.client.get_doclist(
+        fields='entry(title)', desired_class=gdata.docs.data.PartialDocList)
+    self.assertEqual(type(feed), gdata.docs.data.PartialDocList)
+
+
+def suite():
+  return unittest.TestSuite((
+      unittest.makeSuite(DocListFieldsTest, 'test'),))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+# Runs the sync against recorded responses from a MockHttpClient, so none of
+# these tests talk to the server.
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import atom.core
+import atom.http_core
+import atom.mock_http_core
+import gdata.client
+import gdata.docs.client
+import gdata.docs.data
+import main
+
+BASE = 'https://docs.google.com/feeds/default/private/full/'
+PARENT_REL = 'http://schemas.google.com/docs/2007#parent'
+
+def entryXml(kind, resource_id, title, parents=(), updated='2011-01-01T00:00:00.000Z'):
+    """
+    A doclist entry with the fields the listing uses.
+    """
+    links = ''.join(['<link rel="%s" type="application/atom+xml" href="%sfolder%%3A%s"/>'
+                     % (PARENT_REL, BASE, parent) for parent in parents])
+    if kind == 'folder':
+        src = '%sfolder%%3A%s/contents' % (BASE, resource_id)
+    else:
+        src = exportUri(resource_id)
+    return ('<entry gd:etag=\'"e1"\'><id>%s%s%%3A%s</id>'
+            '<updated>%s</updated>'
+            '<category scheme="http://schemas.google.com/g/2005#kind"'
+            ' term="http://schemas.google.com/docs/2007#%s" label="%s"/>'
+            '<title>%s</title><content type="text/html" src="%s"/>%s'
+            '<gd:resourceId>%s:%s</gd:resourceId></entry>') % (
+        BASE, kind, resource_id, updated, kind, kind, title, src, links, kind, resource_id)
+
+def exportUri(resource_id):
+    return 'https://docs.google.com/feeds/download/documents/%s/Export?docId=%s' % (
+        resource_id, resource_id)
+
+def feedXml(entries):
+    return ('<feed xmlns="http://www.w3.org/2005/Atom" xmlns:gd="http://schemas.google.com/g/2005">'
+            '<id>feed</id><title>feed</title>%s</feed>') % ''.join(entries)
+
+class CollectingDownloader(object):
+    """
+    Stands in for a DownloadQueue and just remembers the docs it's given.
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    def put(self, document):
+        self.documents.append(document)
+
+class CollectingUploads(object):
+    """
+    Stands in for an UploadQueue and just remembers the paths it's given.
+    """
+
+    def __init__(self):
+        self.paths = []
+
+    def closed(self, path):
+        self.paths.append(path)
+
+class ListingTest(unittest.TestCase):
+
+    # folder id -> [(kind, resource_id, title)] of what's in it, None is the root
+    tree = {
+        None: [('folder', 'work', 'Work'), ('folder', 'home', 'Home'),
+               ('document', 'todo', 'Todo')],
+        'work': [('document', 'plan', 'Plan'), ('folder', 'old', 'Old'),
+                 ('document', 'shared', 'Shared')],
+        'home': [('document', 'shared', 'Shared'), ('document', 'slash', 'a/b')],
+        'old': [('document', 'notes', 'Notes')],
+    }
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (main.Folder.gdocs_folder, main.Document.gdocs_folder)
+        main.Folder.gdocs_folder = self.folder
+        main.Document.gdocs_folder = self.folder
+
+        mock = atom.mock_http_core.MockHttpClient()
+        everything = {}
+        for folder_id, children in self.tree.items():
+            entries = []
+            for kind, resource_id, title in children:
+                parents = []
+                if folder_id is not None:
+                    parents = [folder_id]
+                entries.append(entryXml(kind, resource_id, title, parents))
+                everything.setdefault((kind, resource_id, title), []).extend(parents)
+            if folder_id is None:
+                uri = 'https://docs.google.com' + main.ROOT_FEED_URI
+            else:
+                uri = '%sfolder%%3A%s/contents' % (BASE, folder_id)
+            self.addFeed(mock, uri, entries)
+        # the flat listing is one page with every entry's parents on it
+        entries = [entryXml(kind, resource_id, title, parents)
+                   for (kind, resource_id, title), parents in everything.items()]
+        self.addFeed(mock, 'https://docs.google.com' + main.FlatLister.feed_uri, entries)
+
+        self.client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+        self.client.ssl = True
+
+    def tearDown(self):
+        main.Folder.gdocs_folder, main.Document.gdocs_folder = self.saved
+        shutil.rmtree(self.folder)
+
+    def addFeed(self, mock, uri, entries):
+        mock.add_response(atom.http_core.HttpRequest(uri, 'GET'), 200, 'OK',
+                          {'Content-Type': 'application/atom+xml'}, feedXml(entries))
+
+    def paths(self, lister):
+        """
+        Crawl with lister and return the sorted folder and doc paths.
+        """
+        downloader = CollectingDownloader()
+        lister.downloader = downloader
+        root = lister.crawl()
+        folders = sorted([folder.path for folder in root.walk()])
+        docs = sorted([document.path for document in downloader.documents])
+        return folders, docs
+
+    def testCrawlerFindsEveryFolderAndDoc(self):
+        folders, docs = self.paths(main.FolderCrawler(self.client, 3))
+        self.assertEqual(folders, ['/', '/Home/', '/Work/', '/Work/Old/'])
+        prefix = self.folder + '/'
+        self.assertEqual(docs, [prefix + 'Home/Shared.odt', prefix + 'Home/a-b.odt',
+                                prefix + 'Todo.odt', prefix + 'Work/Old/Notes.odt',
+                                prefix + 'Work/Plan.odt', prefix + 'Work/Shared.odt'])
+
+    def testFlatListingMatchesCrawler(self):
+        crawled = self.paths(main.FolderCrawler(self.client, 3))
+        listed = self.paths(main.FlatLister(self.client))
+        self.assertEqual(crawled, listed)
+
+    def testCrawlerWithOneWorkerMatches(self):
+        self.assertEqual(self.paths(main.FolderCrawler(self.client, 1)),
+                         self.paths(main.FolderCrawler(self.client, 5)))
+
+class DocDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = main.DocDb()
+        self.db.setDb(self.folder + '/.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def entry(self, etag):
+        xml = entryXml('document', 'shared', 'Shared').replace('"e1"', etag)
+        xml = xml.replace('<entry ', '<entry xmlns="http://www.w3.org/2005/Atom"'
+                          ' xmlns:gd="http://schemas.google.com/g/2005" ')
+        return atom.core.parse(xml, gdata.docs.data.DocsEntry)
+
+    def testCopiesKeepTheirOwnEtag(self):
+        self.db.addDoc(self.entry('"a"'), '/Work/Shared.odt')
+        self.db.addDoc(self.entry('"a"'), '/Home/Shared.odt')
+        self.db.startPass()
+        self.db.addDoc(self.entry('"b"'), '/Work/Shared.odt')
+        self.assertEqual(self.db.getEtag('document:shared', '/Work/Shared.odt'), '"b"')
+        self.assertEqual(self.db.getEtag('document:shared', '/Home/Shared.odt'), '"a"')
+        self.db.finishPass()
+        self.assertEqual(self.db.getEtag('document:shared', '/Home/Shared.odt'), '"a"')
+        self.assertEqual(self.db.getEtag('document:shared', '/Nowhere.odt'), False)
+
+    def testEveryCopyHasARow(self):
+        self.db.addDoc(self.entry('"a"'), '/Work/Shared.odt')
+        self.db.addDoc(self.entry('"a"'), '/Home/Shared.odt')
+        self.db.resetEtag(self.entry('"c"'), '/Home/Shared.odt')
+        self.assertEqual(self.db.getRowFromPath('/Home/Shared.odt')[:2],
+                         ('document:shared', '"c"'))
+        self.assertEqual(self.db.getRowFromPath('/Work/Shared.odt')[:2],
+                         ('document:shared', '"a"'))
+
+class SyncTest(unittest.TestCase):
+
+    # newest first, which is what the high water mark query asks for
+    docs = [('new', '2011-03-01T00:00:00.000Z'), ('broken', '2011-02-01T00:00:00.000Z'),
+            ('old', '2011-01-01T00:00:00.000Z')]
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (main.Folder.gdocs_folder, main.Document.gdocs_folder)
+        main.Folder.gdocs_folder = self.folder
+        main.Document.gdocs_folder = self.folder
+
+        self.sync = main.DocSync.__new__(main.DocSync)
+        self.sync.gdocs_folder = self.folder
+        self.sync.db_file = self.folder + '/.db'
+        self.sync.db = main.DocDb()
+        self.sync.flat_listing = True
+        self.sync.download_workers = 1
+
+    def tearDown(self):
+        main.Folder.gdocs_folder, main.Document.gdocs_folder = self.saved
+        shutil.rmtree(self.folder)
+
+    def useServer(self, broken_status):
+        """
+        Serve the docs, with the export of 'broken' answering broken_status.
+        """
+        mock = atom.mock_http_core.MockHttpClient()
+        entries = [entryXml('document', resource_id, resource_id.title(), updated=updated)
+                   for resource_id, updated in self.docs]
+        mock.add_response(atom.http_core.HttpRequest(BASE, 'GET'), 200, 'OK',
+                          {'Content-Type': 'application/atom+xml'}, feedXml(entries))
+        for resource_id, updated in self.docs:
+            status = 200
+            if resource_id == 'broken':
+                status = broken_status
+            mock.add_response(atom.http_core.HttpRequest(exportUri(resource_id), 'GET'),
+                              status, 'OK', {}, resource_id)
+        self.sync.client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+        self.sync.client.ssl = True
+
+    def testFailedDownloadHoldsBackHighWater(self):
+        self.useServer(500)
+        self.sync.getAll()
+        self.assertEqual(self.sync.db.getState('high_water'), '2011-02-01T00:00:00.000Z')
+        self.assertFalse(os.path.exists(self.folder + '/Broken.odt'))
+
+        # the next incremental pass asks for the doc again
+        self.useServer(200)
+        self.assertTrue(self.sync.getChanges(self.sync.db.getState('high_water')))
+        self.assertEqual(open(self.folder + '/Broken.odt').read(), 'broken')
+        self.assertEqual(self.sync.db.getState('high_water'), '2011-03-01T00:00:00.000Z')
+
+    def testHighWaterAdvancesWhenEverythingDownloads(self):
+        self.useServer(200)
+        self.sync.getAll()
+        self.assertEqual(self.sync.db.getState('high_water'), '2011-03-01T00:00:00.000Z')
+
+class RecordingHttpClient(atom.mock_http_core.MockHttpClient):
+    """
+    A MockHttpClient that also keeps every request it's sent.
+    """
+
+    def __init__(self):
+        atom.mock_http_core.MockHttpClient.__init__(self)
+        self.requests = []
+
+    def request(self, http_request):
+        self.requests.append(http_request)
+        return atom.mock_http_core.MockHttpClient.request(self, http_request)
+
+class ScriptedHttpClient(object):
+    """
+    Answers each request with the next of the given (status, headers, body)
+    responses, whatever it asks for, and keeps the requests.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, http_request):
+        self.requests.append(http_request)
+        status, headers, body = self.responses.pop(0)
+        return atom.mock_http_core.MockHttpResponse(status, 'OK', headers, body)
+
+class UploadTest(unittest.TestCase):
+
+    media_link = 'https://docs.google.com/feeds/default/media/document%3Ashared'
+    session_uri = 'https://docs.google.com/feeds/upload/create-session/default/private/full/session1'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sync = main.DocSync.__new__(main.DocSync)
+        self.sync.gdocs_folder = self.folder
+        self.sync.db_file = self.folder + '/.db'
+        self.sync.db = main.DocDb()
+        self.sync.db.setDb(self.sync.db_file)
+        self.sync.authd = True
+        self.sync.upload_chunk_size = 512*1024
+        self.sync.upload_retries = 0
+        self.path = self.folder + '/Shared.odt'
+        open(self.path, 'w').write('old')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def entry(self, etag):
+        """
+        The doc as the server lists it, starred and in a folder.
+        """
+        links = ('<link rel="edit-media" href="%s"/>'
+                 '<link rel="http://schemas.google.com/g/2005#resumable-edit-media"'
+                 ' href="https://docs.google.com/feeds/upload/create-session/default/private/full/document%%3Ashared"/>'
+                 '<link rel="alternate" href="https://docs.google.com/Doc?id=shared"/>'
+                 '<category scheme="http://schemas.google.com/g/2005/labels"'
+                 ' term="http://schemas.google.com/g/2005/labels#starred" label="starred"/>'
+                 % self.media_link)
+        xml = entryXml('document', 'shared', 'Shared', ['work'])
+        xml = xml.replace('"e1"', etag).replace('</entry>', links + '</entry>')
+        return xml.replace('<entry ', '<entry xmlns="http://www.w3.org/2005/Atom"'
+                           ' xmlns:gd="http://schemas.google.com/g/2005" ')
+
+    def testUpdateSendsOnlyTheFile(self):
+        mock = RecordingHttpClient()
+        mock.add_response(atom.http_core.HttpRequest(self.media_link, 'PUT'), 200, 'OK',
+                          {'Content-Type': 'application/atom+xml'}, self.entry('"b"'))
+        self.sync.client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+        self.sync.db.addDoc(atom.core.parse(self.entry('"a"'), gdata.docs.data.DocsEntry),
+                            self.path)
+        open(self.path, 'w').write('new')
+        self.sync.updateDoc(self.path)
+
+        request = mock.requests[0]
+        self.assertEqual(request.method, 'PUT')
+        self.assertEqual(str(request.uri), self.media_link)
+        self.assertEqual(request.headers['If-Match'], '"a"')
+        self.assertEqual(request.headers['Content-Type'], gdata.docs.data.MIMETYPES['ODT'])
+        # no entry goes with the file, so the labels and folders the doc
+        # already has can't be overwritten
+        self.assertEqual(len(request._body_parts), 1)
+        self.assertEqual(request._body_parts[0].read(), 'new')
+        self.assertEqual(self.sync.db.getEtag('document:shared', self.path), '"b"')
+
+    def testRestartResumesSavedUpload(self):
+        self.sync.db.addDoc(atom.core.parse(self.entry('"a"'), gdata.docs.data.DocsEntry),
+                            self.path)
+        # the last run got part of the way through uploading this
+        open(self.path, 'w').write('new content')
+        self.sync.db.setUpload(self.path, self.session_uri, main.fileState(self.path)[0])
+        # and started on these, which have changed or gone since
+        edited = self.folder + '/Edited.odt'
+        open(edited, 'w').write('edited again')
+        self.sync.db.setUpload(edited, self.session_uri + 'x', 'stale')
+        self.sync.db.setUpload(self.folder + '/Gone.odt', self.session_uri + 'y', 'stale')
+
+        # start up again
+        sync = main.DocSync.__new__(main.DocSync)
+        sync.__dict__.update(self.sync.__dict__)
+        sync.db = main.DocDb()
+        sync.upload_chunk_size = 4
+        mock = ScriptedHttpClient([(308, {'Range': 'bytes=0-4'}, ''),
+                                   (308, {'Range': 'bytes=0-8'}, ''),
+                                   (201, {'Content-Type': 'application/atom+xml'},
+                                    self.entry('"b"'))])
+        sync.client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+
+        uploads = CollectingUploads()
+        sync._resumeUploads(uploads)
+        self.assertEqual(uploads.paths, [self.path, edited])
+        self.assertEqual(sync.db.getUpload(edited), None)
+        self.assertEqual(sync.db.getUpload(self.folder + '/Gone.odt'), None)
+
+        # the upload carries on from what the server has, in the same session
+        sync.updateDoc(self.path)
+        self.assertEqual([str(request.uri) for request in mock.requests],
+                         [self.session_uri] * 3)
+        self.assertEqual([request.headers['Content-Range'] for request in mock.requests],
+                         ['bytes */11', 'bytes 5-8/11', 'bytes 9-10/11'])
+        self.assertEqual(sync.db.getUpload(self.path), None)
+        self.assertEqual(sync.db.getEtag('document:shared', self.path), '"b"')
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.saved = (main.Folder.gdocs_folder, main.Document.gdocs_folder)
+        main.Folder.gdocs_folder = self.folder
+        main.Document.gdocs_folder = self.folder
+        self.db = main.DocDb()
+        self.db.setDb(self.folder + '/.db')
+        self.path = self.folder + '/Shared.odt'
+        self.part = gdata.docs.client.partial_path(self.path)
+
+        # an earlier attempt got the first three bytes of this version
+        open(self.part, 'wb').write('abc')
+        self.db.setPartial(self.path, 'document:shared', '"e1"', 3)
+
+    def tearDown(self):
+        main.Folder.gdocs_folder, main.Document.gdocs_folder = self.saved
+        shutil.rmtree(self.folder)
+
+    def save(self, status, headers, body):
+        """
+        Save the doc with the export answering status, and return the
+        request that was sent.
+        """
+        mock = RecordingHttpClient()
+        mock.add_response(atom.http_core.HttpRequest(exportUri('shared'), 'GET'),
+                          status, 'OK', headers, body)
+        client = gdata.docs.client.DocsClient(source='test', http_client=mock)
+        client.ssl = True
+        xml = entryXml('document', 'shared', 'Shared').replace(
+            '<entry ', '<entry xmlns="http://www.w3.org/2005/Atom"'
+            ' xmlns:gd="http://schemas.google.com/g/2005" ')
+        document = main.Document(atom.core.parse(xml, gdata.docs.data.DocsEntry),
+                                 client=client, downloader=CollectingDownloader())
+        try:
+            document.save(client, self.db)
+        finally:
+            main.Document.written.pop(self.path, None)
+        return mock.requests[0]
+
+    def testResumesWhereThePartialFileEnds(self):
+        request = self.save(206, {'Content-Range': 'bytes 3-5/6'}, 'def')
+        self.assertEqual(request.headers['Range'], 'bytes=3-')
+        self.assertEqual(open(self.path, 'rb').read(), 'abcdef')
+        self.assertFalse(os.path.exists(self.part))
+        self.assertEqual(self.db.getPartial(self.path), None)
+
+    def testServerIgnoringRangeStartsOver(self):
+        request = self.save(200, {'Content-Length': '6'}, 'abcdef')
+        self.assertEqual(request.headers['Range'], 'bytes=3-')
+        self.assertEqual(open(self.path, 'rb').read(), 'abcdef')
+        self.assertFalse(os.path.exists(self.part))
+
+    def testInterruptedResumeKeepsWhatArrived(self):
+        self.assertRaises(gdata.client.Error, self.save,
+                          206, {'Content-Range': 'bytes 3-8/9'}, 'def')
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(open(self.part, 'rb').read(), 'abcdef')
+        self.assertEqual(self.db.getPartial(self.path), ('document:shared', '"e1"', 6))
+
+class RejectingSyncer(object):
+    """
+    A syncer whose token has expired.
+    """
+
+    polls = 0
+
+    def poll(self):
+        self.polls += 1
+        raise gdata.client.Unauthorized('Token expired')
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def testFloorIsNeverAboveTheInterval(self):
+        self.assertEqual(main.PollScheduler(None, 10).min_interval, 10)
+        self.assertEqual(main.PollScheduler(None, 60).min_interval, 30)
+        self.assertEqual(main.PollScheduler(None, 300).min_interval, 75)
+
+    def testRejectedTokenStopsPolling(self):
+        syncer = RejectingSyncer()
+        scheduler = main.PollScheduler(syncer, 0.01)
+        scheduler.start()
+        scheduler.thread.join(5)
+        self.assertFalse(scheduler.thread.isAlive())
+        self.assertEqual(syncer.polls, 1)
+        self.assertTrue(isinstance(scheduler.error, gdata.client.Unauthorized))
+
+    def testWatcherRaisesRejectedToken(self):
+        folder = tempfile.mkdtemp()
+        try:
+            sync = main.DocSync.__new__(main.DocSync)
+            sync.gdocs_folder = folder
+            sync.db_file = folder + '/.db'
+            sync.db = main.DocDb()
+            sync.scheduler = main.PollScheduler(RejectingSyncer(), 0.01)
+            sync.scheduler.start()
+            self.assertRaises(gdata.client.Unauthorized, sync._watchFolder)
+            self.assertEqual(sync.scheduler, None)
+        finally:
+            shutil.rmtree(folder)
+
+def suite():
+    return unittest.TestSuite((unittest.makeSuite(ListingTest, 'test'),
+                               unittest.makeSuite(DocDbTest, 'test'),
+                               unittest.makeSuite(SyncTest, 'test'),
+                               unittest.makeSuite(UploadTest, 'test'),
+                               unittest.makeSuite(DownloadTest, 'test'),
+                               unittest.makeSuite(PollSchedulerTest, 'test')))
+
+if __name__ == '__main__':
+    unittest.main()